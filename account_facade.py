@@ -5,13 +5,21 @@ Logic to perform high level user account access and management operations.
 @license GNU GPL v3
 """
 
+import binascii
 import datetime
+import hashlib
+import os
+import time
 
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from webapp2_extras import securecookie
 
 import collections
 import constants
 import models
+import notifications
 import util
 
 
@@ -21,31 +29,123 @@ FlashMessage = collections.namedtuple(
     ["msg_type", "msg"]
 )
 
+# Simple struct to hold the fields of a user shown in portfolio listings
+RosterEntry = collections.namedtuple(
+    "RosterEntry",
+    ["email", "safe_email", "first_name", "last_name"]
+)
+
+# Simple struct to hold the unread comment counts for a portfolio
+PortfolioStatus = collections.namedtuple(
+    "PortfolioStatus",
+    ["roster_entry", "section_statuses", "num_comments"]
+)
+
+# Simple struct to hold the comments shown on a portfolio section page
+CommentListing = collections.namedtuple(
+    "CommentListing",
+    ["new_comments", "old_comments", "last_visited", "older_cursor"]
+)
+
+# Simple struct to hold the name (used in URLs) and title of a section
+SectionInfo = collections.namedtuple(
+    "SectionInfo",
+    ["name", "title"]
+)
+
+# Simple struct to hold the portfolio sections cached by this instance
+SectionCache = collections.namedtuple(
+    "SectionCache",
+    ["version", "checked", "sections"]
+)
+
+# Simple struct to hold unread counts changed since a client's last poll
+UnreadUpdate = collections.namedtuple(
+    "UnreadUpdate",
+    ["token", "unread_counts"]
+)
+
+# Serializer for signed flash message cookies (loaded on first use)
+flash_cookie_serializer = None
+
+# Portfolio sections cached by this instance (loaded on first use)
+section_cache = None
+
+
+class ViewerContext(object):
+    """
+    Identity of the user making a request, resolved once per request.
+
+    Identity of the user making a request along with his / her UserInfo record
+    and access privileges. Can be passed to account_facade functions in place
+    of a google.appengine.api.users.User to avoid repeated record lookups.
+    """
+
+    def __init__(self, user, user_info):
+        """
+        Create a new ViewerContext.
+
+        @param user: The user making the request or None if not logged in.
+        @type user: google.appengine.api.users.User
+        @param user_info: The UserInfo record for the given user or None if
+                          none exists.
+        @type user_info: models.UserInfo
+        """
+        self.user = user
+        self.user_info = user_info
+        self.is_reviewer = bool(user_info and user_info.is_reviewer)
+        self.is_admin = bool(user_info and user_info.is_admin)
+
+    def email(self):
+        """
+        Get the email address of the user making the request.
+
+        @return: The email address of the user.
+        @rtype: str
+        """
+        return self.user.email()
+
+
+def get_viewer_context(viewing_user):
+    """
+    Resolve the identity and access privileges of a user.
+
+    @param viewing_user: The user to resolve or an already resolved context.
+    @type viewing_user: ViewerContext or google.appengine.api.users.User
+    @return: Context with the given user's UserInfo record and privileges.
+    @rtype: ViewerContext
+    """
+    if isinstance(viewing_user, ViewerContext):
+        return viewing_user
+    elif viewing_user == None:
+        return ViewerContext(None, None)
+    else:
+        user_info = models.UserInfo.get_for_user(viewing_user)
+        return ViewerContext(viewing_user, user_info)
+
 
 def is_reviewer(viewing_user):
     """
     Determines if the specified user has "profile reviewer" access privileges.
 
     @param viewing_user: The user to determine reviewer privileges for.
-    @type viewing_user: google.appengine.api.users.User
+    @type viewing_user: ViewerContext or google.appengine.api.users.User
     @return: True if user can review other users' profiles and False otherwise.
     @rtype: bool
     """
-    target_user_info = models.UserInfo.get_for_user(viewing_user)
-    return target_user_info.is_reviewer
+    return get_viewer_context(viewing_user).is_reviewer
 
 
 def is_admin(viewing_user):
     """
-    Determines if the specified user has "profile reviewer" access privileges.
+    Determines if the specified user has administrator access privileges.
 
-    @param viewing_user: The user to determine reviewer privileges for.
-    @type viewing_user: google.appengine.api.users.User
-    @return: True if user can review other users' profiles and False otherwise.
+    @param viewing_user: The user to determine administrator privileges for.
+    @type viewing_user: ViewerContext or google.appengine.api.users.User
+    @return: True if user can administer the application and False otherwise.
     @rtype: bool
     """
-    target_user_info = models.UserInfo.get_for_user(viewing_user)
-    return target_user_info.is_admin
+    return get_viewer_context(viewing_user).is_admin
 
 
 def ensure_user_info(target_user):
@@ -62,7 +162,8 @@ def ensure_user_info(target_user):
     """
     user_info = models.UserInfo.get_for_user(target_user)
     if not user_info:
-        user_info = models.UserInfo()
+        user_info = models.UserInfo(
+            key_name=models.UserInfo.get_key_name(target_user.email()))
         user_info.email = target_user.email()
         user_info.safe_email = util.get_safe_email(target_user)
         user_info.is_reviewer = False
@@ -71,15 +172,43 @@ def ensure_user_info(target_user):
         user_info.first_name = name_parts[0]
         user_info.last_name = name_parts[1]
         user_info.put()
+        invalidate_roster()
     return user_info
 
 
+def make_reviewer(target_email):
+    """
+    Give a user "profile reviewer" access privileges.
+
+    @param target_email: The email address of the user to make a reviewer.
+    @type target_email: str
+    """
+    target_user_info = models.UserInfo.get_for_email(target_email)
+    target_user_info.is_reviewer = True
+    target_user_info.put()
+    invalidate_roster()
+
+
+def make_admin(target_email):
+    """
+    Give a user administrator (and "profile reviewer") access privileges.
+
+    @param target_email: The email address of the user to make an admin.
+    @type target_email: str
+    """
+    target_user_info = models.UserInfo.get_for_email(target_email)
+    target_user_info.is_reviewer = True
+    target_user_info.is_admin = True
+    target_user_info.put()
+    invalidate_roster()
+
+
 def viewer_has_access(viewing_user, profile_user_email):
     """
     Check to see if a user has access to the given profile's private comments.
 
     @param viewing_user: The user to check access permissions for.
-    @type viewing_user: google.appengine.api.users.User
+    @type viewing_user: ViewerContext or google.appengine.api.users.User
     @param profile_user_email: The email of the user whose profile access rights
                                are in question for.
     @type profile_user_email: 
@@ -88,20 +217,18 @@ def viewer_has_access(viewing_user, profile_user_email):
     @rtype: bool
     """
     # Check actually logged in
-    if viewing_user == None:
-        return False
-
-    # Check that a portfolio even exists
-    if not models.UserInfo.get_for_email(profile_user_email):
+    viewer = get_viewer_context(viewing_user)
+    if viewer.user == None:
         return False
 
-    # Provide access to own portfolio and others if reviewer
-    if viewing_user.email() == profile_user_email:
-        return True
-    elif is_reviewer(viewing_user):
-        return True
+    # Provide access to own portfolio (if it exists)
+    if viewer.email() == profile_user_email:
+        return viewer.user_info != None
 
-    return False
+    # Provide access to others if reviewer and the portfolio even exists
+    if not viewer.is_reviewer:
+        return False
+    return models.UserInfo.get_for_email(profile_user_email) != None
 
 
 def get_new_comments(viewing_user, profile_user_email, section_name=None):
@@ -112,7 +239,7 @@ def get_new_comments(viewing_user, profile_user_email, section_name=None):
     profile of the user with the given email.
 
     @param viewing_user: The user for whom new comments should be returned.
-    @type viewing_user: google.appengine.api.users.User
+    @type viewing_user: ViewerContext or google.appengine.api.users.User
     @param profile_user_email: The email of the user whose profile is being
                                queried for new comments.
     @type profile_user_email: str
@@ -124,9 +251,29 @@ def get_new_comments(viewing_user, profile_user_email, section_name=None):
              has not yet seen.
     @rtype: Iterable over models.Comment
     """
-    viewing_profile = models.ViewingProfile.get_for(
-        viewing_user, profile_user_email, section_name)
-    last_visited = viewing_profile.last_visited
+    last_visited = get_last_visits(
+        viewing_user.email(), [(profile_user_email, section_name)])[0]
+    return get_comments_since(profile_user_email, last_visited, section_name)
+
+
+def get_comments_since(profile_user_email, last_visited, section_name=None):
+    """
+    Get the comments left on a profile after a user last visited it.
+
+    @param profile_user_email: The email of the user whose profile is being
+                               queried for new comments.
+    @type profile_user_email: str
+    @param last_visited: The time the user last visited the profile / section
+                         or None if never visited.
+    @type last_visited: datetime.datetime
+    @keyword section_name: The name of the section on which new comments should
+                           be looked for. If None, all profile sections will be
+                           examined.
+    @type section_name: str
+    @return: Comments for the given profile and section left after the given
+             time (all comments if last_visited is None).
+    @rtype: Iterable over models.Comment
+    """
     if last_visited:
         return models.Comment.get_past_date(
             profile_user_email, last_visited, section_name)
@@ -142,7 +289,7 @@ def get_old_comments(viewing_user, profile_user_email, section_name=None):
     profile of the user with the given email.
 
     @param viewing_user: The user for whom old comments should be returned.
-    @type viewing_user: google.appengine.api.users.User
+    @type viewing_user: ViewerContext or google.appengine.api.users.User
     @param profile_user_email: The email of the user whose profile is being
                                queried for old comments.
     @type profile_user_email: str
@@ -154,13 +301,477 @@ def get_old_comments(viewing_user, profile_user_email, section_name=None):
              has already seen.
     @rtype: Iterable over models.Comment
     """
-    viewing_profile = models.ViewingProfile.get_for(
-        viewing_user, profile_user_email, section_name)
-    last_visited = viewing_profile.last_visited
+    last_visited = get_last_visits(
+        viewing_user.email(), [(profile_user_email, section_name)])[0]
     return models.Comment.get_before_or_on_date(
         profile_user_email, last_visited, section_name)
 
 
+def get_unread_counts(viewing_user, profile_emails):
+    """
+    Get the number of unread comments per section for many portfolios.
+
+    Read the precomputed unread comment counters for the given user on every
+    section of the given portfolios in a single batch. Sections without a
+    counter yet (user never visited or records predating the counters) are
+    counted from comments without saving anything and a task is enqueued to
+    build their counters (see enqueue_counter_building).
+
+    @param viewing_user: The user for whom unread comments should be counted.
+    @type viewing_user: ViewerContext or google.appengine.api.users.User
+    @param profile_emails: The emails of the users whose portfolios should be
+                           examined.
+    @type profile_emails: Iterable over str
+    @return: Mapping from profile email to the number of unread comments in
+             each section containing > 0 unread comments for the given user.
+    @rtype: Dict mapping str to (dict mapping str to int)
+    """
+    return get_unread_counts_async(viewing_user, profile_emails).get_result()
+
+
+def get_unread_counts_async(viewing_user, profile_emails):
+    """
+    Start getting the number of unread comments per section for portfolios.
+
+    Asynchronous version of get_unread_counts that starts reading the unread
+    comment counters right away but only waits for them when the result is
+    used.
+
+    @param viewing_user: The user for whom unread comments should be counted.
+    @type viewing_user: ViewerContext or google.appengine.api.users.User
+    @param profile_emails: The emails of the users whose portfolios should be
+                           examined.
+    @type profile_emails: Iterable over str
+    @return: Lazy result of get_unread_counts.
+    @rtype: util.LazyResult
+    """
+    viewer_email = viewing_user.email()
+    profile_emails = list(profile_emails)
+    sections = get_portfolio_section_names()
+    profile_section_pairs = [
+        (profile_email, section)
+        for profile_email in profile_emails
+        for section in sections
+    ]
+    counters_rpc = models.UnreadCounter.get_for_async(
+        viewer_email, profile_section_pairs)
+
+    def get_result():
+        counters = counters_rpc.get_result()
+
+        counts = dict(map(
+            lambda (pair, counter): (pair, counter and counter.count),
+            zip(profile_section_pairs, counters)
+        ))
+
+        # Count sections without a counter from comments since the last
+        # visit (capped, read-only) and leave saving the counters to a task
+        missing_pairs = filter(lambda pair: counts[pair] == None,
+            profile_section_pairs)
+        if missing_pairs:
+            last_visits = get_last_visits(viewer_email, missing_pairs)
+            keys_rpcs = map(
+                lambda ((profile_email, section), last_visited):
+                    models.Comment.get_keys_past_date_async(
+                        profile_email,
+                        last_visited,
+                        section,
+                        limit=constants.UNREAD_COUNT_CAP + 1
+                    ),
+                zip(missing_pairs, last_visits)
+            )
+            enqueue_counter_building(viewer_email,
+                set(map(lambda (profile_email, section): profile_email,
+                    missing_pairs)))
+            for pair, keys_rpc in zip(missing_pairs, keys_rpcs):
+                counts[pair] = len(keys_rpc.get_result())
+
+        listings = dict(map(lambda x: (x, {}), profile_emails))
+        for (profile_email, section), count in counts.items():
+            if count > 0:
+                listings[profile_email][section] = count
+
+        return listings
+
+    return util.LazyResult(get_result)
+
+
+def get_counters_pending_key(viewer_email, profile_user_email):
+    """
+    Get the memcache key marking that a user's counters on a portfolio will
+    be built.
+
+    @param viewer_email: The email of the user whose counters will be built.
+    @type viewer_email: str
+    @param profile_user_email: The email address of the user whose portfolio
+                               the counters are for.
+    @type profile_user_email: str
+    @return: The memcache key that is set while building the given user's
+             counters on the given portfolio is pending.
+    @rtype: str
+    """
+    return "counters_pending_%s_%s" % (viewer_email, profile_user_email)
+
+
+def enqueue_counter_building(viewer_email, profile_emails):
+    """
+    Enqueue the task that builds a user's missing counters on portfolios.
+
+    Enqueue a single task building the user's missing unread counters on the
+    given portfolios, skipping portfolios for which a build was enqueued in
+    the last constants.COUNTER_BUILD_WINDOW seconds so that repeated page
+    loads and polls do not enqueue duplicate tasks.
+
+    @param viewer_email: The email of the user whose counters should be built.
+    @type viewer_email: str
+    @param profile_emails: The emails of the users whose portfolios the
+                           counters are for.
+    @type profile_emails: Iterable over str
+    """
+    pending_keys = dict(map(
+        lambda x: (get_counters_pending_key(viewer_email, x), x),
+        profile_emails
+    ))
+    already_pending = memcache.add_multi(
+        dict(map(lambda x: (x, True), pending_keys)),
+        time=constants.COUNTER_BUILD_WINDOW
+    )
+    profile_emails = [
+        profile_email for key, profile_email in pending_keys.items()
+        if not key in already_pending
+    ]
+    if profile_emails:
+        taskqueue.add(
+            url=constants.BUILD_COUNTERS_URL,
+            params={
+                "viewer_email": viewer_email,
+                "profile_email": sorted(profile_emails)
+            }
+        )
+
+
+def build_unread_counters(viewer_email, profile_emails):
+    """
+    Save a user's missing unread counters on every section of portfolios.
+
+    Save the counters that do not exist yet (see build_unread_counter), each
+    in its own transaction. Run by the task enqueued by
+    enqueue_counter_building, outside of page requests.
+
+    @param viewer_email: The email of the user whose counters should be built.
+    @type viewer_email: str
+    @param profile_emails: The emails of the users whose portfolios the
+                           counters are for.
+    @type profile_emails: Iterable over str
+    @return: The number of counters saved.
+    @rtype: int
+    """
+    sections = get_portfolio_section_names()
+    profile_section_pairs = [
+        (profile_email, section)
+        for profile_email in profile_emails
+        for section in sections
+    ]
+    counters = models.UnreadCounter.get_for(viewer_email,
+        profile_section_pairs)
+    missing_pairs = [
+        pair for pair, counter in zip(profile_section_pairs, counters)
+        if not counter
+    ]
+    last_visits = get_last_visits(viewer_email, missing_pairs)
+    for (profile_email, section), last_visited in zip(missing_pairs,
+        last_visits):
+        db.run_in_transaction(build_unread_counter, viewer_email,
+            profile_email, section, last_visited)
+    return len(missing_pairs)
+
+
+def build_unread_counter(viewer_email, profile_user_email, section_name,
+    last_visited):
+    """
+    Get a user's unread counter on a section, counting comments if missing.
+
+    Get a user's unread counter on a portfolio section or, if the counter
+    does not exist yet, save a new one counting the comments posted after the
+    user's last visit (no further than needed to display a capped badge). The
+    counted comments are remembered so that they are not counted again. Must
+    be run in a transaction on the entity group of the portfolio so that
+    comments saved concurrently (see save_comment) are counted exactly once.
+
+    @param viewer_email: The email of the user whose counter should be built.
+    @type viewer_email: str
+    @param profile_user_email: The email address of the user whose portfolio
+                               the counter is for.
+    @type profile_user_email: str
+    @param section_name: The name of the section the counter is for.
+    @type section_name: str
+    @param last_visited: When the user last viewed the section or None if
+                         never viewed.
+    @type last_visited: datetime.datetime
+    @return: The saved counter.
+    @rtype: models.UnreadCounter
+    """
+    counter = models.UnreadCounter.get(models.UnreadCounter.get_key(
+        viewer_email, profile_user_email, section_name))
+    if counter:
+        return counter
+
+    keys = models.Comment.get_keys_past_date_async(
+        profile_user_email,
+        last_visited,
+        section_name,
+        limit=constants.UNREAD_COUNT_CAP + 1
+    ).get_result()
+    counter = models.UnreadCounter.create(
+        viewer_email, profile_user_email, section_name, len(keys))
+    counter.set_counted_comments(reversed(keys))
+    counter.put()
+    return counter
+
+
+def get_comments(viewing_user, profile_user_email, section_name=None,
+    page_size=constants.COMMENTS_PAGE_SIZE):
+    """
+    Get both the new and old comments for a given user on a given profile.
+
+    Get the comments that the given viewing user has and has not yet seen for
+    the profile of the user with the given email, looking up when the user
+    last visited the profile only once. Only the first page of old comments
+    is returned (see get_older_comments).
+
+    @param viewing_user: The user for whom comments should be returned.
+    @type viewing_user: ViewerContext or google.appengine.api.users.User
+    @param profile_user_email: The email of the user whose profile is being
+                               queried for comments.
+    @type profile_user_email: str
+    @keyword section_name: The name of the section on which comments should be
+                           looked for. If None, all profile sections will be
+                           examined.
+    @type section_name: str
+    @keyword page_size: The maximum number of old comments to return.
+                        Defaults to constants.COMMENTS_PAGE_SIZE.
+    @type page_size: int
+    @return: The new comments and first page of old comments for the given
+             profile and section along with the cursor for the next page of
+             old comments (None if no more old comments).
+    @rtype: CommentListing
+    """
+    return get_comments_async(viewing_user, profile_user_email, section_name,
+        page_size).get_result()
+
+
+def get_comments_async(viewing_user, profile_user_email, section_name=None,
+    page_size=constants.COMMENTS_PAGE_SIZE):
+    """
+    Start getting both the new and old comments for a user on a profile.
+
+    Asynchronous version of get_comments that starts looking up when the user
+    last visited the profile right away but only waits for it when the result
+    is used.
+
+    @param viewing_user: The user for whom comments should be returned.
+    @type viewing_user: ViewerContext or google.appengine.api.users.User
+    @param profile_user_email: The email of the user whose profile is being
+                               queried for comments.
+    @type profile_user_email: str
+    @keyword section_name: The name of the section on which comments should be
+                           looked for. If None, all profile sections will be
+                           examined.
+    @type section_name: str
+    @keyword page_size: The maximum number of old comments to return.
+                        Defaults to constants.COMMENTS_PAGE_SIZE.
+    @type page_size: int
+    @return: Lazy result of get_comments.
+    @rtype: util.LazyResult
+    """
+    last_visits = get_last_visits_async(
+        viewing_user.email(), [(profile_user_email, section_name)])
+    comments = get_cached_comments(profile_user_email, section_name)
+
+    def get_result():
+        last_visited = last_visits[0]
+
+        # Split cached comments in memory unless history exceeds the cache
+        if len(comments) < constants.COMMENT_CACHE_SIZE:
+            new_comments = filter(
+                lambda x: models.is_later(x.timestamp, last_visited),
+                comments
+            )
+            old_comments = filter(
+                lambda x: not models.is_later(x.timestamp, last_visited),
+                comments
+            )
+            if len(old_comments) > page_size:
+                old_comments = old_comments[:page_size]
+                older_cursor = fetch_older_comment_keys(
+                    profile_user_email, last_visited, section_name,
+                    page_size)[1]
+            else:
+                older_cursor = None
+        else:
+            new_comments = get_comments_since(
+                profile_user_email, last_visited, section_name)
+            old_comments, older_cursor = get_older_comments(
+                profile_user_email, last_visited, section_name,
+                page_size=page_size)
+
+        return CommentListing(new_comments, old_comments, last_visited,
+            older_cursor)
+
+    return util.LazyResult(get_result)
+
+
+def fetch_older_comment_keys(profile_user_email, last_visited, section_name,
+    page_size, cursor=None):
+    """
+    Get the keys for a page of comments posted before or on a visit.
+
+    @param profile_user_email: The email of the user whose profile is being
+                               queried for old comments.
+    @type profile_user_email: str
+    @param last_visited: The time of the visit splitting new and old comments.
+    @type last_visited: datetime.datetime
+    @param section_name: The name of the section to get comments for. If None,
+                         comments for all sections will be returned.
+    @type section_name: str
+    @param page_size: The number of comments in a page.
+    @type page_size: int
+    @keyword cursor: The cursor the page starts at or None for the first page.
+    @type cursor: str
+    @return: The keys of the comments in the page and the cursor after them.
+    @rtype: Tuple of list of db.Key and str
+    """
+    query = models.Comment.get_before_or_on_date(
+        profile_user_email, last_visited, section_name, keys_only=True)
+    query.with_cursor(cursor)
+    keys = query.fetch(page_size)
+    return (keys, query.cursor())
+
+
+def get_older_comments(profile_user_email, last_visited, section_name=None,
+    cursor=None, page_size=constants.COMMENTS_PAGE_SIZE):
+    """
+    Get a page of the comments posted before or on a user's last visit.
+
+    @param profile_user_email: The email of the user whose profile is being
+                               queried for old comments.
+    @type profile_user_email: str
+    @param last_visited: The time of the visit splitting new and old comments
+                         (see CommentListing.last_visited).
+    @type last_visited: datetime.datetime
+    @keyword section_name: The name of the section to get comments for. If
+                           None, comments for all sections will be returned.
+    @type section_name: str
+    @keyword cursor: The cursor returned with the previous page or None for
+                     the first page.
+    @type cursor: str
+    @keyword page_size: The maximum number of comments to return. Defaults to
+                        constants.COMMENTS_PAGE_SIZE.
+    @type page_size: int
+    @return: The comments in the page in reverse chronological order and the
+             cursor for the next page (None if no more comments).
+    @rtype: Tuple of list of models.Comment and str
+    """
+    keys, next_cursor = fetch_older_comment_keys(
+        profile_user_email, last_visited, section_name, page_size, cursor)
+    comments = filter(None, db.get(keys))
+    if len(keys) < page_size:
+        next_cursor = None
+    return (comments, next_cursor)
+
+
+def get_comment_cache_key(profile_user_email, section_name):
+    """
+    Get the memcache key under which a comment listing is cached.
+
+    @param profile_user_email: The email of the user whose portfolio comments
+                               are cached.
+    @type profile_user_email: str
+    @param section_name: The name of the section whose comments are cached or
+                         None for comments on all sections.
+    @type section_name: str
+    @return: Memcache key for the listing.
+    @rtype: str
+    """
+    if section_name == None:
+        section_name = ""
+    return "comments_%s_%s" % (profile_user_email, section_name)
+
+
+def get_cached_comments(profile_user_email, section_name=None):
+    """
+    Get the most recent comments for a portfolio / section through memcache.
+
+    @param profile_user_email: The email of the user whose portfolio comments
+                               should be returned.
+    @type profile_user_email: str
+    @keyword section_name: The name of the section to get comments for. If
+                           None, comments for all sections will be returned.
+    @type section_name: str
+    @return: Up to constants.COMMENT_CACHE_SIZE of the most recent comments in
+             reverse chronological order.
+    @rtype: List of models.Comment
+    """
+    cache_key = get_comment_cache_key(profile_user_email, section_name)
+    comments = memcache.get(cache_key)
+    if comments == None:
+        comments = models.Comment.get_for(
+            profile_user_email, section_name).fetch(
+                constants.COMMENT_CACHE_SIZE)
+        memcache.add(cache_key, comments)
+    return comments
+
+
+def add_to_comment_cache(comment, section_name):
+    """
+    Insert a newly saved comment into a cached comment listing.
+
+    Insert a newly saved comment into the cached listing for its portfolio and
+    the given section using compare-and-set so that concurrent writes are not
+    lost. The listing is dropped if it cannot be updated.
+
+    @param comment: The comment to insert.
+    @type comment: models.Comment
+    @param section_name: The name of the section listing to insert the comment
+                         into (comment.section_name) or None for the listing
+                         of all sections.
+    @type section_name: str
+    """
+    cache_key = get_comment_cache_key(comment.profile_email, section_name)
+    client = memcache.Client()
+
+    for i in range(constants.CACHE_CAS_RETRIES):
+        comments = client.gets(cache_key)
+        if comments == None:
+            comments = models.Comment.get_for(
+                comment.profile_email, section_name).fetch(
+                    constants.COMMENT_CACHE_SIZE)
+            if client.add(cache_key, insert_comment(comments, comment)):
+                return
+        elif client.cas(cache_key, insert_comment(comments, comment)):
+            return
+
+    memcache.delete(cache_key)
+
+
+def insert_comment(comments, comment):
+    """
+    Insert a comment into a listing of comments if not already present.
+
+    @param comments: Comments in reverse chronological order.
+    @type comments: List of models.Comment
+    @param comment: The comment to insert.
+    @type comment: models.Comment
+    @return: New listing with the given comment in reverse chronological order
+             and truncated to constants.COMMENT_CACHE_SIZE comments.
+    @rtype: List of models.Comment
+    """
+    comments = filter(lambda x: x.key() != comment.key(), comments)
+    comments.append(comment)
+    comments.sort(key=lambda x: x.timestamp, reverse=True)
+    return comments[:constants.COMMENT_CACHE_SIZE]
+
+
 def get_updated_sections(viewing_user, profile_user_email):
     """
     Get the profile sections containing comments unread by the given user.
@@ -170,7 +781,7 @@ def get_updated_sections(viewing_user, profile_user_email):
 
     @param viewing_user: The user for whom sections with unread comments should
                          be returned.
-    @type viewing_user: google.appengine.api.users.User
+    @type viewing_user: ViewerContext or google.appengine.api.users.User
     @param profile_user_email: The email of the user whose profile's comments
                                should be searched.
     @type profile_user_email: str
@@ -178,101 +789,1226 @@ def get_updated_sections(viewing_user, profile_user_email):
              unread comments for the given user.
     @rtype: Dict mapping str to int
     """
-    listing = {}
-    for section in constants.PORTFOLIO_SECTIONS:
-        new_comments_query = get_new_comments(
-            viewing_user,
-            profile_user_email,
-            section
-        )
-        new_comments = list(new_comments_query)
-        num_new_comments = len(new_comments)
-        if num_new_comments > 0:
-            listing[section] = num_new_comments
-    return listing
+    return get_updated_sections_async(
+        viewing_user, profile_user_email).get_result()
+
+
+def get_updated_sections_async(viewing_user, profile_user_email):
+    """
+    Start getting the profile sections containing comments unread by a user.
+
+    @param viewing_user: The user for whom sections with unread comments should
+                         be returned.
+    @type viewing_user: ViewerContext or google.appengine.api.users.User
+    @param profile_user_email: The email of the user whose profile's comments
+                               should be searched.
+    @type profile_user_email: str
+    @return: Lazy result of get_updated_sections.
+    @rtype: util.LazyResult
+    """
+    unread_counts = get_unread_counts_async(viewing_user, [profile_user_email])
+    return util.LazyResult(lambda: unread_counts[profile_user_email])
+
+
+def get_unread_dashboard(viewing_user, profile_emails, viewing_profiles=None):
+    """
+    Count the comments unread by a user on every section of many portfolios.
+
+    Count unread comments in a single pass: load all of the user's viewing
+    profiles in one query, load the portfolio / section / time of comments
+    posted since the oldest of those visits in another and join them in
+    memory. Sections the user never visited are counted by their unread
+    counters, loaded in one batch. Never visited sections without a counter
+    are counted in the same pass but only from comments posted in the last
+    constants.UNREAD_SCAN_DAYS days so that no query scans every comment, and
+    a task is enqueued to build their counters.
+
+    @param viewing_user: The user for whom unread comments should be counted.
+    @type viewing_user: ViewerContext or google.appengine.api.users.User
+    @param profile_emails: The emails of the users whose portfolios should be
+                           examined.
+    @type profile_emails: Iterable over str
+    @keyword viewing_profiles: All of the viewing profiles of the given user
+                               if already being loaded or None to load them.
+    @type viewing_profiles: Iterable over models.ViewingProfile
+    @return: Mapping from profile email to the number of unread comments in
+             each section containing > 0 unread comments for the given user.
+    @rtype: Dict mapping str to (dict mapping str to int)
+    """
+    dashboard = dict(map(lambda x: (x, {}), profile_emails))
+    sections = get_portfolio_section_names()
+
+    if viewing_profiles == None:
+        viewing_profiles = models.ViewingProfile.get_all_for(
+            viewing_user.email())
+
+    last_visits = {}
+    for viewing_profile in viewing_profiles:
+        if viewing_profile.profile_email in dashboard and \
+            viewing_profile.section_name in sections and \
+            viewing_profile.last_visited:
+            last_visits[(viewing_profile.profile_email,
+                viewing_profile.section_name)] = viewing_profile.last_visited
+
+    # Views not yet saved to the datastore take precedence
+    buffered_views = get_buffered_views(viewing_user.email())
+    for (profile_email, section), last_visited in buffered_views.items():
+        if profile_email in dashboard and section in sections and \
+            models.is_later(last_visited, last_visits.get(
+                (profile_email, section))):
+            last_visits[(profile_email, section)] = last_visited
+
+    # Count sections never visited by their counters, loaded in one batch
+    unvisited_pairs = [
+        (profile_email, section)
+        for profile_email in dashboard
+        for section in sections
+        if not (profile_email, section) in last_visits
+    ]
+    unvisited_counters = models.UnreadCounter.get_for(
+        viewing_user.email(), unvisited_pairs, single_rpc=True)
+
+    # Count the rest from recent comments with the visited sections
+    scan_start = datetime.datetime.now() - datetime.timedelta(
+        days=constants.UNREAD_SCAN_DAYS)
+    scan_visits = dict(last_visits)
+    for pair, counter in zip(unvisited_pairs, unvisited_counters):
+        if counter:
+            if counter.count > 0:
+                dashboard[pair[0]][pair[1]] = counter.count
+        else:
+            scan_visits[pair] = scan_start
+
+    uncounted_profiles = set(map(
+        lambda (profile_email, section): profile_email,
+        filter(lambda pair: not pair in last_visits, scan_visits)
+    ))
+    if uncounted_profiles:
+        enqueue_counter_building(viewing_user.email(), uncounted_profiles)
+
+    if scan_visits:
+        headers = models.Comment.get_headers_past_date(
+            min(scan_visits.values()))
+        for comment in headers.run(
+            prefetch_size=constants.UNREAD_SCAN_BATCH_SIZE,
+            batch_size=constants.UNREAD_SCAN_BATCH_SIZE):
+            last_visited = scan_visits.get(
+                (comment.profile_email, comment.section_name))
+            if last_visited and models.is_later(comment.timestamp,
+                last_visited):
+                section_statuses = dashboard[comment.profile_email]
+                section_statuses[comment.section_name] = \
+                    section_statuses.get(comment.section_name, 0) + 1
+
+    return dashboard
 
 
 def get_updated_portfolios(viewing_user):
-    user_info_records = list(models.UserInfo.all())
-    portfolio_statuses = map(
-        lambda x: get_updated_sections(viewing_user, x.email),
-        user_info_records
-    )
-    portfolio_statuses_zip = zip(
-        user_info_records,
-        portfolio_statuses
-    )
-    updated_portfolio_statuses = filter(
-        lambda (user_info, status): len(status.keys()) > 0,
-        portfolio_statuses_zip
-    )
-    return map(
-        lambda (user_info, status): user_info,
-        updated_portfolio_statuses
-    )
+    """
+    Get the portfolios containing comments unread by the given user.
+
+    @param viewing_user: The user for whom portfolios with unread comments
+                         should be returned.
+    @type viewing_user: ViewerContext or google.appengine.api.users.User
+    @return: Roster entries and unread comment counts for the owners of
+             portfolios with at least one unread comment.
+    @rtype: List of PortfolioStatus
+    """
+    return get_updated_portfolios_async(viewing_user).get_result()
 
 
-def set_viewed(viewing_user, profile_user_email, section_name):
+def get_updated_portfolios_async(viewing_user):
     """
-    Indicate that a user just viewed a given section on a given profile.
+    Start getting the portfolios containing comments unread by a user.
 
-    @param viewing_user: The user that viewed the given section on the given
-                         profile.
-    @type viewing_user: google.appengine.api.users.User
-    @param profile_user_email: The email address of the user whose profile was
-                               just viewed.
-    @param section_name: The name of the section this user just viewed.
+    Asynchronous version of get_updated_portfolios that starts loading the
+    given user's viewing profiles right away but only waits for them when the
+    result is used.
+
+    @param viewing_user: The user for whom portfolios with unread comments
+                         should be returned.
+    @type viewing_user: ViewerContext or google.appengine.api.users.User
+    @return: Lazy result of get_updated_portfolios.
+    @rtype: util.LazyResult
+    """
+    roster = get_roster()
+    viewing_profiles_iter = models.ViewingProfile.get_all_for(
+        viewing_user.email()).run()
+
+    def get_result():
+        dashboard = get_unread_dashboard(
+            viewing_user,
+            map(lambda x: x.email, roster),
+            viewing_profiles_iter
+        )
+        portfolio_statuses = map(
+            lambda x: PortfolioStatus(
+                x,
+                dashboard[x.email],
+                sum(dashboard[x.email].values())
+            ),
+            roster
+        )
+        return filter(lambda x: x.num_comments > 0, portfolio_statuses)
+
+    return util.LazyResult(get_result)
+
+
+def add_comment(author, profile_user_email, section_name, contents):
+    """
+    Save a new private comment and update unread counters for other users.
+
+    Save a new private comment and increment the unread counters of other
+    users in the same transaction, which also enqueues a task to send
+    notifications for it (see process_new_comment). Cached comment listings
+    and the portfolio's unread version are updated once the transaction
+    commits.
+
+    @param author: The user that wrote the comment.
+    @type author: ViewerContext or google.appengine.api.users.User
+    @param profile_user_email: The email address of the user whose portfolio
+                               the comment was left on.
+    @type profile_user_email: str
+    @param section_name: The name of the portfolio section commented on.
     @type section_name: str
+    @param contents: The already escaped HTML contents of the comment.
+    @type contents: str
+    @return: The newly saved comment.
+    @rtype: models.Comment
     """
-    viewing_profile = models.ViewingProfile.get_for(
-        viewing_user, profile_user_email, section_name)
-    viewing_profile.last_visited = datetime.datetime.now()
-    viewing_profile.put()
+    new_comment = models.Comment(
+        parent=models.get_portfolio_key(profile_user_email))
+    new_comment.author_email = author.email()
+    new_comment.profile_email = profile_user_email
+    new_comment.section_name = section_name
+    new_comment.contents = contents
+    new_comment.timestamp = datetime.datetime.now()
+    new_comment.rendered_html = util.render_comment_html(
+        new_comment.author_email, new_comment.timestamp, contents)
 
+    db.run_in_transaction(save_comment, new_comment)
 
-def get_account_listing():
+    # Update cached listings right away so the author's next page shows the
+    # comment (the comment's task repeats this in case this request fails)
+    add_to_comment_cache(new_comment, section_name)
+    add_to_comment_cache(new_comment, None)
+    memcache.incr(get_profile_unread_version_key(profile_user_email))
+    mark_portfolio_modified(profile_user_email, new_comment.timestamp)
+
+    return new_comment
+
+
+def save_comment(comment):
     """
-    Get a list of all of the users registered with the application.
+    Save a new comment, count it as unread, and enqueue its processing.
 
-    @return: Iterable over user information sorted first by last name and then
-             first name.
-    @rtype: Iterable over models.UserInfo
+    Save a new comment, count it as unread for other users that have read its
+    section, and enqueue the task that processes it. Must be run in a
+    transaction on the entity group of the comment's portfolio.
+
+    @param comment: The comment to save.
+    @type comment: models.Comment
     """
-    query = models.UserInfo.all()
-    query.order("last_name")
-    query.order("first_name")
-    return query
+    comment.put()
 
+    counters = models.UnreadCounter.get_for_section(
+        comment.profile_email, comment.section_name)
+    updated_counters = []
+    for counter in counters:
+        if counter.viewer_email == comment.author_email:
+            continue
+        if counter.add_comment(comment.key()):
+            updated_counters.append(counter)
+    db.put(updated_counters)
 
-def set_flash_message(target_user_email, msg_type, msg):
+    enqueue_comment_processing(comment.key())
+
+
+def enqueue_comment_processing(comment_key):
     """
-    Register a flash message for a user to be displayed on their next page load.
+    Enqueue the task that processes a newly saved comment.
 
-    @param target_user_email: The email address of the user to leave a message
-                              for.
-    @type target_user_email: str
-    @param msg_type: Constant indicating the type of message that is being left
-                     for the given user.
-    @type msg_type: str
-    @param msg: The message to leave (cannot contain underscores).
-    @type msg: str
+    Enqueue the task that processes a newly saved comment as part of the
+    current transaction so that it runs if and only if the comment is saved.
+
+    @param comment_key: The key of the comment to process.
+    @type comment_key: db.Key
     """
-    memcache.set("%s_msg" % target_user_email, "%s_%s" % (msg_type, msg))
+    taskqueue.add(
+        url=constants.PROCESS_COMMENT_URL,
+        params={"comment_key": str(comment_key)},
+        transactional=True
+    )
 
 
-def get_flash_message(target_user_email):
+def process_new_comment(comment_key):
     """
-    Get any waiting flash messages for a user and delete them.
+    Update caches and notifications for a new comment.
 
-    @param target_user_email: The user to get the messages for.
-    @type target_user_email: str
-    @return: The waiting message or None if no messages waiting.
-    @rtype: FlashMessage
+    Update everything derived from a newly saved comment outside of its
+    entity group: the unread version of the portfolio and its latest comment
+    marker, and notifying users viewing the portfolio. The cached comment
+    listings are updated again in case the request saving the comment failed
+    before updating them (see add_comment). Each step tolerates being run
+    more than once so that the task calling this can be retried
+    (notifications are deduplicated by clients).
+
+    @param comment_key: The key of the comment to process.
+    @type comment_key: db.Key or str
+    @return: True if the comment was found and processed and False otherwise.
+    @rtype: bool
     """
-    memcache_key = "%s_msg" % target_user_email
-    memcache_val = memcache.get(memcache_key)
-    if memcache_val:
-        memcache.delete(memcache_key)
-        return FlashMessage(*memcache_val.split("_"))
-    else:
-        return None
+    comment = models.Comment.get(comment_key)
+    if not comment:
+        return False
+
+    add_to_comment_cache(comment, comment.section_name)
+    add_to_comment_cache(comment, None)
+
+    memcache.incr(get_profile_unread_version_key(comment.profile_email))
+    mark_portfolio_modified(comment.profile_email, comment.timestamp)
+    notifications.publish_comment(comment)
+
+    return True
+
+
+def set_viewed(viewing_user, profile_user_email, section_name):
+    """
+    Indicate that a user just viewed a given section on a given profile.
+
+    Indicate that a user just viewed a given section on a given profile. The
+    view is buffered in memcache and saved to the datastore with other views
+    by flush_views (see buffer_view).
+
+    @param viewing_user: The user that viewed the given section on the given
+                         profile.
+    @type viewing_user: ViewerContext or google.appengine.api.users.User
+    @param profile_user_email: The email address of the user whose profile was
+                               just viewed.
+    @param section_name: The name of the section this user just viewed.
+    @type section_name: str
+    """
+    buffer_view(viewing_user.email(), profile_user_email, section_name,
+        datetime.datetime.now())
+
+    if section_name == None:
+        return
+
+    # Only reset the unread counter (and its version) if it changes, skipping
+    # the transaction when the counter was already reset
+    counter = models.UnreadCounter.get_for(
+        viewing_user.email(), [(profile_user_email, section_name)])[0]
+    if counter and counter.count == 0:
+        return
+
+    if db.run_in_transaction(reset_unread_counter, viewing_user.email(),
+        profile_user_email, section_name):
+        memcache.incr(get_viewer_unread_version_key(
+            viewing_user.email(), profile_user_email))
+        memcache.incr(get_reads_version_key(viewing_user.email()))
+
+
+def reset_unread_counter(viewer_email, profile_user_email, section_name):
+    """
+    Mark all comments in a portfolio section as read by a user.
+
+    Reset the unread counter of a user on a portfolio section if it changes,
+    keeping its record of counted comments. Must be run in a transaction on
+    the entity group of the portfolio so that concurrently posted comments are
+    not lost.
+
+    @param viewer_email: The email of the user that read the section.
+    @type viewer_email: str
+    @param profile_user_email: The email address of the user whose portfolio
+                               was read.
+    @type profile_user_email: str
+    @param section_name: The name of the section read.
+    @type section_name: str
+    @return: True if the counter changed and False otherwise.
+    @rtype: bool
+    """
+    counter = models.UnreadCounter.get_for(
+        viewer_email, [(profile_user_email, section_name)])[0]
+    if not counter:
+        counter = models.UnreadCounter.create(
+            viewer_email, profile_user_email, section_name, 0)
+    elif counter.count != 0:
+        counter.count = 0
+    else:
+        return False
+
+    counter.put()
+    return True
+
+
+def get_buffered_views_key(viewer_email):
+    """
+    Get the memcache key of the views by a user not yet saved to the datastore.
+
+    @param viewer_email: The email of the user whose views are buffered.
+    @type viewer_email: str
+    @return: The memcache key holding the buffered views of the given user.
+    @rtype: str
+    """
+    return "views_%s" % viewer_email
+
+
+def get_views_pending_key(viewer_email):
+    """
+    Get the memcache key marking that a user's buffered views will be saved.
+
+    @param viewer_email: The email of the user whose views are buffered.
+    @type viewer_email: str
+    @return: The memcache key that is set while a flush of the given user's
+             buffered views is pending.
+    @rtype: str
+    """
+    return "views_pending_%s" % viewer_email
+
+
+def get_buffered_views(viewer_email):
+    """
+    Get the recent views by a user that may not be saved to the datastore yet.
+
+    @param viewer_email: The email of the user whose views should be returned.
+    @type viewer_email: str
+    @return: Mapping from (profile email, section name) pairs to the time the
+             given user last viewed them.
+    @rtype: dict mapping tuple to datetime.datetime
+    """
+    return memcache.get(get_buffered_views_key(viewer_email)) or {}
+
+
+def buffer_view(viewer_email, profile_user_email, section_name, timestamp):
+    """
+    Record a view of a portfolio section to be saved to the datastore later.
+
+    Record a view in the memcache buffer of the viewing user so that it is
+    visible to unread calculations right away and schedule a flush of the
+    user's buffered views if one is not already pending. Repeated views before
+    that flush only replace the buffered timestamp. If the buffer cannot be
+    updated, the view is saved to the datastore right away instead.
+
+    @param viewer_email: The email of the user that viewed the section.
+    @type viewer_email: str
+    @param profile_user_email: The email address of the user whose portfolio
+                               was viewed.
+    @type profile_user_email: str
+    @param section_name: The name of the section viewed or None for the
+                         portfolio overview.
+    @type section_name: str
+    @param timestamp: The time of the view.
+    @type timestamp: datetime.datetime
+    """
+    cache_key = get_buffered_views_key(viewer_email)
+    client = memcache.Client()
+    min_timestamp = timestamp - datetime.timedelta(
+        seconds=constants.VIEW_BUFFER_TIME)
+
+    for i in range(constants.CACHE_CAS_RETRIES):
+        views = client.gets(cache_key)
+        if views == None:
+            views = {(profile_user_email, section_name): timestamp}
+            if client.add(cache_key, views, constants.VIEW_BUFFER_TIME):
+                break
+        else:
+            # Views this old were saved by earlier flushes
+            views = dict(filter(
+                lambda (pair, view_timestamp): view_timestamp > min_timestamp,
+                views.items()
+            ))
+            views[(profile_user_email, section_name)] = timestamp
+            if client.cas(cache_key, views, constants.VIEW_BUFFER_TIME):
+                break
+    else:
+        models.ViewingProfile.create(
+            viewer_email, profile_user_email, section_name, timestamp).put()
+        return
+
+    if memcache.add(get_views_pending_key(viewer_email), True,
+        constants.VIEW_WRITE_WINDOW):
+        taskqueue.Queue(constants.VIEWS_QUEUE_NAME).add(
+            taskqueue.Task(payload=viewer_email, method="PULL"))
+
+
+def flush_views():
+    """
+    Save buffered views for users with a pending flush to the datastore.
+
+    Save the views buffered by buffer_view in batches, one batch per lease of
+    pending flushes from the views pull queue. Pending markers are cleared
+    before the buffers are read so that views arriving during a flush
+    schedule another one.
+
+    @return: The number of viewing profiles saved.
+    @rtype: int
+    """
+    queue = taskqueue.Queue(constants.VIEWS_QUEUE_NAME)
+    num_saved = 0
+
+    while True:
+        tasks = queue.lease_tasks(constants.VIEW_FLUSH_LEASE_TIME,
+            constants.VIEW_FLUSH_BATCH_SIZE)
+        if not tasks:
+            return num_saved
+
+        viewer_emails = list(set(map(lambda x: x.payload, tasks)))
+        memcache.delete_multi(map(get_views_pending_key, viewer_emails))
+        buffered_views = memcache.get_multi(
+            map(get_buffered_views_key, viewer_emails))
+
+        records = []
+        for viewer_email in viewer_emails:
+            views = buffered_views.get(get_buffered_views_key(viewer_email))
+            for (profile_email, section), last_visited in (views or {}).items():
+                records.append(models.ViewingProfile.create(
+                    viewer_email, profile_email, section, last_visited))
+        db.put(records)
+        queue.delete_tasks(tasks)
+        num_saved += len(records)
+
+
+def get_last_visits(viewer_email, profile_section_pairs):
+    """
+    Get the last time a user viewed each of many portfolio sections.
+
+    @param viewer_email: The email of the user whose views should be returned.
+    @type viewer_email: str
+    @param profile_section_pairs: The (profile email, section name) pairs to
+                                  get the last views of.
+    @type profile_section_pairs: Iterable over tuple
+    @return: Times of the last views in the same order as the given pairs with
+             None in place of sections the user never viewed.
+    @rtype: List of datetime.datetime
+    """
+    return get_last_visits_async(
+        viewer_email, profile_section_pairs).get_result()
+
+
+def get_last_visits_async(viewer_email, profile_section_pairs):
+    """
+    Start getting the last time a user viewed each of many portfolio sections.
+
+    Asynchronous version of get_last_visits that starts reading the viewing
+    profiles right away and combines them with buffered views not yet saved
+    when the result is used.
+
+    @param viewer_email: The email of the user whose views should be returned.
+    @type viewer_email: str
+    @param profile_section_pairs: The (profile email, section name) pairs to
+                                  get the last views of.
+    @type profile_section_pairs: Iterable over tuple
+    @return: Lazy result of get_last_visits.
+    @rtype: util.LazyResult
+    """
+    profile_section_pairs = list(profile_section_pairs)
+    viewing_profiles_rpc = models.ViewingProfile.get_many_async(
+        viewer_email, profile_section_pairs)
+
+    def get_result():
+        buffered_views = get_buffered_views(viewer_email)
+        last_visits = []
+        for pair, viewing_profile in zip(profile_section_pairs,
+            viewing_profiles_rpc.get_result()):
+            last_visited = viewing_profile and viewing_profile.last_visited
+            buffered_visit = buffered_views.get(pair)
+            if models.is_later(buffered_visit, last_visited):
+                last_visited = buffered_visit
+            last_visits.append(last_visited)
+        return last_visits
+
+    return util.LazyResult(get_result)
+
+
+def get_profile_unread_version_key(profile_user_email):
+    """
+    Get the memcache key of the version of all unread counters on a profile.
+
+    @param profile_user_email: The email address of the user whose profile
+                               the version is for.
+    @type profile_user_email: str
+    @return: Memcache key for the version.
+    @rtype: str
+    """
+    return "unread_version_%s" % profile_user_email
+
+
+def get_viewer_unread_version_key(viewer_email, profile_user_email):
+    """
+    Get the memcache key of the version of a user's counters on a profile.
+
+    @param viewer_email: The email address of the user whose counters the
+                         version is for.
+    @type viewer_email: str
+    @param profile_user_email: The email address of the user whose profile
+                               the version is for.
+    @type profile_user_email: str
+    @return: Memcache key for the version.
+    @rtype: str
+    """
+    return "unread_version_%s|%s" % (viewer_email, profile_user_email)
+
+
+def get_unread_version(viewing_user, profile_user_email):
+    """
+    Get a value that changes whenever a user's unread counters on a profile do.
+
+    @param viewing_user: The user whose unread counters are versioned.
+    @type viewing_user: ViewerContext or google.appengine.api.users.User
+    @param profile_user_email: The email address of the user whose profile
+                               the counters are for.
+    @type profile_user_email: str
+    @return: The current version.
+    @rtype: str
+    """
+    version_keys = [
+        get_profile_unread_version_key(profile_user_email),
+        get_viewer_unread_version_key(viewing_user.email(), profile_user_email)
+    ]
+    return "%d.%d" % tuple(get_versions(version_keys))
+
+
+def get_versions(version_keys):
+    """
+    Get the current values of many version counters kept in memcache.
+
+    @param version_keys: The memcache keys of the versions to get.
+    @type version_keys: List of str
+    @return: The versions in the same order as the given keys.
+    @rtype: List of int
+    """
+    versions = memcache.get_multi(version_keys)
+
+    # Start from the time so versions are not reused after eviction
+    missing_versions = dict(map(
+        lambda x: (x, int(time.time())),
+        filter(lambda x: not x in versions, version_keys)
+    ))
+    if missing_versions:
+        memcache.add_multi(missing_versions)
+        versions.update(missing_versions)
+
+    return map(lambda x: versions[x], version_keys)
+
+
+def get_latest_comment_key(profile_user_email):
+    """
+    Get the memcache key of the time of the latest comment on a portfolio.
+
+    @param profile_user_email: The email address of the user whose portfolio
+                               the time is for.
+    @type profile_user_email: str
+    @return: Memcache key for the time (see get_latest_comment_time).
+    @rtype: str
+    """
+    return "latest_comment_%s" % profile_user_email
+
+
+def get_reads_version_key(viewer_email):
+    """
+    Get the memcache key of the version of everything a user has read.
+
+    @param viewer_email: The email address of the user the version is for.
+    @type viewer_email: str
+    @return: Memcache key for the version.
+    @rtype: str
+    """
+    return "reads_version_%s" % viewer_email
+
+
+def get_latest_comment_time(profile_user_email):
+    """
+    Get the time of the most recent comment on a portfolio.
+
+    Get the time of the most recent comment on a portfolio from the marker
+    kept in memcache by mark_portfolio_modified, querying for the latest
+    comment only if the marker was evicted.
+
+    @param profile_user_email: The email address of the user whose portfolio
+                               should be checked.
+    @type profile_user_email: str
+    @return: The time of the latest comment or None if there are no comments.
+    @rtype: datetime.datetime
+    """
+    cache_key = get_latest_comment_key(profile_user_email)
+    token = memcache.get(cache_key)
+    if token == None:
+        comment = models.Comment.get_for(profile_user_email).get()
+        token = comment and util.timestamp_to_token(comment.timestamp) or ""
+        memcache.add(cache_key, token)
+    return util.token_to_timestamp(token)
+
+
+def mark_portfolio_modified(profile_user_email, timestamp):
+    """
+    Record that a comment was posted on a portfolio.
+
+    Advance the marker of the latest comment on a portfolio (never moving it
+    back) and change the version of all comments so that ETags computed by
+    get_portfolio_etag change. Safe to call more than once for a comment.
+
+    @param profile_user_email: The email address of the user whose portfolio
+                               was commented on.
+    @type profile_user_email: str
+    @param timestamp: The time the comment was posted.
+    @type timestamp: datetime.datetime
+    """
+    cache_key = get_latest_comment_key(profile_user_email)
+    token = util.timestamp_to_token(timestamp)
+    client = memcache.Client()
+    for i in range(constants.CACHE_CAS_RETRIES):
+        cached_token = client.gets(cache_key)
+        if cached_token == None:
+            if client.add(cache_key, token):
+                break
+        elif cached_token and int(cached_token) >= int(token):
+            break
+        elif client.cas(cache_key, token):
+            break
+    else:
+        # Fall back to querying for the latest comment when next needed
+        memcache.delete(cache_key)
+
+    memcache.incr("comments_version", initial_value=int(time.time()))
+
+
+def get_portfolio_etag(viewer, profile_user_email, section_name):
+    """
+    Compute an ETag for a portfolio page without rendering it.
+
+    Compute an ETag from everything a portfolio page depends on: the latest
+    comment on the portfolio, when the viewer last visited the page, and the
+    versions of the viewer's unread counters and of the portfolio sections.
+    The last visit is only included while comments posted after it remain,
+    so that repeat visits to a page without new comments share an ETag.
+    Reviewers also see the roster and unread comments on every portfolio so
+    the roster version, the version of all comments and the version of
+    everything the reviewer has read are included for them.
+
+    @param viewer: The user viewing the page.
+    @type viewer: ViewerContext
+    @param profile_user_email: The email address of the user whose portfolio
+                               is being viewed.
+    @type profile_user_email: str
+    @param section_name: The name of the section being viewed or None for the
+                         portfolio overview.
+    @type section_name: str
+    @return: The ETag of the page as the viewer would currently see it.
+    @rtype: str
+    """
+    viewer_email = viewer.email()
+    last_visits = get_last_visits_async(
+        viewer_email, [(profile_user_email, section_name)])
+    latest_comment = get_latest_comment_time(profile_user_email)
+
+    version_keys = [
+        get_profile_unread_version_key(profile_user_email),
+        get_viewer_unread_version_key(viewer_email, profile_user_email),
+        "sections_version"
+    ]
+    if viewer.is_reviewer:
+        version_keys.extend([
+            "roster_version",
+            "comments_version",
+            get_reads_version_key(viewer_email)
+        ])
+    versions = get_versions(version_keys)
+
+    last_visited = last_visits[0]
+    if last_visited and not models.is_later(latest_comment, last_visited):
+        visit_token = "read"
+    elif last_visited:
+        visit_token = util.timestamp_to_token(last_visited)
+    else:
+        visit_token = "never"
+
+    etag_parts = [
+        os.environ.get("CURRENT_VERSION_ID", ""),
+        viewer_email,
+        str(viewer.is_reviewer),
+        str(viewer.is_admin),
+        profile_user_email,
+        section_name or "",
+        latest_comment and util.timestamp_to_token(latest_comment) or "",
+        visit_token
+    ] + map(str, versions)
+    return hashlib.md5("|".join(etag_parts)).hexdigest()
+
+
+def get_unread_token(viewer_email):
+    """
+    Get a value that changes whenever a user's unread counts might.
+
+    Get a token combining the version of all comments, the roster version, the
+    version of the portfolio sections and the version of everything the user
+    has read, loaded with a single memcache request.
+
+    @param viewer_email: The email address of the user whose unread counts
+                         the token is for.
+    @type viewer_email: str
+    @return: The current token.
+    @rtype: str
+    """
+    versions = get_versions([
+        "comments_version",
+        "roster_version",
+        "sections_version",
+        get_reads_version_key(viewer_email)
+    ])
+    return ".".join(map(str, versions))
+
+
+def get_unread_update(viewing_user, since=None):
+    """
+    Get a user's unread counts on every portfolio they can see if changed.
+
+    Get a user's unread counts (see get_unread_counts) on every portfolio in
+    the roster for reviewers or on their own portfolio (if it exists) for
+    other users. If the token returned by a previous call is given and nothing
+    changed since, only the token is looked up.
+
+    @param viewing_user: The user for whom unread comments should be counted.
+    @type viewing_user: ViewerContext or google.appengine.api.users.User
+    @keyword since: The token returned by the previous call or None to always
+                    count unread comments.
+    @type since: str
+    @return: The current token and the unread counts or None in place of the
+             counts if they are unchanged since the given token.
+    @rtype: UnreadUpdate
+    """
+    token = get_unread_token(viewing_user.email())
+    if since == token:
+        return UnreadUpdate(token, None)
+
+    viewer = get_viewer_context(viewing_user)
+    if viewer.is_reviewer:
+        profile_emails = map(lambda x: x.email, get_roster())
+    else:
+        profile_emails = filter(lambda x: viewer_has_access(viewer, x),
+            [viewer.email()])
+    return UnreadUpdate(token, get_unread_counts(viewer, profile_emails))
+
+
+def get_account_listing():
+    """
+    Get a list of all of the users registered with the application.
+
+    @return: Iterable over user information sorted first by last name and then
+             first name.
+    @rtype: Iterable over models.UserInfo
+    """
+    query = models.UserInfo.all()
+    query.order("last_name")
+    query.order("first_name")
+    return query
+
+
+def migrate_key_names_batch(step=None, cursor=None):
+    """
+    Move a batch of records saved before records were keyed to their keys.
+
+    Move a batch of records saved before records were keyed to their
+    deterministic keys. The migration moves user information, then viewing
+    profiles and finally clears unread counters so that they are rebuilt from
+    the migrated viewing profiles. Once every batch is done, the migration is
+    recorded as complete so that lookups stop checking for legacy records.
+
+    @keyword step: The step returned by the previous batch or None to start
+                   the migration.
+    @type step: str
+    @keyword cursor: The cursor returned by the previous batch or None to start
+                     the step.
+    @type cursor: str
+    @return: The number of records migrated and the step and cursor of the
+             next batch (step is None if the migration finished).
+    @rtype: Tuple of int, str and str
+    """
+    step = step or KEY_NAME_MIGRATION_STEPS[0]
+    num_migrated, next_cursor = KEY_NAME_MIGRATIONS[step](cursor)
+    if next_cursor:
+        return (num_migrated, step, next_cursor)
+
+    step_index = KEY_NAME_MIGRATION_STEPS.index(step) + 1
+    if step_index < len(KEY_NAME_MIGRATION_STEPS):
+        return (num_migrated, KEY_NAME_MIGRATION_STEPS[step_index], None)
+
+    models.MigrationStatus.set_complete(constants.KEY_NAMES_MIGRATION)
+    return (num_migrated, None, None)
+
+
+def delete_unread_counters_batch(cursor=None):
+    """
+    Delete a batch of unread counters so that they are rebuilt when requested.
+
+    @keyword cursor: The cursor returned by the previous batch or None to start
+                     with the first batch.
+    @type cursor: str
+    @return: The number of counters deleted (not counted as migrated records so
+             always 0) and the cursor of the next batch or None if this was
+             the last batch.
+    @rtype: Tuple of int and str
+    """
+    counter_keys, next_cursor = models.fetch_batch(
+        models.UnreadCounter.all(keys_only=True), cursor)
+    db.delete(counter_keys)
+    return (0, next_cursor)
+
+
+# Steps of the key name migration in order with the function migrating a batch
+KEY_NAME_MIGRATION_STEPS = ["user_infos", "viewing_profiles", "unread_counters"]
+KEY_NAME_MIGRATIONS = {
+    "user_infos": models.UserInfo.migrate_key_names,
+    "viewing_profiles": models.ViewingProfile.migrate_key_names,
+    "unread_counters": delete_unread_counters_batch
+}
+
+
+def enqueue_key_name_migration(step=None, cursor=None):
+    """
+    Enqueue the task that migrates the next batch of records to key names.
+
+    @keyword step: The step returned by the previous batch or None to start
+                   the migration.
+    @type step: str
+    @keyword cursor: The cursor returned by the previous batch or None to start
+                     the step.
+    @type cursor: str
+    """
+    taskqueue.add(
+        url=constants.MIGRATE_KEY_NAMES_URL,
+        params={"step": step or "", "cursor": cursor or ""}
+    )
+
+
+def migrate_key_names():
+    """
+    Move every record saved before records were keyed to their keys.
+
+    Move every record saved before records were keyed to their deterministic
+    keys in this request. Large datastores should use
+    enqueue_key_name_migration instead, which migrates one batch per task.
+
+    @return: The number of records migrated.
+    @rtype: int
+    """
+    num_migrated, step, cursor = migrate_key_names_batch()
+    while step:
+        num_batch_migrated, step, cursor = migrate_key_names_batch(
+            step, cursor)
+        num_migrated += num_batch_migrated
+    return num_migrated
+
+
+def migrate_entity_groups():
+    """
+    Move comments and unread counters saved without a parent to their groups.
+
+    Move comments saved without a parent into the entity group of their
+    portfolio, clearing cached listings holding their old keys, and delete
+    unread counters saved without a parent so that they are rebuilt.
+
+    @return: The number of comments moved.
+    @rtype: int
+    """
+    moved_comments = models.Comment.migrate_entity_groups()
+
+    legacy_counter_keys = filter(
+        lambda x: x.parent() == None,
+        models.UnreadCounter.all(keys_only=True)
+    )
+    db.delete(legacy_counter_keys)
+
+    profile_emails = set(map(lambda x: x.profile_email, moved_comments))
+    memcache.delete_multi([
+        get_comment_cache_key(profile_email, section_name)
+        for profile_email in profile_emails
+        for section_name in get_portfolio_section_names() + [None]
+    ])
+    return len(moved_comments)
+
+
+def get_roster():
+    """
+    Get the names and emails of all users registered with the application.
+
+    Get a compact listing of all users built by a single projection query and
+    cached in memcache until a user is added or a user's role changes.
+
+    @return: Roster entries sorted first by last name and then first name.
+    @rtype: List of RosterEntry
+    """
+    roster = memcache.get("roster")
+    if roster == None:
+        roster = map(
+            lambda x: RosterEntry(
+                x.email, x.safe_email, x.first_name, x.last_name),
+            models.UserInfo.get_roster()
+        )
+        memcache.add("roster", roster, constants.ROSTER_CACHE_TIME)
+    return roster
+
+
+def get_roster_version():
+    """
+    Get a value that changes whenever the roster changes.
+
+    @return: The current roster version.
+    @rtype: int
+    """
+    version = memcache.get("roster_version")
+    if version == None:
+        # Start from the time so versions are not reused after eviction
+        version = int(time.time())
+        memcache.add("roster_version", version)
+    return version
+
+
+def invalidate_roster():
+    """Drop the cached roster and change the roster version."""
+    memcache.delete("roster")
+    memcache.incr("roster_version")
+
+
+def get_portfolio_sections():
+    """
+    Get the sections of student portfolios in display order.
+
+    Get the sections of student portfolios from a cache kept by each instance,
+    reloading them from the datastore when the sections version changes. The
+    version is checked at most once every SECTION_CACHE_CHECK_INTERVAL seconds
+    (see constants). If no sections are saved, the default sections are used
+    (see get_portfolio_section_records).
+
+    @return: Name and title of every portfolio section.
+    @rtype: List of SectionInfo
+    """
+    global section_cache
+    cached = section_cache
+    now = time.time()
+    if cached and now - cached.checked < constants.SECTION_CACHE_CHECK_INTERVAL:
+        return cached.sections
+
+    version = get_sections_version()
+    if cached and cached.version == version:
+        sections = cached.sections
+    else:
+        sections = map(
+            lambda x: SectionInfo(x.get_name(), x.title or x.get_name()),
+            get_portfolio_section_records()
+        )
+
+    section_cache = SectionCache(version, now, sections)
+    return sections
+
+
+def get_portfolio_section_records():
+    """
+    Load the saved portfolio sections without writing to the datastore.
+
+    @return: Every portfolio section record in display order or unsaved
+             records for the default sections if none are saved.
+    @rtype: List of models.PortfolioSection
+    """
+    records = list(models.PortfolioSection.get_all())
+    if not records:
+        records = map(
+            lambda (position, name): models.PortfolioSection.create(
+                name, name.capitalize(), position),
+            enumerate(constants.DEFAULT_PORTFOLIO_SECTIONS)
+        )
+    return records
+
+
+def seed_portfolio_sections():
+    """
+    Save the default portfolio sections if no sections are saved.
+
+    Save the default portfolio sections if no sections are saved so that
+    administrators edit them along with new sections. Run by warmup requests
+    and before sections are edited so that page requests never write them.
+
+    @return: True if the default sections were saved and False otherwise.
+    @rtype: bool
+    """
+    records = get_portfolio_section_records()
+    if records[0].is_saved():
+        return False
+    db.put(records)
+    return True
+
+
+def get_portfolio_section_names():
+    """
+    Get the names of the sections of student portfolios in display order.
+
+    @return: The name of every portfolio section as it appears in URLs.
+    @rtype: List of str
+    """
+    return map(lambda x: x.name, get_portfolio_sections())
+
+
+def is_portfolio_section(section_name):
+    """
+    Determine if a section name refers to an existing portfolio section.
+
+    Determine if a section name refers to an existing portfolio section using
+    only the cached sections so that requests for unknown sections can be
+    rejected before any query runs.
+
+    @param section_name: The name of the section to check.
+    @type section_name: str
+    @return: True if the section exists and False otherwise.
+    @rtype: bool
+    """
+    return section_name in get_portfolio_section_names()
+
+
+def save_portfolio_section(section_name, title, position):
+    """
+    Create or update a portfolio section.
+
+    @param section_name: The name of the section as it appears in URLs.
+    @type section_name: str
+    @param title: The name of the section as displayed to users.
+    @type title: str
+    @param position: The order of the section relative to other sections.
+    @type position: int
+    """
+    # Save the default sections first so they are not replaced by this one
+    seed_portfolio_sections()
+    models.PortfolioSection.create(section_name, title, position).put()
+    invalidate_sections()
+
+
+def delete_portfolio_section(section_name):
+    """
+    Delete a portfolio section (but not the comments left on it).
+
+    @param section_name: The name of the section to delete.
+    @type section_name: str
+    """
+    # Save the default sections first so the others are kept
+    seed_portfolio_sections()
+    db.delete(db.Key.from_path(
+        models.PortfolioSection.kind(), section_name))
+    invalidate_sections()
+
+
+def get_sections_version():
+    """
+    Get a value that changes whenever the portfolio sections change.
+
+    @return: The current sections version.
+    @rtype: int
+    """
+    version = memcache.get("sections_version")
+    if version == None:
+        # Start from the time so versions are not reused after eviction
+        version = int(time.time())
+        memcache.add("sections_version", version)
+    return version
+
+
+def invalidate_sections():
+    """Change the sections version and drop this instance's cached sections."""
+    global section_cache
+    memcache.incr("sections_version", initial_value=int(time.time()))
+    section_cache = None
+
+
+def get_flash_cookie_serializer():
+    """
+    Get the serializer used to sign and verify flash message cookies.
+
+    Get the serializer used to sign and verify flash message cookies, loading
+    its secret from the datastore only once per instance.
+
+    @return: Serializer signing cookies with the application flash secret.
+    @rtype: securecookie.SecureCookieSerializer
+    """
+    global flash_cookie_serializer
+    if flash_cookie_serializer is None:
+        secret = models.AppSecret.get_value(constants.FLASH_COOKIE_SECRET_NAME)
+        flash_cookie_serializer = securecookie.SecureCookieSerializer(secret)
+    return flash_cookie_serializer
+
+
+def get_flash_messages_key(token):
+    """
+    Get the memcache key for flash messages too large to fit in a cookie.
+
+    @param token: The one-time token the messages were stored under.
+    @type token: str
+    @return: The memcache key holding the messages for the given token.
+    @rtype: str
+    """
+    return "flash_%s" % token
+
+
+def encode_flash_messages(flash_messages):
+    """
+    Create a signed cookie value holding flash messages for a user.
+
+    Create a signed cookie value holding flash messages to be displayed on a
+    user's next page load. Small messages are embedded in the cookie itself.
+    Messages too large for a cookie are stored in memcache under a random one
+    time token and the cookie only holds that token.
+
+    @param flash_messages: The messages to leave for the user.
+    @type flash_messages: Iterable over FlashMessage
+    @return: Signed value for the flash message cookie.
+    @rtype: str
+    """
+    serializer = get_flash_cookie_serializer()
+    messages = map(list, flash_messages)
+
+    cookie_value = serializer.serialize(
+        constants.FLASH_COOKIE_NAME, {"messages": messages})
+    if len(cookie_value) <= constants.FLASH_COOKIE_MAX_SIZE:
+        return cookie_value
+
+    token = binascii.hexlify(os.urandom(constants.SECRET_SIZE))
+    memcache.set(
+        get_flash_messages_key(token),
+        messages,
+        constants.FLASH_MESSAGE_TIME
+    )
+    return serializer.serialize(constants.FLASH_COOKIE_NAME, {"token": token})
+
+
+def decode_flash_messages(cookie_value):
+    """
+    Get the flash messages held by a flash message cookie.
+
+    Get the flash messages held by a flash message cookie. Messages too large
+    to embed in the cookie are read from memcache and deleted so that the
+    cookie's token is only honored once. Callers should clear the cookie
+    afterwards.
+
+    @param cookie_value: The signed value of the flash message cookie.
+    @type cookie_value: str
+    @return: The waiting messages or an empty list if the cookie is missing,
+             expired, or has an invalid signature.
+    @rtype: list of FlashMessage
+    """
+    if not cookie_value:
+        return []
+
+    serializer = get_flash_cookie_serializer()
+    value = serializer.deserialize(
+        constants.FLASH_COOKIE_NAME,
+        cookie_value,
+        max_age=constants.FLASH_MESSAGE_TIME
+    )
+    if not isinstance(value, dict):
+        return []
+
+    if "token" in value:
+        messages_key = get_flash_messages_key(value["token"])
+        messages = memcache.get(messages_key)
+        if messages:
+            memcache.delete(messages_key)
+    else:
+        messages = value.get("messages")
+
+    return map(lambda message: FlashMessage(*message), messages or [])
@@ -0,0 +1,33 @@
+#!/usr/bin/python
+"""
+Precompile the application's Jinja2 templates into importable modules.
+
+Precompile the application's templates into the directory named by
+constants.COMPILED_TEMPLATES_DIR so that instances can import them instead of
+parsing and compiling template sources. Run before deploying:
+
+$ python compile_templates.py
+
+@author: Sam Pottinger
+@license: GNU GPL v3
+"""
+
+import os
+
+import jinja2
+
+import constants
+import templating
+
+
+def main():
+    """Compile all templates into constants.COMPILED_TEMPLATES_DIR."""
+    target_dir = os.path.join(
+        templating.BASE_DIR, constants.COMPILED_TEMPLATES_DIR)
+    environment = templating.create_environment(templating.file_system_loader)
+    environment.compile_templates(target_dir, zip=None, py_compile=False)
+    print "Compiled templates to %s" % target_dir
+
+
+if __name__ == "__main__":
+    main()
@@ -7,13 +7,53 @@ Program-wide constants for the EHP Portfolios Private Comments application.
 
 HOME_URL = "/"
 TEMPLATES_DIR = "templates"
-PORTFOLIO_SECTIONS = [
+COMPILED_TEMPLATES_DIR = "compiled_templates"
+DEFAULT_PORTFOLIO_SECTIONS = [
     "work",
     "experience",
     "service",
     "leadership",
     "research"
 ]
+COMMENT_CACHE_SIZE = 200
+COMMENTS_PAGE_SIZE = 20
+UNREAD_COUNT_CAP = 99
+UNREAD_SCAN_DAYS = 30
+UNREAD_SCAN_BATCH_SIZE = 1000
+COUNTED_COMMENTS_SIZE = 20
+CACHE_CAS_RETRIES = 5
+ROSTER_CACHE_TIME = 600
+FRAGMENT_CACHE_TIME = 3600
+STREAM_CHUNK_SIZE = 8192
+STREAM_RESPONSES = False
+SECTION_CACHE_CHECK_INTERVAL = 10
+SECRET_SIZE = 32
+FLASH_COOKIE_NAME = "flash"
+FLASH_COOKIE_SECRET_NAME = "flash_cookie"
+FLASH_COOKIE_MAX_SIZE = 1024
+FLASH_MESSAGE_TIME = 300
+PROCESS_COMMENT_URL = "/tasks/process_comment"
+FLUSH_VIEWS_URL = "/tasks/flush_views"
+MIGRATE_KEY_NAMES_URL = "/tasks/migrate_key_names"
+BUILD_COUNTERS_URL = "/tasks/build_counters"
+KEY_NAMES_MIGRATION = "key_names"
+MIGRATION_BATCH_SIZE = 100
+VIEWS_QUEUE_NAME = "views"
+VIEW_BUFFER_TIME = 3600
+VIEW_WRITE_WINDOW = 300
+COUNTER_BUILD_WINDOW = 300
+LONG_POLL_TIMEOUT = 10
+LONG_POLL_INTERVAL = 2
+EVENTS_POLL_MIN_DELAY = 5
+EVENTS_POLL_MAX_DELAY = 120
+NOTIFICATION_LOG_SIZE = 50
+VIEW_FLUSH_BATCH_SIZE = 100
+VIEW_FLUSH_LEASE_TIME = 60
+PROFILE_HEADER = "X-Profile"
+PROFILE_ENVIRON_KEY = "HTTP_X_PROFILE"
+PROFILE_REQUEST_SCOPE = "(request)"
+PROFILES_CACHE_KEY = "recent_profiles"
+NUM_RECENT_PROFILES = 50
 
 FLASH_MSG_TYPE_ERR = "error"
 FLASH_MSG_TYPE_CONFIRMATION = "confirmation"
@@ -23,3 +63,9 @@ FLASH_MSG_INVALID_EMAIL = "Sorry! This service is only available to accounts" \
 FLASH_MSG_ADDED_COMMENT = "Comment added!"
 FLASH_MSG_USER_MADE_ADMIN = "User %s given administrator rights."
 FLASH_MSG_USER_MADE_REVIEWER = "User %s given reviewer rights."
+FLASH_MSG_MIGRATING_KEY_NAMES = "Started moving records to key names."
+FLASH_MSG_MIGRATED_ENTITY_GROUPS = "Moved %d comments to their portfolios."
+FLASH_MSG_SECTION_SAVED = "Section %s saved."
+FLASH_MSG_SECTION_DELETED = "Section %s deleted."
+FLASH_MSG_INVALID_SECTION = "Sections need a name (letters, numbers, - or _)" \
+    " and a numeric position."
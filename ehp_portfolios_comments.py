@@ -6,10 +6,9 @@ Handlers for the EHP Portfolios Private Comments application.
 """
 
 import cgi
-import datetime
-import os
+import json
+import logging
 
-import jinja2
 import webapp2
 
 from google.appengine.api import users
@@ -17,42 +16,175 @@ from google.appengine.api import users
 import account_facade
 import constants
 import models
+import notifications
+import profiling
+import templating
 import util
 
 
-# Prepare template files and loader for the jinja2 template rendering package.
-jinja_file_system_loader = jinja2.FileSystemLoader(
-    os.path.join(os.path.dirname(__file__), constants.TEMPLATES_DIR))
-jinja_environment = jinja2.Environment(loader=jinja_file_system_loader)
+jinja_environment = templating.jinja_environment
 
+# Attribute time in profiled requests to account_facade functions
+profiling.instrument_module(account_facade)
 
-def get_standard_template_dict():
+
+def get_standard_template_dict(viewer, flash_messages):
     """
     Generate a dictionary of template values common to all inner app pages.
 
     Generate a dictionary of template values common to all pages outside of
     account mechanics (registration, login, etc).
 
+    @param viewer: The identity of the user making the request.
+    @type viewer: account_facade.ViewerContext
+    @param flash_messages: The flash messages to display on this page.
+    @type flash_messages: list of account_facade.FlashMessage
     @return: Dictionary of common template values.
     @rtype: dict
     """
-    cur_user = users.get_current_user()
-    cur_user_info = models.UserInfo.get_for_user(cur_user)
     std_template_vals = {
-        "user": cur_user,
+        "user": viewer.user,
         "logout_url": users.create_logout_url(constants.HOME_URL),
-        "is_reviewer": cur_user_info.is_reviewer,
-        "is_admin": cur_user_info.is_admin,
-        "flash_message": account_facade.get_flash_message(cur_user.email())
+        "is_reviewer": viewer.is_reviewer,
+        "is_admin": viewer.is_admin,
+        "flash_messages": flash_messages
     }
-    if cur_user_info.is_reviewer:
-        std_template_vals["users"] = account_facade.get_account_listing()
+    if viewer.is_reviewer:
+        std_template_vals["users"] = util.LazyResult(account_facade.get_roster)
+        std_template_vals["roster_version"] = \
+            account_facade.get_roster_version()
         std_template_vals["updated_users"] = \
-            account_facade.get_updated_portfolios(cur_user)
+            account_facade.get_updated_portfolios_async(viewer)
     return std_template_vals
 
 
-class HomePage(webapp2.RequestHandler):
+class BaseHandler(webapp2.RequestHandler):
+    """
+    Base handler providing the identity of the user making a request.
+
+    Base handler for all application pages that resolves the user making the
+    request (and his / her UserInfo record) at most once per request.
+    """
+
+    @webapp2.cached_property
+    def viewer(self):
+        """
+        Get the identity of the user making this request.
+
+        @return: The user making this request along with his / her privileges.
+        @rtype: account_facade.ViewerContext
+        """
+        return account_facade.get_viewer_context(users.get_current_user())
+
+    def add_flash_message(self, msg_type, msg):
+        """
+        Leave a flash message to be displayed on the user's next page load.
+
+        @param msg_type: Constant indicating the type of message being left.
+        @type msg_type: str
+        @param msg: The message to leave.
+        @type msg: str
+        """
+        self.pending_flash_messages.append(
+            account_facade.FlashMessage(msg_type, msg))
+        cookie_value = account_facade.encode_flash_messages(
+            self.pending_flash_messages)
+        self.response.set_cookie(
+            constants.FLASH_COOKIE_NAME,
+            cookie_value,
+            path=constants.HOME_URL,
+            httponly=True
+        )
+
+    def pop_flash_messages(self):
+        """
+        Get any flash messages waiting for the user and clear them.
+
+        @return: The waiting messages (empty if there are none).
+        @rtype: list of account_facade.FlashMessage
+        """
+        cookie_value = self.request.cookies.get(constants.FLASH_COOKIE_NAME)
+        if not cookie_value:
+            return []
+
+        self.response.delete_cookie(
+            constants.FLASH_COOKIE_NAME, path=constants.HOME_URL)
+        return account_facade.decode_flash_messages(cookie_value)
+
+    def check_not_modified(self, profile_email, section_name):
+        """
+        Answer with 304 Not Modified if the client's copy of a page is current.
+
+        Set the ETag of a portfolio page (see account_facade.get_portfolio_etag)
+        and answer with 304 Not Modified if the client sent it back. Pages
+        showing flash messages are neither tagged nor answered with 304 since
+        the messages are only shown once.
+
+        @param profile_email: The email address of the user whose portfolio
+                              is requested.
+        @type profile_email: str
+        @param section_name: The name of the section requested or None for the
+                             portfolio overview.
+        @type section_name: str
+        @return: True if a 304 response was set and the page should not be
+                 rendered and False otherwise.
+        @rtype: bool
+        """
+        if self.request.cookies.get(constants.FLASH_COOKIE_NAME):
+            return False
+
+        etag = account_facade.get_portfolio_etag(
+            self.viewer, profile_email, section_name)
+        self.response.etag = etag
+        self.response.headers["Cache-Control"] = "private, no-cache"
+        if etag in self.request.if_none_match:
+            self.response.status = 304
+            return True
+        return False
+
+    def stream_response(self, chunks, on_complete=None):
+        """
+        Send a response body as it is generated if streaming is enabled.
+
+        Send a response body as it is generated (see
+        templating.generate_chunks) so that its beginning can be written
+        while the rest is still being rendered. The python27 runtime buffers
+        the whole body before sending it so this is only done if
+        constants.STREAM_RESPONSES is set (for servers that send bodies as
+        they are generated). Otherwise the body is rendered right away.
+        Headers (including cookies) must be set before calling this.
+
+        @param chunks: The encoded chunks of the response body.
+        @type chunks: Iterable over str
+        @keyword on_complete: Function to call once the whole body is
+                              generated (not if generation fails or the
+                              client disconnects) or None for no such
+                              function.
+        @type on_complete: function
+        """
+        def generate_body():
+            for chunk in chunks:
+                yield chunk
+            if on_complete:
+                on_complete()
+
+        if constants.STREAM_RESPONSES:
+            self.response.app_iter = generate_body()
+        else:
+            self.response.out.write("".join(generate_body()))
+
+    @webapp2.cached_property
+    def pending_flash_messages(self):
+        """
+        Get the flash messages left while handling this request.
+
+        @return: Messages to be displayed on the user's next page load.
+        @rtype: list of account_facade.FlashMessage
+        """
+        return []
+
+
+class HomePage(BaseHandler):
     """Handler for the application homepage."""
 
     def get(self):
@@ -72,24 +204,18 @@ class HomePage(webapp2.RequestHandler):
                 self.redirect("/sync_user")
                 return
 
-            flash_message = account_facade.get_flash_message(cur_user.email())
-
-        else:
-
-            flash_message = None
-
         # Render page
         template = jinja_environment.get_template("home.html")
         content = template.render(
             {
                 "login_url": users.create_login_url("/sync_user"),
-                "flash_message": flash_message
+                "flash_messages": self.pop_flash_messages()
             }
         )
         self.response.out.write(content)
 
 
-class SyncUserHandler(webapp2.RequestHandler):
+class SyncUserHandler(BaseHandler):
     """
     Handler for a redirect page that ensures a user has an account.
 
@@ -109,8 +235,7 @@ class SyncUserHandler(webapp2.RequestHandler):
         target_email = cur_user.email()
 
         if not util.check_email(target_email):
-            account_facade.set_flash_message(
-                target_email,
+            self.add_flash_message(
                 constants.FLASH_MSG_TYPE_ERR,
                 constants.FLASH_MSG_INVALID_EMAIL
             )
@@ -120,7 +245,7 @@ class SyncUserHandler(webapp2.RequestHandler):
             self.redirect(util.get_user_home(cur_user))
 
 
-class PortfolioOverviewPage(webapp2.RequestHandler):
+class PortfolioOverviewPage(BaseHandler):
     """
     Handler that renders a portfolio's overview page, showing unread comments.
 
@@ -136,17 +261,22 @@ class PortfolioOverviewPage(webapp2.RequestHandler):
                               overview page should be rendered.
         @type profile_email: str
         """
-        cur_user = users.get_current_user()
+        cur_user = self.viewer
         if not account_facade.viewer_has_access(cur_user, profile_email):
             self.redirect(constants.HOME_URL)
+            return
+
+        if self.check_not_modified(profile_email, None):
+            return
 
-        section_statuses = account_facade.get_updated_sections(
+        # Start lookups concurrently, waiting only when the template needs them
+        section_statuses = account_facade.get_updated_sections_async(
             cur_user, profile_email)
-        sections = constants.PORTFOLIO_SECTIONS
-        account_facade.set_viewed(cur_user, profile_email, None)
+        sections = account_facade.get_portfolio_sections()
 
         template = jinja_environment.get_template("portfolio_overview.html")
-        template_vals = get_standard_template_dict()
+        template_vals = get_standard_template_dict(
+            self.viewer, self.pop_flash_messages())
         owner_name = util.get_full_name_from_email(profile_email)
         template_vals["profile_safe_email"] = util.sanitize_email(profile_email)
         template_vals["cur_section"] = "overview"
@@ -155,11 +285,22 @@ class PortfolioOverviewPage(webapp2.RequestHandler):
         template_vals["owner_last_name"] = owner_name[1]
         template_vals["sections"] = sections
         template_vals["section_statuses"] = section_statuses
+        template_vals["unread_version"] = account_facade.get_unread_version(
+            cur_user, profile_email)
+        template_vals["sections_version"] = \
+            account_facade.get_sections_version()
+        template_vals["events_cursor"] = notifications.get_portfolio_cursor(
+            profile_email, account_facade.get_latest_comment_time)
+        template_vals["events_min_delay"] = constants.EVENTS_POLL_MIN_DELAY
+        template_vals["events_max_delay"] = constants.EVENTS_POLL_MAX_DELAY
+        template_vals["unread_count_cap"] = constants.UNREAD_COUNT_CAP
         content = template.render(template_vals)
+
+        account_facade.set_viewed(cur_user, profile_email, None)
         self.response.out.write(content)
 
 
-class PortfolioContentPage(webapp2.RequestHandler):
+class PortfolioContentPage(BaseHandler):
     """Handler to render the private comments for a section of a portfolio."""
 
     def get(self, profile_email, section_name):
@@ -173,22 +314,27 @@ class PortfolioContentPage(webapp2.RequestHandler):
                              comments for.
         @type section_name: str
         """
-        cur_user = users.get_current_user()
+        if not account_facade.is_portfolio_section(section_name):
+            self.abort(404)
+
+        cur_user = self.viewer
         if not account_facade.viewer_has_access(cur_user, profile_email):
             self.redirect(constants.HOME_URL)
+            return
 
-        new_comments = account_facade.get_new_comments(
-            cur_user, profile_email, section_name)
-        old_comments = account_facade.get_old_comments(
-            cur_user, profile_email, section_name)
+        if self.check_not_modified(profile_email, section_name):
+            return
 
-        section_statuses = account_facade.get_updated_sections(
+        # Start lookups concurrently, waiting only when the template needs them
+        comment_listing = account_facade.get_comments_async(
+            cur_user, profile_email, section_name)
+        section_statuses = account_facade.get_updated_sections_async(
             cur_user, profile_email)
-        sections = constants.PORTFOLIO_SECTIONS
-        account_facade.set_viewed(cur_user, profile_email, section_name)
+        sections = account_facade.get_portfolio_sections()
 
         template = jinja_environment.get_template("portfolio_section.html")
-        template_vals = get_standard_template_dict()
+        template_vals = get_standard_template_dict(
+            self.viewer, self.pop_flash_messages())
         owner_name = util.get_full_name_from_email(profile_email)
         template_vals["profile_safe_email"] = util.sanitize_email(profile_email)
         template_vals["cur_section"] = section_name
@@ -197,10 +343,33 @@ class PortfolioContentPage(webapp2.RequestHandler):
         template_vals["owner_last_name"] = owner_name[1]
         template_vals["sections"] = sections
         template_vals["section_statuses"] = section_statuses
-        template_vals["new_comments"] = new_comments
-        template_vals["old_comments"] = old_comments
-        content = template.render(template_vals)
-        self.response.out.write(content)
+        template_vals["unread_version"] = account_facade.get_unread_version(
+            cur_user, profile_email)
+        template_vals["sections_version"] = \
+            account_facade.get_sections_version()
+        template_vals["events_cursor"] = notifications.get_portfolio_cursor(
+            profile_email, account_facade.get_latest_comment_time)
+        template_vals["events_min_delay"] = constants.EVENTS_POLL_MIN_DELAY
+        template_vals["events_max_delay"] = constants.EVENTS_POLL_MAX_DELAY
+        template_vals["unread_count_cap"] = constants.UNREAD_COUNT_CAP
+        template_vals["new_comments"] = util.LazyResult(
+            lambda: comment_listing.new_comments)
+        template_vals["old_comments"] = util.LazyResult(
+            lambda: comment_listing.old_comments)
+        template_vals["older_url"] = util.LazyResult(
+            lambda: comment_listing.older_cursor and \
+                util.get_older_comments_url(
+                    profile_email,
+                    section_name,
+                    comment_listing.last_visited,
+                    comment_listing.older_cursor
+                )
+        )
+        chunks = templating.generate_chunks(template, template_vals)
+
+        # Record the visit only once the page it shows is fully rendered
+        self.stream_response(chunks, lambda: account_facade.set_viewed(
+            cur_user, profile_email, section_name))
 
     def post(self, profile_email, section_name):
         """
@@ -213,26 +382,24 @@ class PortfolioContentPage(webapp2.RequestHandler):
                              comment to.
         @type section_name: str
         """
-        cur_user = users.get_current_user()
+        if not account_facade.is_portfolio_section(section_name):
+            self.abort(404)
+
+        cur_user = self.viewer
         if not account_facade.viewer_has_access(cur_user, profile_email):
             self.redirect(constants.HOME_URL)
+            return
 
         raw_comment_contents = self.request.get("comment-contents", "")
         comment_contents = cgi.escape(raw_comment_contents)
         comment_contents = "<br>".join(comment_contents.splitlines())
 
-        new_comment = models.Comment()
-        new_comment.author_email = cur_user.email()
-        new_comment.profile_email = profile_email
-        new_comment.section_name = section_name
-        new_comment.contents = comment_contents
-        new_comment.timestamp = datetime.datetime.now()
-        new_comment.put()
+        account_facade.add_comment(
+            cur_user, profile_email, section_name, comment_contents)
 
         account_facade.set_viewed(cur_user, profile_email, section_name)
 
-        account_facade.set_flash_message(
-            cur_user.email(),
+        self.add_flash_message(
             constants.FLASH_MSG_TYPE_CONFIRMATION,
             constants.FLASH_MSG_ADDED_COMMENT
         )
@@ -240,34 +407,208 @@ class PortfolioContentPage(webapp2.RequestHandler):
         self.redirect(self.request.path)
 
 
-class AdminPageHandler(webapp2.RequestHandler):
+class OlderCommentsPage(BaseHandler):
+    """Handler returning a page of older private comments for a section."""
+
+    def get(self, profile_email, section_name):
+        """
+        GET request handler that returns the next page of older comments.
+
+        GET request handler that returns the next page of comments posted
+        before the visit given in the "visited" parameter starting at the
+        "cursor" parameter, either as an HTML fragment or as JSON if the
+        "format" parameter is "json".
+
+        @param profile_email: The email address of the user whose portfolio's
+                              comments should be returned.
+        @type profile_email: str
+        @param section_name: The name of the portfolio section to return
+                             comments for.
+        @type section_name: str
+        """
+        if not account_facade.is_portfolio_section(section_name):
+            self.abort(404)
+
+        cur_user = self.viewer
+        if not account_facade.viewer_has_access(cur_user, profile_email):
+            self.abort(403)
+
+        last_visited = util.token_to_timestamp(self.request.get("visited"))
+        if not last_visited:
+            self.abort(400)
+        cursor = self.request.get("cursor", None)
+        response_format = self.request.get("format", None)
+
+        comments, next_cursor = account_facade.get_older_comments(
+            profile_email, last_visited, section_name, cursor)
+        if next_cursor:
+            older_url = util.get_older_comments_url(profile_email,
+                section_name, last_visited, next_cursor, response_format)
+        else:
+            older_url = None
+
+        if response_format == "json":
+            self.response.headers["Content-Type"] = "application/json"
+            self.response.out.write(json.dumps({
+                "comments": map(
+                    lambda x: {
+                        "author_email": x.author_email,
+                        "timestamp": x.timestamp.strftime("%Y-%m-%d"),
+                        "contents": x.contents,
+                        "html": x.get_html()
+                    },
+                    comments
+                ),
+                "older_url": older_url
+            }))
+        else:
+            template = jinja_environment.get_template("comment_list.html")
+            content = template.render(
+                {
+                    "old_comments": comments,
+                    "older_url": older_url
+                }
+            )
+            self.response.out.write(content)
+
+
+class PortfolioEventsHandler(BaseHandler):
+    """Handler waiting for new comment events on a portfolio (long-poll)."""
+
+    def get(self, profile_email):
+        """
+        GET request handler that returns new comment events as JSON.
+
+        GET request handler that waits up to constants.LONG_POLL_TIMEOUT
+        seconds for comments posted by others on a portfolio after the
+        "cursor" parameter and returns them along with the cursor to send
+        with the next request.
+
+        @param profile_email: The email address of the user whose portfolio
+                              events should be returned.
+        @type profile_email: str
+        """
+        cur_user = self.viewer
+        if not account_facade.viewer_has_access(cur_user, profile_email):
+            self.abort(403)
+
+        try:
+            cursor = int(self.request.get("cursor"))
+        except ValueError:
+            self.abort(400)
+
+        events, next_cursor = notifications.wait_for_portfolio_events(
+            profile_email, cursor)
+        events = filter(lambda x: x["author_email"] != cur_user.email(),
+            events)
+
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.headers["Cache-Control"] = "private, no-cache"
+        self.response.out.write(json.dumps({
+            "cursor": next_cursor,
+            "events": events
+        }))
+
+
+class UnreadCountsHandler(BaseHandler):
+    """Handler returning the current user's unread comment counts as JSON."""
+
+    def get(self):
+        """
+        GET request handler that returns unread counts changed since a poll.
+
+        GET request handler that returns the number of unread comments on
+        every portfolio and section the user can see along with a token. If
+        the "since" parameter is the token returned by an earlier request and
+        nothing changed, the response has "changed" set to false and no
+        portfolios, having cost a single memcache lookup: the token is checked
+        before the user's records are loaded as it was only handed out by a
+        request that passed the access checks. Otherwise every portfolio is
+        listed so clients can replace what they have. Users who are not
+        signed in get 403 and users who are neither reviewers nor have a
+        portfolio get 404.
+        """
+        user = users.get_current_user()
+        if user == None:
+            self.abort(403)
+
+        since = self.request.get("since", None)
+        if since and since == account_facade.get_unread_token(user.email()):
+            self.write_unread_counts(since, None)
+            return
+
+        cur_user = self.viewer
+        if not cur_user.is_reviewer and not account_facade.viewer_has_access(
+            cur_user, cur_user.email()):
+            self.abort(404)
+
+        update = account_facade.get_unread_update(cur_user, since)
+        self.write_unread_counts(update.token, update.unread_counts)
+
+    def write_unread_counts(self, token, unread_counts):
+        """
+        Write unread comment counts as the JSON body of the response.
+
+        @param token: The token to be passed as "since" on the next poll.
+        @type token: str
+        @param unread_counts: The unread counts on every portfolio the user
+                              can see (see account_facade.get_unread_counts)
+                              or None if nothing changed since the poll.
+        @type unread_counts: Dict mapping str to (dict mapping str to int)
+        """
+        portfolios = {}
+        for profile_email, section_counts in (unread_counts or {}).items():
+            total = sum(section_counts.values())
+            portfolios[profile_email] = {
+                "total": total,
+                "label": util.format_unread_count(total),
+                "sections": dict(map(
+                    lambda (section_name, count): (section_name, {
+                        "count": count,
+                        "label": util.format_unread_count(count)
+                    }),
+                    section_counts.items()
+                ))
+            }
+
+        self.response.headers["Content-Type"] = "application/json"
+        self.response.headers["Cache-Control"] = "private, no-cache"
+        self.response.out.write(json.dumps({
+            "since": token,
+            "changed": unread_counts != None,
+            "portfolios": portfolios
+        }))
+
+
+class AdminPageHandler(BaseHandler):
     """Handler to render admin page."""
 
     def get(self):
-        cur_user = users.get_current_user()
-        if not account_facade.is_admin(cur_user):
+        cur_user = self.viewer
+        if not cur_user.is_admin:
             self.redirect(constants.HOME_URL)
+            return
 
         template = jinja_environment.get_template("admin.html")
-        template_vals = get_standard_template_dict()
+        template_vals = get_standard_template_dict(
+            self.viewer, self.pop_flash_messages())
+        template_vals["accounts"] = account_facade.get_account_listing()
         content = template.render(template_vals)
         self.response.out.write(content)
 
 
-class ReviewerUpgradeHandler(webapp2.RequestHandler):
+class ReviewerUpgradeHandler(BaseHandler):
     """Handler to make a user into a reviewer."""
 
     def get(self, target_email):
-        cur_user = users.get_current_user()
-        if not account_facade.is_admin(cur_user):
+        cur_user = self.viewer
+        if not cur_user.is_admin:
             self.redirect(constants.HOME_URL)
+            return
 
-        target_user_info = models.UserInfo.get_for_email(target_email)
-        target_user_info.is_reviewer = True
-        target_user_info.put()
+        account_facade.make_reviewer(target_email)
 
-        account_facade.set_flash_message(
-            cur_user.email(),
+        self.add_flash_message(
             constants.FLASH_MSG_TYPE_CONFIRMATION,
             constants.FLASH_MSG_USER_MADE_REVIEWER % target_email
         )
@@ -275,21 +616,18 @@ class ReviewerUpgradeHandler(webapp2.RequestHandler):
         self.redirect("/administer")
 
 
-class AdminUpgradeHandler(webapp2.RequestHandler):
+class AdminUpgradeHandler(BaseHandler):
     """Handler to make a user into a administrator."""
 
     def get(self, target_email):
-        cur_user = users.get_current_user()
-        if not account_facade.is_admin(cur_user):
+        cur_user = self.viewer
+        if not cur_user.is_admin:
             self.redirect(constants.HOME_URL)
+            return
 
-        target_user_info = models.UserInfo.get_for_email(target_email)
-        target_user_info.is_reviewer = True
-        target_user_info.is_admin = True
-        target_user_info.put()
+        account_facade.make_admin(target_email)
 
-        account_facade.set_flash_message(
-            cur_user.email(),
+        self.add_flash_message(
             constants.FLASH_MSG_TYPE_CONFIRMATION,
             constants.FLASH_MSG_USER_MADE_ADMIN % target_email
         )
@@ -297,16 +635,222 @@ class AdminUpgradeHandler(webapp2.RequestHandler):
         self.redirect("/administer")
 
 
-# Register handlers along with URL patterns
-app = webapp2.WSGIApplication(
+class MigrateKeyNamesHandler(BaseHandler):
+    """Handler to start moving records saved without key names to their keys."""
+
+    def get(self):
+        cur_user = self.viewer
+        if not cur_user.is_admin:
+            self.redirect(constants.HOME_URL)
+            return
+
+        account_facade.enqueue_key_name_migration()
+
+        self.add_flash_message(
+            constants.FLASH_MSG_TYPE_CONFIRMATION,
+            constants.FLASH_MSG_MIGRATING_KEY_NAMES
+        )
+
+        self.redirect("/administer")
+
+
+class MigrateEntityGroupsHandler(BaseHandler):
+    """Handler to move comments saved without a parent to their portfolios."""
+
+    def get(self):
+        cur_user = self.viewer
+        if not cur_user.is_admin:
+            self.redirect(constants.HOME_URL)
+            return
+
+        num_migrated = account_facade.migrate_entity_groups()
+
+        self.add_flash_message(
+            constants.FLASH_MSG_TYPE_CONFIRMATION,
+            constants.FLASH_MSG_MIGRATED_ENTITY_GROUPS % num_migrated
+        )
+
+        self.redirect("/administer")
+
+
+class AdminSectionsHandler(BaseHandler):
+    """Handler to list, create and update portfolio sections."""
+
+    def get(self):
+        cur_user = self.viewer
+        if not cur_user.is_admin:
+            self.redirect(constants.HOME_URL)
+            return
+
+        template_vals = get_standard_template_dict(
+            self.viewer, self.pop_flash_messages())
+        template_vals["sections"] = \
+            account_facade.get_portfolio_section_records()
+
+        template = jinja_environment.get_template("admin_sections.html")
+        self.response.out.write(template.render(template_vals))
+
+    def post(self):
+        cur_user = self.viewer
+        if not cur_user.is_admin:
+            self.redirect(constants.HOME_URL)
+            return
+
+        section_name = self.request.get("name", "").strip()
+        title = self.request.get("title", "").strip() or section_name
+        try:
+            position = int(self.request.get("position", ""))
+        except ValueError:
+            position = None
+
+        if position == None or not util.check_section_name(section_name):
+            self.add_flash_message(
+                constants.FLASH_MSG_TYPE_ERR,
+                constants.FLASH_MSG_INVALID_SECTION
+            )
+        else:
+            account_facade.save_portfolio_section(
+                section_name, title, position)
+            self.add_flash_message(
+                constants.FLASH_MSG_TYPE_CONFIRMATION,
+                constants.FLASH_MSG_SECTION_SAVED % section_name
+            )
+
+        self.redirect("/administer/sections")
+
+
+class DeleteSectionHandler(BaseHandler):
+    """Handler to delete a portfolio section."""
+
+    def get(self, section_name):
+        cur_user = self.viewer
+        if not cur_user.is_admin:
+            self.redirect(constants.HOME_URL)
+            return
+
+        account_facade.delete_portfolio_section(section_name)
+
+        self.add_flash_message(
+            constants.FLASH_MSG_TYPE_CONFIRMATION,
+            constants.FLASH_MSG_SECTION_DELETED % section_name
+        )
+
+        self.redirect("/administer/sections")
+
+
+class AdminStatsHandler(BaseHandler):
+    """Handler for the page listing recently profiled requests."""
+
+    def get(self):
+        cur_user = self.viewer
+        if not cur_user.is_admin:
+            self.redirect(constants.HOME_URL)
+            return
+
+        template_vals = get_standard_template_dict(
+            self.viewer, self.pop_flash_messages())
+        template_vals["profiles"] = profiling.get_recent_profiles()
+        template_vals["profile_header"] = constants.PROFILE_HEADER
+
+        template = jinja_environment.get_template("admin_stats.html")
+        self.response.out.write(template.render(template_vals))
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    """Handler for warmup requests sent before an instance takes traffic."""
+
+    def get(self):
+        """
+        GET request handler that prepares the instance to serve pages.
+
+        GET request handler that loads all templates ahead of use and saves
+        the default portfolio sections if none are saved.
+        """
+        templating.warm_up()
+        account_facade.seed_portfolio_sections()
+
+
+class ProcessCommentTask(webapp2.RequestHandler):
+    """Handler for the task that processes a newly saved comment."""
+
+    def post(self):
+        """
+        POST request handler that updates everything derived from a comment.
+
+        POST request handler run by the task queue after a comment is saved.
+        Unexpected errors fail the request so that the task is retried.
+        """
+        comment_key = self.request.get("comment_key")
+        if not account_facade.process_new_comment(comment_key):
+            logging.warning("Comment %s to process not found.", comment_key)
+
+
+class FlushViewsTask(webapp2.RequestHandler):
+    """Handler for the cron job saving buffered portfolio views."""
+
+    def get(self):
+        """GET request handler that saves buffered views in batches."""
+        num_saved = account_facade.flush_views()
+        logging.info("Saved %d buffered views.", num_saved)
+
+
+class BuildCountersTask(webapp2.RequestHandler):
+    """Handler for the task building a user's missing unread counters."""
+
+    def post(self):
+        """POST request handler that saves the missing counters."""
+        num_built = account_facade.build_unread_counters(
+            self.request.get("viewer_email"),
+            self.request.get_all("profile_email")
+        )
+        logging.info("Built %d unread counters.", num_built)
+
+
+class MigrateKeyNamesTask(webapp2.RequestHandler):
+    """Handler for the task moving a batch of records to their key names."""
+
+    def post(self):
+        """
+        POST request handler migrating a batch and enqueuing the next one.
+
+        POST request handler run by the task queue that migrates a batch of
+        records and enqueues a task for the following batch until the
+        migration finishes.
+        """
+        num_migrated, step, cursor = account_facade.migrate_key_names_batch(
+            self.request.get("step") or None,
+            self.request.get("cursor") or None
+        )
+        logging.info("Migrated %d records to key names.", num_migrated)
+        if step:
+            account_facade.enqueue_key_name_migration(step, cursor)
+        else:
+            logging.info("Finished migrating records to key names.")
+
+
+# Register handlers along with URL patterns, profiling requests that ask
+app = profiling.ProfilingMiddleware(webapp2.WSGIApplication(
         [
             ("/", HomePage),
+            ("/_ah/warmup", WarmupHandler),
             ("/sync_user", SyncUserHandler),
+            (constants.PROCESS_COMMENT_URL, ProcessCommentTask),
+            (constants.FLUSH_VIEWS_URL, FlushViewsTask),
+            (constants.BUILD_COUNTERS_URL, BuildCountersTask),
+            (constants.MIGRATE_KEY_NAMES_URL, MigrateKeyNamesTask),
+            ("/api/unread", UnreadCountsHandler),
             ("/administer", AdminPageHandler),
+            ("/administer/stats", AdminStatsHandler),
+            ("/administer/sections", AdminSectionsHandler),
+            ("/administer/sections/([^/]+)/delete", DeleteSectionHandler),
+            ("/administer/migrate_key_names", MigrateKeyNamesHandler),
+            ("/administer/migrate_entity_groups", MigrateEntityGroupsHandler),
             ("/administer/([^/]+)/make_reviewer", ReviewerUpgradeHandler),
             ("/administer/([^/]+)/make_admin", AdminUpgradeHandler),
             ("/portfolio/([^/]+)/overview", PortfolioOverviewPage),
+            ("/portfolio/([^/]+)/events", PortfolioEventsHandler),
+            ("/portfolio/([^/]+)/section/([^/]+)/older", OlderCommentsPage),
             ("/portfolio/([^/]+)/section/([^/]+)", PortfolioContentPage)
         ],
         debug=True
-    )
+    ))
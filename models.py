@@ -5,19 +5,164 @@ Data models for the EHP Portfolios Private Comments application.
 @license: GNU GPL v3
 """
 
+import binascii
+import os
+
 from google.appengine.ext import db
 
+import constants
+import util
+
+
+def copy_with_key_name(entity, key_name):
+    """
+    Create an unsaved copy of a record under a different key name.
+
+    @param entity: The record to copy.
+    @type entity: db.Model
+    @param key_name: The key name the copy should be saved under.
+    @type key_name: str
+    @return: New unsaved record with the same property values.
+    @rtype: db.Model
+    """
+    return entity.__class__(key_name=key_name, **get_property_values(entity))
+
+
+def copy_with_parent(entity, parent):
+    """
+    Create an unsaved copy of a record in a different entity group.
+
+    @param entity: The record to copy.
+    @type entity: db.Model
+    @param parent: The key of the parent the copy should be saved under.
+    @type parent: db.Key
+    @return: New unsaved record with the same key name (or a new ID if the
+             record has no key name) and property values.
+    @rtype: db.Model
+    """
+    return entity.__class__(
+        parent=parent,
+        key_name=entity.key().name(),
+        **get_property_values(entity)
+    )
+
+
+def get_property_values(entity):
+    """
+    Get the values of all of the properties of a record.
+
+    @param entity: The record to read.
+    @type entity: db.Model
+    @return: Mapping from property name to value.
+    @rtype: dict
+    """
+    return dict(map(
+        lambda name: (name, getattr(entity, name)),
+        entity.properties().keys()
+    ))
+
+
+def get_portfolio_key(profile_email):
+    """
+    Get the key of the entity group holding a portfolio's comments.
+
+    Get the key of the UserInfo record of a portfolio's owner which is the
+    parent of all comments and unread counters for that portfolio. The record
+    itself does not need to exist.
+
+    @param profile_email: The email address of the portfolio's owner.
+    @type profile_email: str
+    @return: Key of the entity group for the given portfolio.
+    @rtype: db.Key
+    """
+    return db.Key.from_path(
+        UserInfo.kind(), UserInfo.get_key_name(profile_email))
+
+
+def fetch_batch(query, cursor=None):
+    """
+    Fetch a batch of constants.MIGRATION_BATCH_SIZE records from a query.
+
+    @param query: The query to fetch records from.
+    @type query: db.Query
+    @keyword cursor: The cursor returned with the previous batch or None to
+                     fetch the first batch.
+    @type cursor: str
+    @return: The records fetched and the cursor of the next batch or None if
+             there are no more records.
+    @rtype: Tuple of list and str
+    """
+    if cursor:
+        query.with_cursor(cursor)
+    records = query.fetch(constants.MIGRATION_BATCH_SIZE)
+    if len(records) < constants.MIGRATION_BATCH_SIZE:
+        return (records, None)
+    return (records, query.cursor())
+
+
+def get_by_key_names_async(model_class, key_names):
+    """
+    Start getting many records of a kind by key name in one batch.
+
+    @param model_class: The kind of records to get.
+    @type model_class: class
+    @param key_names: The key names of the records to get.
+    @type key_names: Iterable over str
+    @return: RPC whose result is the records in the same order as the given
+             key names with None in place of missing records.
+    @rtype: RPC
+    """
+    keys = map(
+        lambda x: db.Key.from_path(model_class.kind(), x),
+        key_names
+    )
+    return db.get_async(keys)
+
+
+def is_later(timestamp, other_timestamp):
+    """
+    Determine if a possibly missing timestamp comes after another one.
+
+    @param timestamp: The timestamp to check or None if missing.
+    @type timestamp: datetime.datetime
+    @param other_timestamp: The timestamp to compare against or None if missing.
+    @type other_timestamp: datetime.datetime
+    @return: True if timestamp is set and comes after other_timestamp (or
+             other_timestamp is missing) and False otherwise.
+    @rtype: bool
+    """
+    if timestamp == None:
+        return False
+    return other_timestamp == None or timestamp > other_timestamp
+
 
 class UserInfo(db.Model):
-    """Data model for application specific user information."""
+    """
+    Data model for application specific user information.
+
+    Data model for application specific user information keyed by the user's
+    email address (see UserInfo.get_key_name).
+    """
     
     email = db.StringProperty()
     safe_email = db.StringProperty()
-    is_reviewer = db.BooleanProperty()
-    is_admin = db.BooleanProperty()
+    is_reviewer = db.BooleanProperty(indexed=False)
+    is_admin = db.BooleanProperty(indexed=False)
     first_name = db.StringProperty()
     last_name = db.StringProperty()
 
+    @classmethod
+    def get_key_name(cls, email):
+        """
+        Get the key name of the UserInfo record for the given email address.
+
+        @param email: The email address of the user.
+        @type email: str
+        @return: Key name for the corresponding UserInfo record.
+        @rtype: str
+        """
+        return email
+
     @classmethod
     def get_for_user(cls, target_user):
         """
@@ -29,9 +174,7 @@ class UserInfo(db.Model):
         @return: The UserInfo object for the given user or None if none exists.
         @rtype: UserInfo or None
         """
-        query = db.Query(cls)
-        query.filter("email ==", target_user.email())
-        return query.get()
+        return cls.get_for_email(target_user.email())
 
     @classmethod
     def get_for_email(cls, email):
@@ -44,9 +187,97 @@ class UserInfo(db.Model):
         @return: The UserInfo record for the given user.
         @rtype: UserInfo
         """
+        return cls.get_for_emails([email])[0]
+
+    @classmethod
+    def get_for_emails(cls, emails):
+        """
+        Get the UserInfo records for many users in a single batch.
+
+        @param emails: The email addresses of the users to get records for.
+        @type emails: Iterable over str
+        @return: UserInfo records in the same order as the given emails with
+                 None in place of users without a record. Until the key name
+                 migration completes, records saved without a key name are
+                 migrated when first requested.
+        @rtype: List of UserInfo or None
+        """
+        emails = list(emails)
+        records = cls.get_by_key_name(map(cls.get_key_name, emails))
+        if all(records) or MigrationStatus.is_complete(
+            constants.KEY_NAMES_MIGRATION):
+            return records
+
+        # Records may still be saved without a key name until migrated
+        return map(
+            lambda (email, record): record or cls.migrate_legacy_record(email),
+            zip(emails, records)
+        )
+
+    @classmethod
+    def get_roster(cls):
+        """
+        Get the names and emails of all users with a single projection query.
+
+        @return: UserInfo records with only last_name, first_name, email and
+                 safe_email loaded sorted first by last name and then first
+                 name.
+        @rtype: Iterable over UserInfo
+        """
+        query = db.Query(
+            cls,
+            projection=("last_name", "first_name", "email", "safe_email")
+        )
+        query.order("last_name")
+        query.order("first_name")
+        return query
+
+    @classmethod
+    def migrate_legacy_record(cls, email):
+        """
+        Find a UserInfo record saved without a key name and move it to its key.
+
+        @param email: The email address of the user whose record should be
+                      migrated.
+        @type email: str
+        @return: The migrated record or None if the user has no legacy record.
+        @rtype: UserInfo or None
+        """
         query = db.Query(cls)
         query.filter("email ==", email)
-        return query.get()
+        legacy_record = query.get()
+        if not legacy_record:
+            return None
+
+        new_record = copy_with_key_name(legacy_record, cls.get_key_name(email))
+        new_record.put()
+        legacy_record.delete()
+        return new_record
+
+    @classmethod
+    def migrate_key_names(cls, cursor=None):
+        """
+        Move a batch of UserInfo records saved without a key name to their key.
+
+        @keyword cursor: The cursor returned by the previous batch or None to
+                         start with the first batch.
+        @type cursor: str
+        @return: The number of records migrated and the cursor of the next
+                 batch or None if this was the last batch.
+        @rtype: Tuple of int and str
+        """
+        records, next_cursor = fetch_batch(cls.all(), cursor)
+        legacy_records = filter(
+            lambda x: x.key().name() != cls.get_key_name(x.email),
+            records
+        )
+        new_records = map(
+            lambda x: copy_with_key_name(x, cls.get_key_name(x.email)),
+            legacy_records
+        )
+        db.put(new_records)
+        db.delete(legacy_records)
+        return (len(legacy_records), next_cursor)
 
 
 class ViewingProfile(db.Model):
@@ -54,13 +285,60 @@ class ViewingProfile(db.Model):
     Data model describing which profiles and sections a user has viewed.
 
     Data model with information about which profiles / sections a user has
-    viewed along with timestamps for when they were last viewed.
+    viewed along with timestamps for when they were last viewed. Records are
+    keyed by ViewingProfile.get_key_name.
     """
 
     viewer_email = db.StringProperty()
-    profile_email = db.StringProperty()
-    section_name = db.StringProperty()
-    last_visited = db.DateTimeProperty()
+    profile_email = db.StringProperty(indexed=False)
+    section_name = db.StringProperty(indexed=False)
+    last_visited = db.DateTimeProperty(indexed=False)
+
+    @classmethod
+    def get_key_name(cls, viewer_email, profile_email, section_name):
+        """
+        Get the key name of the viewing profile for a user and section.
+
+        @param viewer_email: The email of the user who viewed the portfolio.
+        @type viewer_email: str
+        @param profile_email: The email of the user whose portfolio was viewed.
+        @type profile_email: str
+        @param section_name: The name of the section viewed or None for the
+                             portfolio overview.
+        @type section_name: str
+        @return: Key name for the corresponding ViewingProfile record.
+        @rtype: str
+        """
+        if section_name == None:
+            section_name = ""
+        return "%s|%s|%s" % (viewer_email, profile_email, section_name)
+
+    @classmethod
+    def create(cls, viewer_email, profile_email, section_name, last_visited):
+        """
+        Create (but do not save) a viewing profile for a user and section.
+
+        @param viewer_email: The email of the user who viewed the portfolio.
+        @type viewer_email: str
+        @param profile_email: The email of the user whose portfolio was viewed.
+        @type profile_email: str
+        @param section_name: The name of the section viewed or None for the
+                             portfolio overview.
+        @type section_name: str
+        @param last_visited: When the user last viewed the section or None if
+                             never viewed.
+        @type last_visited: datetime.datetime
+        @return: New unsaved viewing profile record.
+        @rtype: ViewingProfile
+        """
+        return cls(
+            key_name=cls.get_key_name(
+                viewer_email, profile_email, section_name),
+            viewer_email=viewer_email,
+            profile_email=profile_email,
+            section_name=section_name,
+            last_visited=last_visited
+        )
 
     @classmethod
     def get_for(cls, viewing_user, profile_email, section_name):
@@ -70,6 +348,8 @@ class ViewingProfile(db.Model):
         Get the viewing profile record for the given user in relationship to
         the given portfolio and section, a data model with information about
         when the given user last viewed the portfolio / section in question.
+        This is a single key get that never writes: if no record exists, an
+        unsaved record without a last visit is returned.
 
         @param viewing_user: The user for whom a viewing profile should be
                              returned.
@@ -84,35 +364,141 @@ class ViewingProfile(db.Model):
                  last visited the given profile section.
         @rtype: ViewingProfile
         """
-        query = db.Query(cls)
+        key_name = cls.get_key_name(
+            viewing_user.email(), profile_email, section_name)
+        viewing_profile = cls.get_by_key_name(key_name)
         
-        query.filter("viewer_email ==", viewing_user.email())
-        query.filter("profile_email ==", profile_email)
-        query.filter("section_name ==", section_name)
-        
-        if query.count() == 0:
-            new_profile = ViewingProfile()
-            new_profile.viewer_email = viewing_user.email()
-            new_profile.profile_email = profile_email
-            new_profile.section_name = section_name
-            new_profile.last_visited = None
-            new_profile.put()
-            return new_profile
-        else:
-            return query.get()
+        if not viewing_profile:
+            viewing_profile = cls.create(
+                viewing_user.email(), profile_email, section_name, None)
+
+        return viewing_profile
+
+    @classmethod
+    def get_all_for(cls, viewer_email):
+        """
+        Get every viewing profile recorded for a user.
+
+        @param viewer_email: The email of the user whose viewing profiles
+                             should be returned.
+        @type viewer_email: str
+        @return: Viewing profiles for all portfolios / sections the user viewed.
+        @rtype: Iterable over ViewingProfile
+        """
+        query = db.Query(cls)
+        query.filter("viewer_email ==", viewer_email)
+        return query
+
+    @classmethod
+    def get_many(cls, viewer_email, profile_section_pairs):
+        """
+        Get the viewing profiles for a user on many sections in one batch.
+
+        @param viewer_email: The email of the user whose viewing profiles
+                             should be returned.
+        @type viewer_email: str
+        @param profile_section_pairs: The (profile email, section name) pairs
+                                      to get viewing profiles for.
+        @type profile_section_pairs: Iterable over tuple
+        @return: Viewing profiles in the same order as the given pairs with
+                 None in place of sections the user never viewed.
+        @rtype: List of ViewingProfile or None
+        """
+        return cls.get_many_async(
+            viewer_email, profile_section_pairs).get_result()
+
+    @classmethod
+    def get_many_async(cls, viewer_email, profile_section_pairs):
+        """
+        Start getting the viewing profiles for a user on many sections.
+
+        @param viewer_email: The email of the user whose viewing profiles
+                             should be returned.
+        @type viewer_email: str
+        @param profile_section_pairs: The (profile email, section name) pairs
+                                      to get viewing profiles for.
+        @type profile_section_pairs: Iterable over tuple
+        @return: RPC whose result is the same as ViewingProfile.get_many.
+        @rtype: RPC
+        """
+        key_names = map(
+            lambda (profile_email, section_name): cls.get_key_name(
+                viewer_email, profile_email, section_name),
+            profile_section_pairs
+        )
+        return get_by_key_names_async(cls, key_names)
+
+    @classmethod
+    def migrate_key_names(cls, cursor=None):
+        """
+        Move a batch of viewing profiles saved without a key name.
+
+        Move a batch of viewing profiles saved without a key name (or under a
+        parent) to their root composite key name, merging duplicate records by
+        keeping the latest visit.
+
+        @keyword cursor: The cursor returned by the previous batch or None to
+                         start with the first batch.
+        @type cursor: str
+        @return: The number of records migrated and the cursor of the next
+                 batch or None if this was the last batch.
+        @rtype: Tuple of int and str
+        """
+        get_record_key_name = lambda x: cls.get_key_name(
+            x.viewer_email, x.profile_email, x.section_name)
+        records, next_cursor = fetch_batch(cls.all(), cursor)
+        legacy_records = filter(
+            lambda x: x.key() != db.Key.from_path(
+                cls.kind(), get_record_key_name(x)),
+            records
+        )
+
+        # Merge with records already saved under the same keys (one batch)
+        key_names = list(set(map(get_record_key_name, legacy_records)))
+        new_records = dict(zip(key_names, cls.get_by_key_name(key_names)))
+        for record in legacy_records:
+            key_name = get_record_key_name(record)
+            prior_record = new_records[key_name]
+            if not prior_record or is_later(
+                record.last_visited, prior_record.last_visited):
+                new_records[key_name] = copy_with_key_name(record, key_name)
+
+        db.put(filter(None, new_records.values()))
+        db.delete(legacy_records)
+        return (len(legacy_records), next_cursor)
 
 
 class Comment(db.Model):
-    """Data model describing a private comment left by one user for another."""
+    """
+    Data model describing a private comment left by one user for another.
 
-    author_email = db.StringProperty()
+    Data model describing a private comment left by one user for another.
+    Comments are saved in the entity group of the portfolio they were left on
+    (see get_portfolio_key) so that listing them is strongly consistent.
+    """
+
+    author_email = db.StringProperty(indexed=False)
     profile_email = db.StringProperty()
     section_name = db.StringProperty()
     contents = db.TextProperty()
     timestamp = db.DateTimeProperty()
+    rendered_html = db.TextProperty()
+
+    def get_html(self):
+        """
+        Get the HTML block displaying this comment.
+
+        @return: The HTML rendered when this comment was saved (rendered now
+                 for comments saved before HTML was stored).
+        @rtype: str
+        """
+        if self.rendered_html:
+            return self.rendered_html
+        return util.render_comment_html(
+            self.author_email, self.timestamp, self.contents)
 
     @classmethod
-    def get_for(cls, profile_user_email, section_name=None):
+    def get_for(cls, profile_user_email, section_name=None, keys_only=False):
         """
         Get private comments for the given portfolio and section.
 
@@ -123,12 +509,15 @@ class Comment(db.Model):
         @keyword section_name: The portfolio section for which private comments
                                should be returned.
         @type section_name: str
+        @keyword keys_only: If True, only the keys of the comments will be
+                            returned. Defaults to False.
+        @type keys_only: bool
         @return: Comments for the given portfolio and section sorted in reverse
                  chronological order (by timestamp field).
-        @rtype: Iterable over Comment
+        @rtype: Iterable over Comment (or db.Key)
         """
-        query = db.Query(cls)
-        query.filter("profile_email ==", profile_user_email)
+        query = db.Query(cls, keys_only=keys_only)
+        query.ancestor(get_portfolio_key(profile_user_email))
 
         if section_name != None:
             query.filter("section_name ==", section_name)
@@ -137,7 +526,34 @@ class Comment(db.Model):
         return query
 
     @classmethod
-    def get_past_date(cls, profile_user_email, timestamp, section_name=None):
+    def get_headers_past_date(cls, timestamp):
+        """
+        Get the portfolio, section and time of comments posted after a date.
+
+        Get the portfolio, section and timestamp (but not contents) of every
+        private comment posted after the given date and time on any portfolio.
+
+        @param timestamp: The date / time to start looking for comments after
+                          or None for all comments.
+        @type timestamp: datetime.datetime
+        @return: Comments with only profile_email, section_name and timestamp
+                 loaded, sorted in chronological order.
+        @rtype: Iterable over Comment
+        """
+        query = db.Query(
+            cls,
+            projection=("timestamp", "profile_email", "section_name")
+        )
+
+        if timestamp != None:
+            query.filter("timestamp >", timestamp)
+
+        query.order("timestamp")
+        return query
+
+    @classmethod
+    def get_past_date(cls, profile_user_email, timestamp, section_name=None,
+        keys_only=False):
         """
         Get private comments for a portfolio / section posted after a date.
 
@@ -153,13 +569,16 @@ class Comment(db.Model):
                                None, comments for all sections will be returned.
                                Defaults to None.
         @type section_name: str
+        @keyword keys_only: If True, only the keys of the comments will be
+                            returned. Defaults to False.
+        @type keys_only: bool
         @return: Comments posted after the given timestamp on the given
                  portfolio / section sorted in reverse chronological order (on
                  the timestamp property).
-        @rtype: Iterable over Comment
+        @rtype: Iterable over Comment (or db.Key)
         """
-        query = db.Query(cls)
-        query.filter("profile_email ==", profile_user_email)
+        query = db.Query(cls, keys_only=keys_only)
+        query.ancestor(get_portfolio_key(profile_user_email))
         query.filter("timestamp >", timestamp)
 
         if section_name != None:
@@ -169,7 +588,99 @@ class Comment(db.Model):
         return query
 
     @classmethod
-    def get_before_or_on_date(cls, profile_email, timestamp, section_name=None):
+    def count_past_date(cls, profile_email, timestamp, section_name=None,
+        limit=None):
+        """
+        Count private comments for a portfolio / section posted after a date.
+
+        Count the private comments left on a portfolio / section after a given
+        date and time with a keys-only query so that comment contents are never
+        loaded, stopping at the given limit.
+
+        @param profile_email: The email address of the user whose portfolio
+                              should be searched for comments.
+        @type profile_email: str
+        @param timestamp: The date / time to start counting comments after or
+                          None to count all comments.
+        @type timestamp: datetime.datetime
+        @keyword section_name: The name of the section to count comments on.
+                               If None, comments for all sections will be
+                               counted. Defaults to None.
+        @type section_name: str
+        @keyword limit: The maximum number of comments to count or None for no
+                        limit. Defaults to None.
+        @type limit: int
+        @return: The number of comments (up to limit).
+        @rtype: int
+        """
+        return cls.count_past_date_async(
+            profile_email, timestamp, section_name, limit).get_result()
+
+    @classmethod
+    def count_past_date_async(cls, profile_email, timestamp, section_name=None,
+        limit=None):
+        """
+        Start counting comments for a portfolio / section posted after a date.
+
+        Asynchronous version of Comment.count_past_date that starts the
+        keys-only query right away.
+
+        @param profile_email: The email address of the user whose portfolio
+                              should be searched for comments.
+        @type profile_email: str
+        @param timestamp: The date / time to start counting comments after or
+                          None to count all comments.
+        @type timestamp: datetime.datetime
+        @keyword section_name: The name of the section to count comments on.
+                               If None, comments for all sections will be
+                               counted. Defaults to None.
+        @type section_name: str
+        @keyword limit: The maximum number of comments to count or None for no
+                        limit. Defaults to None.
+        @type limit: int
+        @return: Lazy result of Comment.count_past_date.
+        @rtype: util.LazyResult
+        """
+        keys = cls.get_keys_past_date_async(
+            profile_email, timestamp, section_name, limit)
+        return util.LazyResult(lambda: len(keys))
+
+    @classmethod
+    def get_keys_past_date_async(cls, profile_email, timestamp,
+        section_name=None, limit=None):
+        """
+        Start getting the keys of comments for a portfolio posted after a date.
+
+        Start a keys-only query for the private comments left on a portfolio /
+        section after a given date and time, stopping at the given limit.
+
+        @param profile_email: The email address of the user whose portfolio
+                              should be searched for comments.
+        @type profile_email: str
+        @param timestamp: The date / time to start looking for comments after
+                          or None to get all comments.
+        @type timestamp: datetime.datetime
+        @keyword section_name: The name of the section to get comments on. If
+                               None, comments for all sections will be
+                               included. Defaults to None.
+        @type section_name: str
+        @keyword limit: The maximum number of keys to get or None for no limit.
+                        Defaults to None.
+        @type limit: int
+        @return: Lazy list of comment keys in reverse chronological order.
+        @rtype: util.LazyResult
+        """
+        if timestamp != None:
+            query = cls.get_past_date(
+                profile_email, timestamp, section_name, keys_only=True)
+        else:
+            query = cls.get_for(profile_email, section_name, keys_only=True)
+        keys = query.run(limit=limit)
+        return util.LazyResult(lambda: list(keys))
+
+    @classmethod
+    def get_before_or_on_date(cls, profile_email, timestamp, section_name=None,
+        keys_only=False):
         """
         Get private comments for a portfolio / section posted before a date.
 
@@ -185,13 +696,16 @@ class Comment(db.Model):
                              None, comments for all sections will be returned.
                              Defaults to None.
         @type section_name: str
+        @keyword keys_only: If True, only the keys of the comments will be
+                            returned. Defaults to False.
+        @type keys_only: bool
         @return: Comments posted before or on the given timestamp on the given
                  portfolio / section sorted in reverse chronological order (on
                  the timestamp property).
-        @rtype: Iterable over Comment
+        @rtype: Iterable over Comment (or db.Key)
         """
-        query = db.Query(cls)
-        query.filter("profile_email ==", profile_email)
+        query = db.Query(cls, keys_only=keys_only)
+        query.ancestor(get_portfolio_key(profile_email))
         query.filter("timestamp <=", timestamp)
 
         if section_name != None:
@@ -199,3 +713,323 @@ class Comment(db.Model):
         
         query.order("-timestamp")
         return query
+
+    @classmethod
+    def migrate_entity_groups(cls):
+        """
+        Move comments saved without a parent into their portfolio's group.
+
+        @return: The moved comments.
+        @rtype: list of Comment
+        """
+        legacy_records = filter(lambda x: x.parent_key() == None, cls.all())
+        new_records = map(
+            lambda x: copy_with_parent(x, get_portfolio_key(x.profile_email)),
+            legacy_records
+        )
+        db.put(new_records)
+        db.delete(legacy_records)
+        return new_records
+
+
+class UnreadCounter(db.Model):
+    """
+    Data model caching the number of comments a user has not read in a section.
+
+    Data model with the number of comments in a portfolio section that a user
+    has not yet read. Counters are kept up to date as comments are posted and
+    sections are viewed so that unread listings do not need to scan comments.
+    Records are keyed by UnreadCounter.get_key_name within the entity group of
+    the portfolio they count (see get_portfolio_key) so that they can be
+    updated in the same transaction as new comments.
+    """
+
+    viewer_email = db.StringProperty(indexed=False)
+    profile_email = db.StringProperty(indexed=False)
+    section_name = db.StringProperty()
+    count = db.IntegerProperty(indexed=False)
+    counted_comments = db.StringListProperty(indexed=False)
+
+    @classmethod
+    def get_key_name(cls, viewer_email, profile_email, section_name):
+        """
+        Get the key name of the counter for the given viewer and section.
+
+        @param viewer_email: The email of the user whose unread comments are
+                             counted.
+        @type viewer_email: str
+        @param profile_email: The email of the user whose portfolio the counter
+                              is for.
+        @type profile_email: str
+        @param section_name: The name of the portfolio section counted.
+        @type section_name: str
+        @return: Key name for the corresponding UnreadCounter record.
+        @rtype: str
+        """
+        return "%s|%s|%s" % (viewer_email, profile_email, section_name)
+
+    @classmethod
+    def get_key(cls, viewer_email, profile_email, section_name):
+        """
+        Get the key of the counter for the given viewer and section.
+
+        @param viewer_email: The email of the user whose unread comments are
+                             counted.
+        @type viewer_email: str
+        @param profile_email: The email of the user whose portfolio the counter
+                              is for.
+        @type profile_email: str
+        @param section_name: The name of the portfolio section counted.
+        @type section_name: str
+        @return: Key of the corresponding UnreadCounter record.
+        @rtype: db.Key
+        """
+        return db.Key.from_path(
+            cls.kind(),
+            cls.get_key_name(viewer_email, profile_email, section_name),
+            parent=get_portfolio_key(profile_email)
+        )
+
+    @classmethod
+    def create(cls, viewer_email, profile_email, section_name, count):
+        """
+        Create (but do not save) a counter for the given viewer and section.
+
+        @param viewer_email: The email of the user whose unread comments are
+                             counted.
+        @type viewer_email: str
+        @param profile_email: The email of the user whose portfolio the counter
+                              is for.
+        @type profile_email: str
+        @param section_name: The name of the portfolio section counted.
+        @type section_name: str
+        @param count: The number of unread comments in the section.
+        @type count: int
+        @return: New unsaved counter record.
+        @rtype: UnreadCounter
+        """
+        return cls(
+            key_name=cls.get_key_name(
+                viewer_email, profile_email, section_name),
+            parent=get_portfolio_key(profile_email),
+            viewer_email=viewer_email,
+            profile_email=profile_email,
+            section_name=section_name,
+            count=count
+        )
+
+    @classmethod
+    def get_for(cls, viewer_email, profile_section_pairs, single_rpc=False):
+        """
+        Get the counters for a user on many portfolio sections in one batch.
+
+        @param viewer_email: The email of the user whose counters should be
+                             returned.
+        @type viewer_email: str
+        @param profile_section_pairs: The (profile email, section name) pairs
+                                      to get counters for.
+        @type profile_section_pairs: Iterable over tuple
+        @keyword single_rpc: If True, get counters on every portfolio in one
+                             datastore call instead of concurrent calls for a
+                             few portfolios (entity groups) each. Defaults to
+                             False.
+        @type single_rpc: bool
+        @return: Counters in the same order as the given pairs with None in
+                 place of counters that do not exist yet.
+        @rtype: List of UnreadCounter or None
+        """
+        return cls.get_for_async(
+            viewer_email, profile_section_pairs, single_rpc).get_result()
+
+    @classmethod
+    def get_for_async(cls, viewer_email, profile_section_pairs,
+        single_rpc=False):
+        """
+        Start getting the counters for a user on many portfolio sections.
+
+        @param viewer_email: The email of the user whose counters should be
+                             returned.
+        @type viewer_email: str
+        @param profile_section_pairs: The (profile email, section name) pairs
+                                      to get counters for.
+        @type profile_section_pairs: Iterable over tuple
+        @keyword single_rpc: If True, get counters on every portfolio in one
+                             datastore call (see UnreadCounter.get_for).
+                             Defaults to False.
+        @type single_rpc: bool
+        @return: RPC whose result is the same as UnreadCounter.get_for.
+        @rtype: RPC
+        """
+        keys = map(
+            lambda (profile_email, section_name): cls.get_key(
+                viewer_email, profile_email, section_name),
+            profile_section_pairs
+        )
+        if single_rpc and keys:
+            return db.get_async(keys, max_entity_groups_per_rpc=len(keys))
+        return db.get_async(keys)
+
+    def add_comment(self, comment_key):
+        """
+        Count a new comment as unread unless it was already counted.
+
+        Count a new comment as unread, remembering the most recently counted
+        comments so that retried updates for the same comment are ignored.
+
+        @param comment_key: The key of the comment to count.
+        @type comment_key: db.Key
+        @return: True if the counter was changed and False if the comment was
+                 already counted.
+        @rtype: bool
+        """
+        comment_key_str = str(comment_key)
+        if comment_key_str in self.counted_comments:
+            return False
+
+        self.count += 1
+        self.set_counted_comments(self.counted_comments + [comment_key])
+        return True
+
+    def set_counted_comments(self, comment_keys):
+        """
+        Record which comments this counter already includes.
+
+        @param comment_keys: The keys of the counted comments, oldest first.
+                             Only the most recent are remembered.
+        @type comment_keys: Iterable over db.Key
+        """
+        self.counted_comments = map(str, comment_keys)[
+            -constants.COUNTED_COMMENTS_SIZE:]
+
+    @classmethod
+    def get_for_section(cls, profile_email, section_name):
+        """
+        Get all existing counters for a portfolio section across all viewers.
+
+        @param profile_email: The email of the user whose portfolio counters
+                              should be returned.
+        @type profile_email: str
+        @param section_name: The name of the section to get counters for.
+        @type section_name: str
+        @return: Counters held by any viewer for the given section.
+        @rtype: Iterable over UnreadCounter
+        """
+        query = db.Query(cls)
+        query.ancestor(get_portfolio_key(profile_email))
+        query.filter("section_name ==", section_name)
+        return query
+
+
+class PortfolioSection(db.Model):
+    """
+    Data model describing a section of student portfolios.
+
+    Data model describing a section of student portfolios that comments can
+    be left on. Records are keyed by the name of the section as it appears in
+    URLs.
+    """
+
+    title = db.StringProperty(indexed=False)
+    position = db.IntegerProperty()
+
+    @classmethod
+    def create(cls, name, title, position):
+        """
+        Create (but do not save) a portfolio section.
+
+        @param name: The name of the section as it appears in URLs.
+        @type name: str
+        @param title: The name of the section as displayed to users.
+        @type title: str
+        @param position: The order of the section relative to other sections.
+        @type position: int
+        @return: New unsaved section record.
+        @rtype: PortfolioSection
+        """
+        return cls(key_name=name, title=title, position=position)
+
+    @classmethod
+    def get_all(cls):
+        """
+        Get all portfolio sections.
+
+        @return: Every portfolio section in display order.
+        @rtype: Iterable over PortfolioSection
+        """
+        query = db.Query(cls)
+        query.order("position")
+        return query
+
+    def get_name(self):
+        """
+        Get the name of this section as it appears in URLs.
+
+        @return: The key name of this section.
+        @rtype: str
+        """
+        return self.key().name()
+
+
+class MigrationStatus(db.Model):
+    """
+    Data model recording that a data migration finished.
+
+    Data model recording that a data migration finished so that code reading
+    data saved before the migration can stop looking for it. The key name of
+    each record is the name of the migration. Completed migrations are
+    remembered by each instance.
+    """
+
+    completed = set()
+
+    @classmethod
+    def is_complete(cls, name):
+        """
+        Determine if a migration finished.
+
+        @param name: The name of the migration.
+        @type name: str
+        @return: True if the migration finished and False otherwise.
+        @rtype: bool
+        """
+        if not name in cls.completed and cls.get_by_key_name(name):
+            cls.completed.add(name)
+        return name in cls.completed
+
+    @classmethod
+    def set_complete(cls, name):
+        """
+        Record that a migration finished.
+
+        @param name: The name of the migration.
+        @type name: str
+        """
+        cls(key_name=name).put()
+        cls.completed.add(name)
+
+
+class AppSecret(db.Model):
+    """
+    Data model for a randomly generated application secret.
+
+    Data model for a secret (like a cookie signing key) generated the first
+    time it is needed and shared by all instances afterwards. The key name of
+    each record is the name of the secret.
+    """
+    value = db.StringProperty(indexed=False)
+
+    @classmethod
+    def get_value(cls, name):
+        """
+        Get the value of a secret, generating it if it does not exist yet.
+
+        @param name: The name of the secret to get.
+        @type name: str
+        @return: The hex encoded value of the requested secret.
+        @rtype: str
+        """
+        record = cls.get_or_insert(
+            name,
+            value=binascii.hexlify(os.urandom(constants.SECRET_SIZE))
+        )
+        return record.value
@@ -0,0 +1,299 @@
+"""
+New comment notifications for the EHP Portfolios Private Comments application.
+
+Publishes an event for every new comment on a portfolio so that users viewing
+that portfolio can update their unread badges without reloading the page.
+Events are delivered through a pluggable transport: MemcacheTransport (used by
+default) lets long-polling requests on any instance receive events published
+by others while LocalTransport keeps events in process for tests. Event
+sequence numbers are seeded from the time of the latest comment (in
+microseconds) so that they keep increasing even if memcache evicts them.
+
+@author: Sam Pottinger
+@license: GNU GPL v3
+"""
+
+import threading
+import time
+
+from google.appengine.api import memcache
+
+import constants
+import util
+
+
+class MemcacheTransport(object):
+    """
+    Transport keeping a short log of recent events per channel in memcache.
+
+    Transport keeping the last constants.NOTIFICATION_LOG_SIZE events of each
+    channel in memcache, numbered by a per-channel sequence that also serves
+    as the cursor of clients. A sequence evicted from memcache restarts from
+    the seed given by the caller. Waiting clients check the log every
+    constants.LONG_POLL_INTERVAL seconds. Events may be lost if memcache
+    evicts a log so clients should treat them as hints.
+    """
+
+    def get_log_key(self, channel):
+        """
+        Get the memcache key of the recent events on a channel.
+
+        @param channel: The name of the channel.
+        @type channel: str
+        @return: Memcache key holding a list of (sequence number, event) pairs.
+        @rtype: str
+        """
+        return "events_%s" % channel
+
+    def get_sequence_key(self, channel):
+        """
+        Get the memcache key of the sequence number of the latest event.
+
+        @param channel: The name of the channel.
+        @type channel: str
+        @return: Memcache key holding the sequence number.
+        @rtype: str
+        """
+        return "events_sequence_%s" % channel
+
+    def get_cursor(self, channel, get_seed=None):
+        """
+        Get a cursor after every event published on a channel so far.
+
+        @param channel: The name of the channel.
+        @type channel: str
+        @keyword get_seed: Function returning the sequence number to start
+                           from if the channel has none, at least that of the
+                           latest event published. Only called if needed.
+        @type get_seed: function
+        @return: The sequence number of the latest event.
+        @rtype: int
+        """
+        sequence_key = self.get_sequence_key(channel)
+        sequence = memcache.get(sequence_key)
+        if sequence == None:
+            seed = get_seed and get_seed() or 0
+            memcache.add(sequence_key, seed)
+            sequence = memcache.get(sequence_key) or seed
+        return sequence
+
+    def publish(self, channel, event, seed=0):
+        """
+        Add an event to a channel.
+
+        @param channel: The name of the channel.
+        @type channel: str
+        @param event: The JSON serializable event to add.
+        @type event: dict
+        @keyword seed: The sequence number to start from if the channel has
+                       none, at least that of the latest earlier event.
+        @type seed: int
+        """
+        sequence = memcache.incr(self.get_sequence_key(channel),
+            initial_value=seed)
+        log_key = self.get_log_key(channel)
+        client = memcache.Client()
+        for i in range(constants.CACHE_CAS_RETRIES):
+            events = client.gets(log_key)
+            if events == None:
+                if client.add(log_key, [(sequence, event)]):
+                    return
+            else:
+                events = (events + [(sequence, event)])[
+                    -constants.NOTIFICATION_LOG_SIZE:]
+                if client.cas(log_key, events):
+                    return
+
+    def poll(self, channel, cursor, timeout):
+        """
+        Wait for events published on a channel after a cursor.
+
+        @param channel: The name of the channel.
+        @type channel: str
+        @param cursor: The cursor returned with the last events received.
+        @type cursor: int
+        @param timeout: The maximum number of seconds to wait.
+        @type timeout: float
+        @return: The events after the cursor (empty if none were published
+                 before the timeout) and the cursor after them.
+        @rtype: Tuple of list of dict and int
+        """
+        deadline = time.time() + timeout
+        log_key = self.get_log_key(channel)
+        while True:
+            new_events = filter(
+                lambda (sequence, event): sequence > cursor,
+                memcache.get(log_key) or []
+            )
+            if new_events:
+                return (map(lambda x: x[1], new_events), new_events[-1][0])
+            if time.time() + constants.LONG_POLL_INTERVAL > deadline:
+                return ([], cursor)
+            time.sleep(constants.LONG_POLL_INTERVAL)
+
+
+class LocalTransport(object):
+    """
+    Transport keeping events in process for tests and single process servers.
+
+    Transport keeping every event in this process and waking waiting clients
+    as soon as an event is published. Events are not shared between instances
+    and are never evicted so seeds are ignored.
+    """
+
+    def __init__(self):
+        """Create a transport without any events."""
+        self.condition = threading.Condition()
+        self.sequence = 0
+        self.events = {}
+
+    def get_cursor(self, channel, get_seed=None):
+        """
+        Get a cursor after every event published on a channel so far.
+
+        @param channel: The name of the channel.
+        @type channel: str
+        @keyword get_seed: Ignored.
+        @type get_seed: function
+        @return: The sequence number of the latest event on any channel.
+        @rtype: int
+        """
+        with self.condition:
+            return self.sequence
+
+    def publish(self, channel, event, seed=0):
+        """
+        Add an event to a channel and wake clients waiting for events.
+
+        @param channel: The name of the channel.
+        @type channel: str
+        @param event: The JSON serializable event to add.
+        @type event: dict
+        @keyword seed: Ignored.
+        @type seed: int
+        """
+        with self.condition:
+            self.sequence += 1
+            self.events.setdefault(channel, []).append((self.sequence, event))
+            self.condition.notify_all()
+
+    def poll(self, channel, cursor, timeout):
+        """
+        Wait for events published on a channel after a cursor.
+
+        @param channel: The name of the channel.
+        @type channel: str
+        @param cursor: The cursor returned with the last events received.
+        @type cursor: int
+        @param timeout: The maximum number of seconds to wait.
+        @type timeout: float
+        @return: The events after the cursor (empty if none were published
+                 before the timeout) and the cursor after them.
+        @rtype: Tuple of list of dict and int
+        """
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                new_events = filter(
+                    lambda (sequence, event): sequence > cursor,
+                    self.events.get(channel, [])
+                )
+                if new_events:
+                    return (map(lambda x: x[1], new_events), new_events[-1][0])
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return ([], cursor)
+                self.condition.wait(remaining)
+
+
+# Transport delivering events (replaced by tests with a LocalTransport)
+transport = MemcacheTransport()
+
+
+def get_portfolio_channel(profile_user_email):
+    """
+    Get the name of the channel carrying events about a portfolio.
+
+    @param profile_user_email: The email address of the user whose portfolio
+                               the channel is for.
+    @type profile_user_email: str
+    @return: The name of the channel.
+    @rtype: str
+    """
+    return "portfolio_%s" % profile_user_email
+
+
+def publish_comment(comment):
+    """
+    Notify users viewing a portfolio of a new comment on it.
+
+    @param comment: The newly saved comment.
+    @type comment: models.Comment
+    """
+    transport.publish(get_portfolio_channel(comment.profile_email), {
+        "type": "new_comment",
+        "comment_key": str(comment.key()),
+        "profile_email": comment.profile_email,
+        "section_name": comment.section_name,
+        "author_email": comment.author_email
+    }, get_sequence_seed(comment.timestamp))
+
+
+def get_sequence_seed(timestamp):
+    """
+    Get the sequence number to start from after an event at the given time.
+
+    @param timestamp: The time of the latest event or None if there were none.
+    @type timestamp: datetime.datetime
+    @return: The number of microseconds since the epoch (0 if None).
+    @rtype: int
+    """
+    if timestamp == None:
+        return 0
+    return int(util.timestamp_to_token(timestamp))
+
+
+def get_portfolio_cursor(profile_user_email, get_latest_comment_time):
+    """
+    Get a cursor after every event published so far about a portfolio.
+
+    @param profile_user_email: The email address of the user whose portfolio
+                               events are about.
+    @type profile_user_email: str
+    @param get_latest_comment_time: Function taking the email address of the
+                                    user whose portfolio events are about and
+                                    returning the time of the latest comment on
+                                    it or None (see
+                                    account_facade.get_latest_comment_time).
+                                    Only called if the sequence of the
+                                    portfolio was evicted.
+    @type get_latest_comment_time: function
+    @return: Cursor to pass to wait_for_portfolio_events.
+    @rtype: int
+    """
+    return transport.get_cursor(
+        get_portfolio_channel(profile_user_email),
+        lambda: get_sequence_seed(get_latest_comment_time(profile_user_email))
+    )
+
+
+def wait_for_portfolio_events(profile_user_email, cursor,
+    timeout=constants.LONG_POLL_TIMEOUT):
+    """
+    Wait for events about a portfolio published after a cursor.
+
+    @param profile_user_email: The email address of the user whose portfolio
+                               events are about.
+    @type profile_user_email: str
+    @param cursor: The cursor returned by get_portfolio_cursor or with the
+                   last events received.
+    @type cursor: int
+    @keyword timeout: The maximum number of seconds to wait. Defaults to
+                      constants.LONG_POLL_TIMEOUT.
+    @type timeout: float
+    @return: The events after the cursor (empty if none were published
+             before the timeout) and the cursor after them.
+    @rtype: Tuple of list of dict and int
+    """
+    return transport.poll(
+        get_portfolio_channel(profile_user_email), cursor, timeout)
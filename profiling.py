@@ -0,0 +1,405 @@
+"""
+Per-request profiling for the EHP Portfolios Private Comments application.
+
+Records the wall time of a request, the number and latency of the API calls
+(datastore, memcache, etc) it makes, and the time spent in instrumented
+functions. Profiling is only enabled for requests sending the
+constants.PROFILE_HEADER header made by administrators of the application (as
+recorded in their UserInfo) or to the development server.
+
+@author: Sam Pottinger
+@license: GNU GPL v3
+"""
+
+import datetime
+import functools
+import json
+import logging
+import threading
+import time
+import types
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.api import users
+
+import account_facade
+import constants
+
+
+# Profile of the request being handled by the current thread (if any)
+local_state = threading.local()
+
+
+class RequestProfile(object):
+    """
+    Timings collected while handling a single request.
+
+    Timings collected while handling a single request. Time and API calls are
+    attributed to the stack of instrumented functions active when they happen,
+    named by joining the function names with " > ".
+    """
+
+    def __init__(self, method, path):
+        """
+        Start profiling a request.
+
+        @param method: The HTTP method of the request.
+        @type method: str
+        @param path: The path requested.
+        @type path: str
+        """
+        self.method = method
+        self.path = path
+        self.timestamp = datetime.datetime.now()
+        self.start_time = time.time()
+        self.stack = []
+        self.rpcs = {}
+        self.functions = {}
+        self.rpc_start_times = {}
+
+    def get_current_scope(self):
+        """
+        Get the name of the stack of instrumented functions running now.
+
+        @return: Names of the running functions joined by " > " or
+                 constants.PROFILE_REQUEST_SCOPE if none are running.
+        @rtype: str
+        """
+        if not self.stack:
+            return constants.PROFILE_REQUEST_SCOPE
+        return " > ".join(self.stack)
+
+    def record_rpc(self, call_name, elapsed):
+        """
+        Record a finished API call.
+
+        @param call_name: The service and method of the call (ex:
+                          datastore_v3.Get).
+        @type call_name: str
+        @param elapsed: The latency of the call in seconds.
+        @type elapsed: float
+        """
+        rpc_stats = self.rpcs.setdefault(call_name, {"count": 0, "time": 0})
+        rpc_stats["count"] += 1
+        rpc_stats["time"] += elapsed
+
+        scope = self.get_current_scope()
+        function_stats = self.get_function_stats(scope)
+        function_stats["rpcs"] += 1
+
+    def get_function_stats(self, scope):
+        """
+        Get the running totals for a stack of instrumented functions.
+
+        @param scope: The name of the stack (see get_current_scope).
+        @type scope: str
+        @return: Mutable totals with the number of calls, time spent, and
+                 API calls made.
+        @rtype: dict
+        """
+        return self.functions.setdefault(
+            scope, {"calls": 0, "time": 0, "rpcs": 0})
+
+    def to_dict(self):
+        """
+        Summarize this profile for logging and display.
+
+        @return: JSON serializable summary with times in milliseconds.
+        @rtype: dict
+        """
+        to_ms = lambda x: round(x * 1000, 2)
+        return {
+            "method": self.method,
+            "path": self.path,
+            "timestamp": self.timestamp.isoformat(),
+            "wall_ms": to_ms(time.time() - self.start_time),
+            "rpcs": sorted(
+                map(
+                    lambda (name, stats): {
+                        "name": name,
+                        "count": stats["count"],
+                        "total_ms": to_ms(stats["time"])
+                    },
+                    self.rpcs.items()
+                ),
+                key=lambda x: x["name"]
+            ),
+            "functions": sorted(
+                map(
+                    lambda (name, stats): {
+                        "name": name,
+                        "calls": stats["calls"],
+                        "total_ms": to_ms(stats["time"]),
+                        "rpcs": stats["rpcs"]
+                    },
+                    self.functions.items()
+                ),
+                key=lambda x: x["name"]
+            )
+        }
+
+
+def get_current_profile():
+    """
+    Get the profile of the request being handled by the current thread.
+
+    @return: The active profile or None if the request is not being profiled.
+    @rtype: RequestProfile
+    """
+    return getattr(local_state, "profile", None)
+
+
+def pre_call_hook(service, call, request, response, rpc):
+    """
+    API proxy hook run when an API call starts.
+
+    @param service: The name of the service called (ex: datastore_v3).
+    @type service: str
+    @param call: The name of the method called.
+    @type call: str
+    @param request: The request message.
+    @type request: ProtocolBuffer.ProtocolMessage
+    @param response: The response message.
+    @type response: ProtocolBuffer.ProtocolMessage
+    @param rpc: The RPC being made.
+    @type rpc: apiproxy_rpc.RPC
+    """
+    profile = get_current_profile()
+    if profile:
+        profile.rpc_start_times[id(rpc)] = time.time()
+
+
+def post_call_hook(service, call, request, response, rpc):
+    """
+    API proxy hook run when an API call finishes.
+
+    @param service: The name of the service called (ex: datastore_v3).
+    @type service: str
+    @param call: The name of the method called.
+    @type call: str
+    @param request: The request message.
+    @type request: ProtocolBuffer.ProtocolMessage
+    @param response: The response message.
+    @type response: ProtocolBuffer.ProtocolMessage
+    @param rpc: The RPC that was made.
+    @type rpc: apiproxy_rpc.RPC
+    """
+    profile = get_current_profile()
+    if profile:
+        start_time = profile.rpc_start_times.pop(id(rpc), None)
+        elapsed = start_time and time.time() - start_time or 0
+        profile.record_rpc("%s.%s" % (service, call), elapsed)
+
+
+def install_hooks():
+    """
+    Register the profiling hooks with the current API proxy if not already.
+
+    Register the profiling hooks with the current API proxy. The hooks are
+    registered again whenever the proxy is replaced (ex: by the testbed).
+    """
+    apiproxy = apiproxy_stub_map.apiproxy
+    apiproxy.GetPreCallHooks().Append("profiling", pre_call_hook)
+    apiproxy.GetPostCallHooks().Append("profiling", post_call_hook)
+
+
+def start_profile(method, path):
+    """
+    Start profiling the request being handled by the current thread.
+
+    @param method: The HTTP method of the request.
+    @type method: str
+    @param path: The path requested.
+    @type path: str
+    @return: The new active profile.
+    @rtype: RequestProfile
+    """
+    install_hooks()
+    local_state.profile = RequestProfile(method, path)
+    return local_state.profile
+
+
+def finish_profile(profile):
+    """
+    Stop profiling a request and report its timings.
+
+    Stop profiling a request, log its timings as JSON, and add them to the
+    recent profiles shown to administrators.
+
+    @param profile: The profile to finish.
+    @type profile: RequestProfile
+    @return: Summary of the profile (see RequestProfile.to_dict).
+    @rtype: dict
+    """
+    if get_current_profile() is profile:
+        local_state.profile = None
+
+    summary = profile.to_dict()
+    logging.info("Request profile: %s", json.dumps(summary))
+    save_recent_profile(summary)
+    return summary
+
+
+def save_recent_profile(summary):
+    """
+    Add the summary of a profiled request to the recent profiles listing.
+
+    @param summary: The summary to add (see RequestProfile.to_dict).
+    @type summary: dict
+    """
+    client = memcache.Client()
+    for i in range(constants.CACHE_CAS_RETRIES):
+        summaries = client.gets(constants.PROFILES_CACHE_KEY)
+        if summaries == None:
+            if client.add(constants.PROFILES_CACHE_KEY, [summary]):
+                return
+        else:
+            summaries = ([summary] + summaries)[:constants.NUM_RECENT_PROFILES]
+            if client.cas(constants.PROFILES_CACHE_KEY, summaries):
+                return
+
+
+def get_recent_profiles():
+    """
+    Get the summaries of the most recently profiled requests.
+
+    @return: Summaries of recent profiles, most recent first (see
+             RequestProfile.to_dict).
+    @rtype: list of dict
+    """
+    return memcache.get(constants.PROFILES_CACHE_KEY) or []
+
+
+def profile_function(function, name):
+    """
+    Wrap a function so that time spent in it is attributed to it.
+
+    @param function: The function to wrap.
+    @type function: function
+    @param name: The name to record the function's time under.
+    @type name: str
+    @return: Wrapper that records calls while the request is profiled.
+    @rtype: function
+    """
+    @functools.wraps(function)
+    def profiled_function(*args, **kwargs):
+        profile = get_current_profile()
+        if not profile:
+            return function(*args, **kwargs)
+
+        profile.stack.append(name)
+        function_stats = profile.get_function_stats(
+            profile.get_current_scope())
+        start_time = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            function_stats["calls"] += 1
+            function_stats["time"] += time.time() - start_time
+            profile.stack.pop()
+
+    profiled_function.is_profiled = True
+    return profiled_function
+
+
+def instrument_module(module):
+    """
+    Wrap every function defined in a module for profiling.
+
+    Wrap every function defined in a module (like account_facade) so that
+    time spent in it is attributed to it. Calls between functions of the same
+    module go through the wrappers too. Modules already instrumented are left
+    unchanged.
+
+    @param module: The module to instrument.
+    @type module: module
+    """
+    for name, value in vars(module).items():
+        if isinstance(value, types.FunctionType) and \
+            value.__module__ == module.__name__ and \
+            not getattr(value, "is_profiled", False):
+            setattr(module, name, profile_function(value, name))
+
+
+class ProfilingMiddleware(object):
+    """
+    WSGI middleware profiling requests that ask to be profiled.
+
+    WSGI middleware profiling requests sending the constants.PROFILE_HEADER
+    header (see is_profiling_allowed). The profile is finished once the
+    response body has been written so that lazily rendered responses are
+    included.
+    """
+
+    def __init__(self, app):
+        """
+        Wrap a WSGI application.
+
+        @param app: The application to profile.
+        @type app: WSGI application
+        """
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        """
+        Handle a request, profiling it if requested.
+
+        @param environ: The WSGI environment of the request.
+        @type environ: dict
+        @param start_response: The WSGI callable starting the response.
+        @type start_response: function
+        @return: The response body.
+        @rtype: Iterable over str
+        """
+        if not self.is_profiling_allowed(environ):
+            return self.app(environ, start_response)
+
+        profile = start_profile(
+            environ.get("REQUEST_METHOD"), environ.get("PATH_INFO"))
+        try:
+            app_iter = self.app(environ, start_response)
+        except:
+            finish_profile(profile)
+            raise
+        return self.finish_after(app_iter, profile)
+
+    def is_profiling_allowed(self, environ):
+        """
+        Determine if a request asked to be profiled and may be.
+
+        Determine if a request sent the constants.PROFILE_HEADER header and
+        was made by an administrator of the application (the same check as
+        the admin pages, see account_facade.is_admin) or to the development
+        server. Profiles slow requests down and are shown on the admin stats
+        page so other users may not trigger them.
+
+        @param environ: The WSGI environment of the request.
+        @type environ: dict
+        @return: True if the request should be profiled and False otherwise.
+        @rtype: bool
+        """
+        if not environ.get(constants.PROFILE_ENVIRON_KEY):
+            return False
+        server_software = environ.get("SERVER_SOFTWARE", "")
+        return server_software.startswith("Development") or \
+            account_facade.is_admin(users.get_current_user())
+
+    def finish_after(self, app_iter, profile):
+        """
+        Pass through a response body and finish its profile afterwards.
+
+        @param app_iter: The response body.
+        @type app_iter: Iterable over str
+        @param profile: The profile to finish after the body is written.
+        @type profile: RequestProfile
+        @return: The same response body.
+        @rtype: Iterable over str
+        """
+        try:
+            for chunk in app_iter:
+                yield chunk
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+            finish_profile(profile)
@@ -0,0 +1,173 @@
+"""
+Jinja2 template environment for the EHP Portfolios Private Comments app.
+
+@author: Sam Pottinger
+@license: GNU GPL v3
+"""
+
+import os
+
+import jinja2
+
+from jinja2 import ext
+from jinja2 import nodes
+
+from google.appengine.api import memcache
+
+import constants
+import util
+
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Templates are only checked for changes on the development server
+IS_DEV_SERVER = os.environ.get("SERVER_SOFTWARE", "").startswith("Development")
+
+# Output by {{ stream_flush }} in templates to send what is rendered so far
+STREAM_FLUSH_MARKER = "<!-- flush -->"
+
+
+class FragmentCacheExtension(ext.Extension):
+    """
+    Template extension caching rendered template fragments in memcache.
+
+    Template extension adding a {% cache key %}...{% endcache %} tag that
+    renders its body only if no fragment rendered under the same key is cached.
+    Keys should include versions of everything the fragment depends on.
+    """
+
+    tags = set(["cache"])
+
+    def parse(self, parser):
+        """
+        Parse a cache tag and its body.
+
+        @param parser: The parser reading the template.
+        @type parser: jinja2.parser.Parser
+        @return: Node rendering the body through the fragment cache.
+        @rtype: jinja2.nodes.CallBlock
+        """
+        lineno = parser.stream.next().lineno
+        args = [parser.parse_expression()]
+        body = parser.parse_statements(["name:endcache"], drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method("_get_fragment", args), [], [], body
+        ).set_lineno(lineno)
+
+    def _get_fragment(self, key, caller):
+        """
+        Get a cached fragment, rendering and caching it if not cached.
+
+        @param key: The key the fragment is cached under.
+        @type key: str
+        @param caller: Function rendering the fragment.
+        @type caller: function
+        @return: The rendered fragment.
+        @rtype: unicode
+        """
+        cache_key = "fragment_%s" % key
+        fragment = memcache.get(cache_key)
+        if fragment == None:
+            fragment = caller()
+            memcache.add(cache_key, fragment, constants.FRAGMENT_CACHE_TIME)
+        return fragment
+
+
+def create_environment(loader, bytecode_cache=None):
+    """
+    Create a jinja2 environment configured for the application's templates.
+
+    @param loader: The loader to load templates with.
+    @type loader: jinja2.BaseLoader
+    @keyword bytecode_cache: The cache for compiled templates or None for no
+                             bytecode cache.
+    @type bytecode_cache: jinja2.BytecodeCache
+    @return: Environment with the application's filters registered.
+    @rtype: jinja2.Environment
+    """
+    environment = jinja2.Environment(
+        loader=loader,
+        bytecode_cache=bytecode_cache,
+        auto_reload=IS_DEV_SERVER,
+        extensions=[FragmentCacheExtension]
+    )
+    environment.filters["unread_count"] = util.format_unread_count
+    environment.globals["stream_flush"] = STREAM_FLUSH_MARKER
+    return environment
+
+
+def generate_chunks(template, template_vals):
+    """
+    Render a template incrementally in chunks of encoded output.
+
+    Render a template with its generate method, yielding the output rendered
+    so far whenever at least constants.STREAM_CHUNK_SIZE bytes are waiting or
+    the template outputs {{ stream_flush }}. Lookups deferred with
+    util.LazyResult are only waited for when the template reaches them so
+    earlier chunks can be sent first.
+
+    @param template: The template to render.
+    @type template: jinja2.Template
+    @param template_vals: The values to render the template with.
+    @type template_vals: dict
+    @return: The UTF-8 encoded output of the template.
+    @rtype: Iterable over str
+    """
+    buffered = []
+    buffered_size = 0
+    for piece in template.generate(template_vals):
+        piece = piece.encode("utf-8")
+        buffered.append(piece)
+        buffered_size += len(piece)
+        if buffered_size >= constants.STREAM_CHUNK_SIZE or \
+            STREAM_FLUSH_MARKER in piece:
+            yield "".join(buffered)
+            buffered = []
+            buffered_size = 0
+    if buffered:
+        yield "".join(buffered)
+
+
+def create_loader():
+    """
+    Create the loader for the application's templates.
+
+    Create a loader that prefers templates precompiled into modules by
+    compile_templates.py (if present) over the template source files.
+
+    @return: Loader for the application's templates.
+    @rtype: jinja2.BaseLoader
+    """
+    compiled_templates_dir = os.path.join(
+        BASE_DIR, constants.COMPILED_TEMPLATES_DIR)
+    if IS_DEV_SERVER or not os.path.isdir(compiled_templates_dir):
+        return file_system_loader
+    return jinja2.ChoiceLoader([
+        jinja2.ModuleLoader(compiled_templates_dir),
+        file_system_loader
+    ])
+
+
+def warm_up():
+    """
+    Load every template so that later requests skip parsing / compiling.
+
+    @return: The names of the templates loaded.
+    @rtype: List of str
+    """
+    template_names = file_system_loader.list_templates()
+    for template_name in template_names:
+        jinja_environment.get_template(template_name)
+    return template_names
+
+
+# Prepare template files and loader for the jinja2 template rendering package.
+file_system_loader = jinja2.FileSystemLoader(
+    os.path.join(BASE_DIR, constants.TEMPLATES_DIR))
+jinja_environment = create_environment(
+    create_loader(),
+    jinja2.MemcachedBytecodeCache(
+        memcache.Client(),
+        prefix="jinja2_%s_" % os.environ.get("CURRENT_VERSION_ID", "")
+    )
+)
@@ -0,0 +1,321 @@
+"""
+Benchmarks for the EHP Portfolios Private Comments application.
+
+Generates synthetic cohorts of students, reviewers and comments on the testbed
+stubs and measures the latency and API calls of the application's most
+frequent operations as the cohort grows. API call counts are compared against
+those committed in BASELINE_FILE so that regressions fail. Timings depend on
+the machine running the benchmark so they are only logged. Set the
+BENCHMARK_RECORD environment variable to save new results as the baseline.
+
+@author: Sam Pottinger
+@license: GNU GPL v3
+"""
+
+import datetime
+import json
+import logging
+import os
+import unittest2
+import urllib
+
+import webapp2
+
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+import account_facade
+import constants
+import ehp_portfolios_comments
+import models
+import profiling
+import util
+from test_server import FakeUser
+
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+BASELINE_FILE = "benchmark_baseline.json"
+BASELINE_PATH = os.path.join(APP_DIR, BASELINE_FILE)
+NUM_STUDENTS = [5, 10, 20]
+NUM_REVIEWERS = 3
+COMMENTS_PER_SECTION = 2
+
+
+def generate_cohort(num_students, num_reviewers, comments_per_section):
+    """
+    Save a synthetic cohort of users along with comments on every portfolio.
+
+    Save UserInfo records for students and reviewers, comments from a
+    rotating reviewer on every section of every student's portfolio, and
+    visits by every reviewer to the first section of each portfolio made
+    before any comments were left (so that every section has unread comments).
+
+    @param num_students: The number of students (portfolios) to create.
+    @type num_students: int
+    @param num_reviewers: The number of reviewers to create.
+    @type num_reviewers: int
+    @param comments_per_section: The number of comments to leave on each
+                                 section of each portfolio.
+    @type comments_per_section: int
+    @return: The students and reviewers created.
+    @rtype: tuple of (list of FakeUser, list of FakeUser)
+    """
+    students = map(
+        lambda i: FakeUser("student.number%d@colorado.edu" % i),
+        range(num_students)
+    )
+    reviewers = map(
+        lambda i: FakeUser("reviewer.number%d@colorado.edu" % i),
+        range(num_reviewers)
+    )
+    for user in students + reviewers:
+        account_facade.ensure_user_info(user)
+    for reviewer in reviewers:
+        account_facade.make_reviewer(reviewer.email())
+
+    start_time = datetime.datetime(2013, 1, 1)
+    comments = []
+    for student_index, student in enumerate(students):
+        for section_name in constants.DEFAULT_PORTFOLIO_SECTIONS:
+            for comment_index in range(comments_per_section):
+                author = reviewers[
+                    (student_index + comment_index) % num_reviewers]
+                timestamp = start_time + datetime.timedelta(
+                    minutes=len(comments))
+                contents = "Comment %d" % comment_index
+                comments.append(models.Comment(
+                    parent=models.get_portfolio_key(student.email()),
+                    author_email=author.email(),
+                    profile_email=student.email(),
+                    section_name=section_name,
+                    contents=contents,
+                    timestamp=timestamp,
+                    rendered_html=util.render_comment_html(
+                        author.email(), timestamp, contents)
+                ))
+    db.put(comments)
+
+    section_name = constants.DEFAULT_PORTFOLIO_SECTIONS[0]
+    visit_time = start_time - datetime.timedelta(minutes=1)
+    db.put([
+        models.ViewingProfile.create(
+            reviewer.email(), student.email(), section_name, visit_time)
+        for reviewer in reviewers
+        for student in students
+    ])
+
+    return (students, reviewers)
+
+
+def measure(operation):
+    """
+    Run an operation while profiling it.
+
+    @param operation: The operation to run.
+    @type operation: function
+    @return: The wall time of the operation in milliseconds and the number of
+             API calls it made.
+    @rtype: dict
+    """
+    profile = profiling.start_profile("BENCHMARK", operation.__name__)
+    try:
+        operation()
+    finally:
+        summary = profiling.finish_profile(profile)
+    return {
+        "ms": summary["wall_ms"],
+        "rpcs": sum(map(lambda x: x["count"], summary["rpcs"]))
+    }
+
+
+def get_benchmark_operations(test_bed, students, reviewers):
+    """
+    Get the operations measured by the benchmark for a cohort.
+
+    @param test_bed: The active testbed (used to sign in the reviewer).
+    @type test_bed: testbed.Testbed
+    @param students: The students in the cohort.
+    @type students: list of FakeUser
+    @param reviewers: The reviewers in the cohort.
+    @type reviewers: list of FakeUser
+    @return: Mapping from operation name to operation.
+    @rtype: dict
+    """
+    reviewer = reviewers[0]
+    student = students[-1]
+    section_name = constants.DEFAULT_PORTFOLIO_SECTIONS[0]
+    section_path = "/portfolio/%s/section/%s" % (
+        urllib.quote(student.email(), ""), section_name)
+    test_bed.setup_env(USER_EMAIL=reviewer.email(), USER_ID="1",
+        USER_IS_ADMIN="0", overwrite=True)
+
+    def get_updated_portfolios():
+        list(account_facade.get_updated_portfolios(reviewer))
+
+    def get_updated_sections():
+        account_facade.get_updated_sections(reviewer, student.email())
+
+    def get_standard_template_dict():
+        template_vals = ehp_portfolios_comments.get_standard_template_dict(
+            account_facade.get_viewer_context(reviewer), [])
+        list(template_vals["users"])
+        list(template_vals["updated_users"])
+
+    def get_section_page():
+        response = webapp2.Request.blank(section_path).get_response(
+            ehp_portfolios_comments.app)
+        assert response.status_int == 200, response.status
+        # Render streamed bodies too
+        response.body
+
+    def post_section_comment():
+        request = webapp2.Request.blank(section_path,
+            POST={"comment-contents": "Benchmark comment"})
+        response = request.get_response(ehp_portfolios_comments.app)
+        assert response.status_int == 302, response.status
+
+    return {
+        "get_updated_portfolios": get_updated_portfolios,
+        "get_updated_sections": get_updated_sections,
+        "get_standard_template_dict": get_standard_template_dict,
+        "PortfolioContentPage.get": get_section_page,
+        "PortfolioContentPage.post": post_section_comment
+    }
+
+
+def load_baseline():
+    """
+    Load the committed API call counts of each operation.
+
+    @return: Mapping from number of students (as str) to mapping from
+             operation name to its API call count or None if no baseline has
+             been saved.
+    @rtype: dict
+    """
+    if not os.path.exists(BASELINE_PATH):
+        return None
+    with open(BASELINE_PATH) as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baseline(results):
+    """
+    Save the API call counts of benchmark results as the new baseline.
+
+    @param results: The results to save (see format_report).
+    @type results: dict
+    """
+    baseline = dict(map(
+        lambda (size, measurements): (size, dict(map(
+            lambda (operation, measurement): (operation, measurement["rpcs"]),
+            measurements.items()
+        ))),
+        results.items()
+    ))
+    with open(BASELINE_PATH, "w") as baseline_file:
+        json.dump(baseline, baseline_file, indent=4, sort_keys=True,
+            separators=(",", ": "))
+        baseline_file.write("\n")
+
+
+def format_report(results):
+    """
+    Describe how each operation scales with the number of students.
+
+    @param results: Mapping from number of students (as str) to mapping from
+                    operation name to its measurements.
+    @type results: dict
+    @return: Table with the latency and API calls of each operation per
+             cohort size.
+    @rtype: str
+    """
+    sizes = sorted(results.keys(), key=int)
+    operations = sorted(results[sizes[0]].keys())
+    lines = ["%-28s %s" % ("operation", "  ".join(map(
+        lambda x: "N=%-14s" % x, sizes)))]
+    for operation in operations:
+        lines.append("%-28s %s" % (operation, "  ".join(map(
+            lambda x: "%7.1fms %4drpc" % (results[x][operation]["ms"],
+                results[x][operation]["rpcs"]),
+            sizes
+        ))))
+    return "\n".join(lines)
+
+
+class BenchmarkTestCase(unittest2.TestCase):
+    """Test case measuring how frequent operations scale with cohort size."""
+
+    def setUp(self):
+        """Start the Google App Engine testbed and dependency injection."""
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=APP_DIR)
+        self.testbed.init_user_stub()
+        account_facade.section_cache = None
+        models.MigrationStatus.completed = set()
+
+    def tearDown(self):
+        """De-activate Google App Engine testbed and dependency injection."""
+        self.testbed.deactivate()
+
+    def reset_stubs(self):
+        """Replace the datastore, memcache and task queue with empty stubs."""
+        self.tearDown()
+        self.setUp()
+
+    def run_benchmark(self, num_students):
+        """
+        Measure every benchmark operation on a new cohort.
+
+        @param num_students: The number of students in the cohort.
+        @type num_students: int
+        @return: Mapping from operation name to its measurements (see
+                 measure). Each operation is run once untimed first so that
+                 caches are warm.
+        @rtype: dict
+        """
+        self.reset_stubs()
+        students, reviewers = generate_cohort(num_students, NUM_REVIEWERS,
+            COMMENTS_PER_SECTION)
+        operations = get_benchmark_operations(self.testbed, students,
+            reviewers)
+
+        results = {}
+        for name, operation in sorted(operations.items()):
+            operation()
+            results[name] = measure(operation)
+        return results
+
+    def test_benchmark(self):
+        """Test that operations use no more API calls than the baseline."""
+        logger = logging.getLogger()
+        log_level = logger.level
+        logger.setLevel(logging.WARNING)
+        try:
+            results = dict(map(
+                lambda x: (str(x), self.run_benchmark(x)),
+                NUM_STUDENTS
+            ))
+        finally:
+            logger.setLevel(log_level)
+        logging.info("Benchmark results:\n%s", format_report(results))
+
+        if os.environ.get("BENCHMARK_RECORD"):
+            save_baseline(results)
+            return
+
+        baseline = load_baseline()
+        if baseline == None:
+            self.fail("%s is missing. Run the benchmark with BENCHMARK_RECORD"
+                " set to save one." % BASELINE_FILE)
+
+        for size, measurements in results.items():
+            for operation, measurement in measurements.items():
+                name = "%s (N=%s)" % (operation, size)
+                expected = baseline.get(size, {}).get(operation)
+                self.assertIsNotNone(expected,
+                    "%s is missing from the baseline." % name)
+                self.assertLessEqual(measurement["rpcs"], expected,
+                    "%s made more API calls than the baseline." % name)
@@ -0,0 +1,193 @@
+"""
+Datastore index audit for the EHP Portfolios Private Comments application.
+
+Runs every query built by models and account_facade against the datastore stub
+to check that index.yaml declares exactly the composite indexes those queries
+need: no query may be missing an index and no declared index may go unused.
+
+@author: Sam Pottinger
+@license: GNU GPL v3
+"""
+
+import datetime
+import os
+import unittest2
+
+from google.appengine.datastore import datastore_index
+from google.appengine.datastore import datastore_stub_index
+from google.appengine.ext import testbed
+
+import account_facade
+import constants
+import models
+from test_server import FakeUser
+
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+INDEX_FILE = os.path.join(APP_DIR, "index.yaml")
+
+
+def run_all_queries():
+    """
+    Run every query built by models and account_facade at least once.
+
+    Save a small set of records and run every datastore query the application
+    builds against them, both directly through models and through the
+    account_facade operations that build queries of their own.
+    """
+    viewer = FakeUser("test.viewer@colorado.edu")
+    author = FakeUser("test.author@colorado.edu")
+    profile_email = author.email()
+    section_name = constants.DEFAULT_PORTFOLIO_SECTIONS[0]
+    now = datetime.datetime.now()
+
+    account_facade.ensure_user_info(viewer)
+    account_facade.ensure_user_info(author)
+    account_facade.set_viewed(viewer, profile_email, section_name)
+    account_facade.add_comment(author, profile_email, section_name, "1")
+    account_facade.add_comment(author, profile_email, section_name, "2")
+    account_facade.flush_views()
+
+    queries = [
+        models.UserInfo.get_roster(),
+        models.ViewingProfile.get_all_for(viewer.email()),
+        models.Comment.get_headers_past_date(None),
+        models.Comment.get_headers_past_date(now),
+        models.UnreadCounter.get_for_section(profile_email, section_name),
+        models.PortfolioSection.get_all(),
+        account_facade.get_account_listing()
+    ]
+    for section in [section_name, None]:
+        for keys_only in [False, True]:
+            queries.extend([
+                models.Comment.get_for(profile_email, section, keys_only),
+                models.Comment.get_past_date(
+                    profile_email, now, section, keys_only),
+                models.Comment.get_before_or_on_date(
+                    profile_email, now, section, keys_only)
+            ])
+    for query in queries:
+        query.fetch(1)
+
+    models.UserInfo.migrate_legacy_record(viewer.email())
+    account_facade.get_comments(viewer, profile_email, section_name,
+        page_size=1)
+    account_facade.get_older_comments(profile_email, now, section_name,
+        page_size=1)
+    account_facade.get_unread_counts(author, [profile_email])
+    account_facade.get_updated_portfolios(viewer)
+    account_facade.migrate_key_names()
+    account_facade.migrate_entity_groups()
+
+
+def get_index_signature(index):
+    """
+    Get a comparable description of a composite index.
+
+    @param index: The index to describe.
+    @type index: datastore_index.Index
+    @return: Tuple of the kind, whether the index includes ancestors, and the
+             (name, direction) of each indexed property.
+    @rtype: tuple
+    """
+    properties = tuple(map(
+        lambda x: (x.name, x.direction),
+        index.properties or []
+    ))
+    return (index.kind, bool(index.ancestor), properties)
+
+
+def parse_indexes(index_yaml):
+    """
+    Parse index definitions into a mapping keyed by index signature.
+
+    @param index_yaml: The contents of an index.yaml file.
+    @type index_yaml: str
+    @return: Mapping from index signature (see get_index_signature) to index.
+    @rtype: dict
+    """
+    definitions = datastore_index.ParseIndexDefinitions(index_yaml)
+    indexes = (definitions and definitions.indexes) or []
+    return dict(map(lambda x: (get_index_signature(x), x), indexes))
+
+
+def format_indexes(indexes):
+    """
+    Describe indexes in index.yaml format for assertion messages.
+
+    @param indexes: The indexes to describe.
+    @type indexes: Iterable over datastore_index.Index
+    @return: The given indexes as index.yaml contents.
+    @rtype: str
+    """
+    return datastore_index.IndexDefinitions(indexes=list(indexes)).ToYAML()
+
+
+class IndexAuditTestCase(unittest2.TestCase):
+    """Test case checking index.yaml against the application's queries."""
+
+    def setUp(self):
+        """Start the Google App Engine testbed and dependency injection."""
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=APP_DIR)
+        account_facade.section_cache = None
+        models.MigrationStatus.completed = set()
+
+    def tearDown(self):
+        """De-activate Google App Engine testbed and dependency injection."""
+        self.testbed.deactivate()
+
+    def get_required_indexes(self):
+        """
+        Determine the composite indexes needed by the application's queries.
+
+        @return: Mapping from index signature to the minimal set of composite
+                 indexes needed to run every query in run_all_queries.
+        @rtype: dict
+        """
+        self.testbed.init_datastore_v3_stub(require_indexes=False)
+        run_all_queries()
+        datastore_stub = self.testbed.get_stub(testbed.DATASTORE_SERVICE_NAME)
+        required_yaml = datastore_stub_index.GenerateIndexFromHistory(
+            datastore_stub.QueryHistory())
+        return parse_indexes("indexes:\n" + required_yaml)
+
+    def get_declared_indexes(self):
+        """
+        Read the composite indexes declared in index.yaml.
+
+        @return: Mapping from index signature to declared index.
+        @rtype: dict
+        """
+        with open(INDEX_FILE) as index_file:
+            return parse_indexes(index_file.read())
+
+    def test_queries_have_indexes(self):
+        """Test that every query runs with only the declared indexes."""
+        self.testbed.init_datastore_v3_stub(
+            require_indexes=True, root_path=APP_DIR)
+        run_all_queries()
+
+    def test_no_missing_indexes(self):
+        """Test that index.yaml declares every index needed by queries."""
+        required = self.get_required_indexes()
+        declared = self.get_declared_indexes()
+        missing = [
+            index for signature, index in required.items()
+            if not signature in declared
+        ]
+        self.assertEqual(missing, [], "Missing indexes:\n%s" %
+            format_indexes(missing))
+
+    def test_no_dead_indexes(self):
+        """Test that every index in index.yaml is used by some query."""
+        required = self.get_required_indexes()
+        declared = self.get_declared_indexes()
+        dead = [
+            index for signature, index in declared.items()
+            if not signature in required
+        ]
+        self.assertEqual(dead, [], "Dead indexes:\n%s\nMinimal index set:\n%s"
+            % (format_indexes(dead), format_indexes(required.values())))
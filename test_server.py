@@ -6,15 +6,25 @@ Unit tests for server-side logic for the EHP Portfolios Private Comments app.
 """
 
 import datetime
+import json
+import os
 import unittest2
 import urllib
+import urlparse
+
+import webapp2
 
 from google.appengine.api import memcache
 from google.appengine.ext import db
 from google.appengine.ext import testbed
 
 import account_facade
+import constants
+import ehp_portfolios_comments
 import models
+import notifications
+import profiling
+import templating
 import util
 
 
@@ -73,11 +83,49 @@ class ServerTestCase(unittest2.TestCase):
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
         self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(
+            root_path=os.path.dirname(os.path.abspath(__file__)))
+        self.taskqueue_stub = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
+        account_facade.section_cache = None
+        models.MigrationStatus.completed = set()
+        notifications.transport = notifications.LocalTransport()
 
     def tearDown(self):
         """De-activate Google App Engine testbed and dependency injection."""
         self.testbed.deactivate()
 
+    def run_comment_tasks(self):
+        """
+        Run the comment processing tasks waiting in the task queue stub.
+
+        @return: The number of tasks run.
+        @rtype: int
+        """
+        tasks = self.taskqueue_stub.get_filtered_tasks(
+            url=constants.PROCESS_COMMENT_URL)
+        for task in tasks:
+            account_facade.process_new_comment(
+                task.extract_params()["comment_key"])
+        self.taskqueue_stub.FlushQueue("default")
+        return len(tasks)
+
+    def run_counter_tasks(self):
+        """
+        Run the counter building tasks waiting in the task queue stub.
+
+        @return: The number of tasks run.
+        @rtype: int
+        """
+        tasks = self.taskqueue_stub.get_filtered_tasks(
+            url=constants.BUILD_COUNTERS_URL)
+        for task in tasks:
+            params = urlparse.parse_qs(task.payload)
+            account_facade.build_unread_counters(params["viewer_email"][0],
+                params["profile_email"])
+        self.taskqueue_stub.FlushQueue("default")
+        return len(tasks)
+
     def test_user_info(self):
         """Test the models.UserInfo data model."""
         user_1 = FakeUser("test1@test.com")
@@ -111,14 +159,18 @@ class ServerTestCase(unittest2.TestCase):
         test_timestamp_1 = datetime.datetime(2000, 1, 2)
         test_timestamp_2 = datetime.datetime(2003, 4, 5)
 
-        viewing_profile_1 = models.ViewingProfile()
+        viewing_profile_1 = models.ViewingProfile(
+            key_name=models.ViewingProfile.get_key_name(
+                user_1.email(), profile_email, section_1_name))
         viewing_profile_1.viewer_email = user_1.email()
         viewing_profile_1.profile_email = profile_email
         viewing_profile_1.section_name = section_1_name
         viewing_profile_1.last_visited = test_timestamp_1
         viewing_profile_1.put()
 
-        viewing_profile_2 = models.ViewingProfile()
+        viewing_profile_2 = models.ViewingProfile(
+            key_name=models.ViewingProfile.get_key_name(
+                user_2.email(), profile_email, None))
         viewing_profile_2.viewer_email = user_2.email()
         viewing_profile_2.profile_email = profile_email
         viewing_profile_2.setion_name = section_2_name
@@ -134,6 +186,7 @@ class ServerTestCase(unittest2.TestCase):
             viewing_profile_1.last_visited)
         self.assertEqual(ret_profile_2.last_visited,
             None)
+        self.assertEqual(models.ViewingProfile.all().count(), 2)
 
     def test_comment(self):
         """Test the models.Comment data model."""
@@ -148,7 +201,8 @@ class ServerTestCase(unittest2.TestCase):
         test_timestamp_2 = datetime.datetime(2003, 4, 5)
         test_divisor_timestamp = datetime.datetime(2001, 4, 5)
 
-        test_comment_1 = models.Comment()
+        test_comment_1 = models.Comment(
+            parent=models.get_portfolio_key(profile_email))
         test_comment_1.author_email = user_1.email()
         test_comment_1.profile_email = profile_email
         test_comment_1.section_name = section_1_name
@@ -156,7 +210,8 @@ class ServerTestCase(unittest2.TestCase):
         test_comment_1.timestamp = test_timestamp_1
         test_comment_1.put()
 
-        test_comment_2 = models.Comment()
+        test_comment_2 = models.Comment(
+            parent=models.get_portfolio_key(profile_email))
         test_comment_2.author_email = user_2.email()
         test_comment_2.profile_email = profile_email
         test_comment_2.section_name = section_2_name
@@ -181,6 +236,28 @@ class ServerTestCase(unittest2.TestCase):
         self.assertEqual(result_1.timestamp, test_timestamp_1)
         self.assertEqual(result_2.timestamp, test_timestamp_2)
 
+    def test_count_comments(self):
+        """Test counting comments without loading them."""
+        user_1 = FakeUser("test1@test.com")
+        profile_email = "safe_email"
+        section_name = constants.DEFAULT_PORTFOLIO_SECTIONS[0]
+
+        for contents in ["1", "2", "3"]:
+            account_facade.add_comment(user_1, profile_email, section_name,
+                contents)
+
+        self.assertEqual(models.Comment.count_past_date(profile_email, None,
+            section_name), 3)
+        self.assertEqual(models.Comment.count_past_date(profile_email, None,
+            section_name, limit=2), 2)
+        self.assertEqual(models.Comment.count_past_date(profile_email,
+            datetime.datetime.now(), section_name), 0)
+
+        self.assertEqual(util.format_unread_count(5), "5")
+        self.assertEqual(util.format_unread_count(
+            constants.UNREAD_COUNT_CAP + 1),
+            "%d+" % constants.UNREAD_COUNT_CAP)
+
     def test_is_reviewer(self):
         """Test recording / reporting user access control permissions."""
         user_1 = FakeUser("test1@test.com")
@@ -201,6 +278,32 @@ class ServerTestCase(unittest2.TestCase):
         self.assertFalse(account_facade.is_reviewer(user_1))
         self.assertTrue(account_facade.is_reviewer(user_2))
 
+    def test_viewer_context(self):
+        """Test resolving the identity of a user once for many checks."""
+        user_1 = FakeUser("test1@test.com")
+        user_2 = FakeUser("test2@test.com")
+
+        user_info_1 = models.UserInfo(key_name=user_1.email())
+        user_info_1.email = user_1.email()
+        user_info_1.is_reviewer = True
+        user_info_1.is_admin = False
+        user_info_1.put()
+
+        viewer = account_facade.get_viewer_context(user_1)
+        self.assertIs(account_facade.get_viewer_context(viewer), viewer)
+        self.assertEqual(viewer.email(), user_1.email())
+        self.assertTrue(account_facade.is_reviewer(viewer))
+        self.assertFalse(account_facade.is_admin(viewer))
+        self.assertTrue(account_facade.viewer_has_access(viewer,
+            user_1.email()))
+        self.assertFalse(account_facade.viewer_has_access(viewer,
+            user_2.email()))
+
+        anonymous = account_facade.get_viewer_context(None)
+        self.assertFalse(anonymous.is_reviewer)
+        self.assertFalse(account_facade.viewer_has_access(anonymous,
+            user_1.email()))
+
     def test_ensure_user_info(self):
         """Test creation logic for the a models.UserInfo data model."""
         user_1 = FakeUser("test1@test.com")
@@ -220,6 +323,29 @@ class ServerTestCase(unittest2.TestCase):
         self.assertEqual(ret_info_2.email, user_2.email())
         self.assertFalse(ret_info_2.is_reviewer)
 
+    def test_roster(self):
+        """Test caching the listing of users shown in the sidebar."""
+        user_1 = FakeUser("first.last@colorado.edu")
+        user_2 = FakeUser("other.person@colorado.edu")
+
+        account_facade.ensure_user_info(user_1)
+        roster_version = account_facade.get_roster_version()
+        roster = account_facade.get_roster()
+        self.assertEqual(map(lambda x: x.email, roster), [user_1.email()])
+
+        account_facade.ensure_user_info(user_2)
+        self.assertNotEqual(account_facade.get_roster_version(),
+            roster_version)
+        roster = account_facade.get_roster()
+        self.assertEqual(map(lambda x: x.last_name, roster),
+            ["Last", "Person"])
+
+        roster_version = account_facade.get_roster_version()
+        account_facade.make_reviewer(user_2.email())
+        self.assertNotEqual(account_facade.get_roster_version(),
+            roster_version)
+        self.assertTrue(account_facade.is_reviewer(user_2))
+
     def test_viewer_has_access(self):
         """Test checking user access control permissions.""" 
         user_1 = FakeUser("test1@test.com")
@@ -262,7 +388,8 @@ class ServerTestCase(unittest2.TestCase):
         test_timestamp_2 = datetime.datetime(2003, 4, 5)
         viewing_timestamp = datetime.datetime(2001, 4, 5)
 
-        test_comment_1 = models.Comment()
+        test_comment_1 = models.Comment(
+            parent=models.get_portfolio_key(profile_email))
         test_comment_1.author_email = user_1.email()
         test_comment_1.profile_email = profile_email
         test_comment_1.section_name = section_1_name
@@ -270,7 +397,8 @@ class ServerTestCase(unittest2.TestCase):
         test_comment_1.timestamp = test_timestamp_1
         test_comment_1.put()
 
-        test_comment_2 = models.Comment()
+        test_comment_2 = models.Comment(
+            parent=models.get_portfolio_key(profile_email))
         test_comment_2.author_email = user_2.email()
         test_comment_2.profile_email = profile_email
         test_comment_2.section_name = section_2_name
@@ -278,7 +406,9 @@ class ServerTestCase(unittest2.TestCase):
         test_comment_2.timestamp = test_timestamp_2
         test_comment_2.put()
 
-        viewing_profile = models.ViewingProfile()
+        viewing_profile = models.ViewingProfile(
+            key_name=models.ViewingProfile.get_key_name(
+                user_1.email(), profile_email, section_1_name))
         viewing_profile.viewer_email = user_1.email()
         viewing_profile.profile_email = profile_email
         viewing_profile.section_name = section_1_name
@@ -293,6 +423,295 @@ class ServerTestCase(unittest2.TestCase):
         self.assertEqual(old_msgs.count(), 1)
         self.assertEqual(old_msgs.get().contents, contents_1)
 
+    def test_unread_version(self):
+        """Test versioning unread counters for cached page fragments."""
+        user_1 = FakeUser("test1@test.com")
+        user_2 = FakeUser("test2@test.com")
+        profile_email = "safe_email"
+        section_name = constants.DEFAULT_PORTFOLIO_SECTIONS[0]
+
+        account_facade.set_viewed(user_1, profile_email, section_name)
+        version_1 = account_facade.get_unread_version(user_1, profile_email)
+        account_facade.set_viewed(user_1, profile_email, section_name)
+        version_2 = account_facade.get_unread_version(user_1, profile_email)
+        self.assertEqual(version_1, version_2)
+
+        # Changed as soon as the comment is saved, before its task runs
+        account_facade.add_comment(user_2, profile_email, section_name, "1")
+        version_3 = account_facade.get_unread_version(user_1, profile_email)
+        self.assertNotEqual(version_2, version_3)
+        self.run_comment_tasks()
+
+        account_facade.set_viewed(user_1, profile_email, section_name)
+        version_4 = account_facade.get_unread_version(user_1, profile_email)
+        self.assertNotEqual(version_3, version_4)
+
+    def test_portfolio_etag(self):
+        """Test tagging portfolio pages so unchanged pages are not resent."""
+        user_1 = FakeUser("test1@test.com")
+        user_2 = FakeUser("test2@test.com")
+        profile_email = "safe_email"
+        section_name = constants.DEFAULT_PORTFOLIO_SECTIONS[0]
+        account_facade.ensure_user_info(user_1)
+        account_facade.make_reviewer(user_1.email())
+        viewer = account_facade.get_viewer_context(user_1)
+
+        etag_1 = account_facade.get_portfolio_etag(
+            viewer, profile_email, section_name)
+        self.assertEqual(etag_1, account_facade.get_portfolio_etag(
+            viewer, profile_email, section_name))
+
+        comment = account_facade.add_comment(
+            user_2, profile_email, section_name, "1")
+        etag_2 = account_facade.get_portfolio_etag(
+            viewer, profile_email, section_name)
+        self.assertNotEqual(etag_1, etag_2)
+        self.assertEqual(account_facade.get_latest_comment_time(
+            profile_email), comment.timestamp)
+
+        # Repeat visits share an ETag once every comment has been read
+        account_facade.set_viewed(viewer, profile_email, section_name)
+        etag_3 = account_facade.get_portfolio_etag(
+            viewer, profile_email, section_name)
+        self.assertNotEqual(etag_2, etag_3)
+        account_facade.set_viewed(viewer, profile_email, section_name)
+        self.assertEqual(etag_3, account_facade.get_portfolio_etag(
+            viewer, profile_email, section_name))
+
+        memcache.delete(account_facade.get_latest_comment_key(profile_email))
+        self.assertEqual(etag_3, account_facade.get_portfolio_etag(
+            viewer, profile_email, section_name))
+
+        # The latest comment marker never moves back when tasks are retried
+        self.run_comment_tasks()
+        account_facade.mark_portfolio_modified(
+            profile_email, datetime.datetime(2000, 1, 2))
+        self.assertEqual(account_facade.get_latest_comment_time(
+            profile_email), comment.timestamp)
+
+    def test_unread_update(self):
+        """Test polling for unread counts changed since a token."""
+        user_1 = FakeUser("first.reviewer@colorado.edu")
+        user_2 = FakeUser("first.student@colorado.edu")
+        section_name = constants.DEFAULT_PORTFOLIO_SECTIONS[0]
+        account_facade.ensure_user_info(user_1)
+        account_facade.ensure_user_info(user_2)
+        account_facade.make_reviewer(user_1.email())
+        account_facade.set_viewed(user_1, user_2.email(), section_name)
+
+        update_1 = account_facade.get_unread_update(user_1)
+        self.assertEqual(update_1.unread_counts[user_2.email()], {})
+        update_2 = account_facade.get_unread_update(user_1, update_1.token)
+        self.assertEqual(update_2, (update_1.token, None))
+
+        account_facade.add_comment(user_2, user_2.email(), section_name, "1")
+        update_3 = account_facade.get_unread_update(user_1, update_1.token)
+        self.assertNotEqual(update_3.token, update_1.token)
+        self.assertEqual(update_3.unread_counts[user_2.email()],
+            {section_name: 1})
+
+        account_facade.set_viewed(user_1, user_2.email(), section_name)
+        update_4 = account_facade.get_unread_update(user_1, update_3.token)
+        self.assertEqual(update_4.unread_counts[user_2.email()], {})
+
+        # Students only see their own portfolio
+        update_5 = account_facade.get_unread_update(user_2)
+        self.assertEqual(update_5.unread_counts.keys(), [user_2.email()])
+
+        # Adding a section changes the token
+        account_facade.save_portfolio_section("capstone", "Capstone", -1)
+        update_6 = account_facade.get_unread_update(user_1, update_4.token)
+        self.assertNotEqual(update_6.token, update_4.token)
+
+        # Users without a portfolio get no counts and no counters
+        user_3 = FakeUser("no.portfolio@colorado.edu")
+        num_counters = models.UnreadCounter.all().count()
+        update_7 = account_facade.get_unread_update(user_3)
+        self.assertEqual(update_7.unread_counts, {})
+        self.assertEqual(models.UnreadCounter.all().count(), num_counters)
+
+        # Unchanged polls are answered without loading the user's records
+        self.testbed.setup_env(USER_EMAIL=user_1.email(), USER_ID="1",
+            overwrite=True)
+        response = webapp2.Request.blank("/api/unread").get_response(
+            ehp_portfolios_comments.app)
+        since = json.loads(response.body)["since"]
+        profile = profiling.start_profile("GET", "/api/unread")
+        response = webapp2.Request.blank(
+            "/api/unread?" + urllib.urlencode({"since": since})).get_response(
+                ehp_portfolios_comments.app)
+        rpcs = profiling.finish_profile(profile)["rpcs"]
+        self.assertEqual(json.loads(response.body),
+            {"since": since, "changed": False, "portfolios": {}})
+        self.assertEqual(map(lambda x: x["name"], rpcs), ["memcache.Get"])
+
+        self.testbed.setup_env(USER_EMAIL=user_3.email(), USER_ID="3",
+            overwrite=True)
+        response = webapp2.Request.blank("/api/unread").get_response(
+            ehp_portfolios_comments.app)
+        self.assertEqual(response.status_int, 404)
+        self.testbed.setup_env(USER_EMAIL="", USER_ID="", overwrite=True)
+        response = webapp2.Request.blank("/api/unread").get_response(
+            ehp_portfolios_comments.app)
+        self.assertEqual(response.status_int, 403)
+
+    def test_notifications(self):
+        """Test notifying viewers of a portfolio of new comments."""
+        user_1 = FakeUser("test1@test.com")
+        profile_email = "safe_email"
+        section_name = constants.DEFAULT_PORTFOLIO_SECTIONS[0]
+
+        cursor_1 = notifications.get_portfolio_cursor(profile_email,
+            lambda x: None)
+        self.assertEqual(notifications.wait_for_portfolio_events(
+            profile_email, cursor_1, 0), ([], cursor_1))
+
+        comment = account_facade.add_comment(
+            user_1, profile_email, section_name, "1")
+        self.run_comment_tasks()
+        events, cursor_2 = notifications.wait_for_portfolio_events(
+            profile_email, cursor_1, 0)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]["comment_key"], str(comment.key()))
+        self.assertEqual(events[0]["section_name"], section_name)
+        self.assertEqual(notifications.wait_for_portfolio_events(
+            profile_email, cursor_2, 0), ([], cursor_2))
+        self.assertEqual(notifications.wait_for_portfolio_events(
+            "other_email", cursor_1, 0), ([], cursor_1))
+
+        transport = notifications.MemcacheTransport()
+        cursor_3 = transport.get_cursor("channel")
+        transport.publish("channel", {"event": 1})
+        transport.publish("channel", {"event": 2})
+        events, cursor_4 = transport.poll("channel", cursor_3, 0)
+        self.assertEqual(events, [{"event": 1}, {"event": 2}])
+        self.assertEqual(transport.poll("channel", cursor_4, 0),
+            ([], cursor_4))
+
+        # Sequences evicted from memcache restart after the latest comment
+        latest_comment_time = datetime.datetime(2013, 1, 1)
+        seed = notifications.get_sequence_seed(latest_comment_time)
+        self.assertGreater(seed, cursor_4)
+        memcache.flush_all()
+        self.assertEqual(transport.get_cursor("channel", lambda: seed), seed)
+        transport.publish("channel", {"event": 3}, seed)
+        self.assertEqual(transport.poll("channel", cursor_4, 0),
+            ([{"event": 3}], seed + 1))
+
+    def test_flash_messages(self):
+        """Test passing flash messages between page loads through cookies."""
+        account_facade.flash_cookie_serializer = None
+        messages = [
+            account_facade.FlashMessage(
+                constants.FLASH_MSG_TYPE_CONFIRMATION, "test_message"),
+            account_facade.FlashMessage(constants.FLASH_MSG_TYPE_ERR, "2")
+        ]
+
+        cookie_value = account_facade.encode_flash_messages(messages)
+        self.assertLessEqual(
+            len(cookie_value), constants.FLASH_COOKIE_MAX_SIZE)
+        self.assertEqual(
+            account_facade.decode_flash_messages(cookie_value), messages)
+
+        large_messages = [
+            account_facade.FlashMessage(
+                constants.FLASH_MSG_TYPE_ERR,
+                "x" * constants.FLASH_COOKIE_MAX_SIZE
+            )
+        ]
+        cookie_value = account_facade.encode_flash_messages(large_messages)
+        self.assertLessEqual(
+            len(cookie_value), constants.FLASH_COOKIE_MAX_SIZE)
+        self.assertEqual(
+            account_facade.decode_flash_messages(cookie_value), large_messages)
+        self.assertEqual(account_facade.decode_flash_messages(cookie_value), [])
+
+        self.assertEqual(account_facade.decode_flash_messages(None), [])
+        self.assertEqual(
+            account_facade.decode_flash_messages(cookie_value + "x"), [])
+
+    def test_comment_cache(self):
+        """Test splitting cached comments into new and old comments."""
+        user_1 = FakeUser("test1@test.com")
+        user_2 = FakeUser("test2@test.com")
+        profile_email = "safe_email"
+        section_name = constants.DEFAULT_PORTFOLIO_SECTIONS[0]
+
+        account_facade.add_comment(user_2, profile_email, section_name, "1")
+        account_facade.set_viewed(user_1, profile_email, section_name)
+        account_facade.add_comment(user_2, profile_email, section_name, "2")
+        self.run_comment_tasks()
+
+        cached_comments = memcache.get(account_facade.get_comment_cache_key(
+            profile_email, section_name))
+        self.assertEqual(map(lambda x: x.contents, cached_comments),
+            ["2", "1"])
+
+        listing = account_facade.get_comments(user_1, profile_email,
+            section_name)
+        self.assertEqual(map(lambda x: x.contents, listing.new_comments),
+            ["2"])
+        self.assertEqual(map(lambda x: x.contents, listing.old_comments),
+            ["1"])
+        self.assertEqual(listing.older_cursor, None)
+        self.assertEqual(listing.new_comments[0].get_html(),
+            util.render_comment_html(user_2.email(),
+                listing.new_comments[0].timestamp, "2"))
+
+    def test_comment_visible_after_post(self):
+        """Test that a posted comment is listed before its task runs."""
+        user_1 = FakeUser("test1@test.com")
+        profile_email = "safe_email"
+        section_name = constants.DEFAULT_PORTFOLIO_SECTIONS[0]
+
+        account_facade.add_comment(user_1, profile_email, section_name, "1")
+        self.run_comment_tasks()
+        account_facade.get_comments(user_1, profile_email, section_name)
+        account_facade.get_comments(user_1, profile_email, None)
+
+        # Both listings are cached now, so a stale cache would hide "2"
+        account_facade.add_comment(user_1, profile_email, section_name, "2")
+        for listed_section in [section_name, None]:
+            listing = account_facade.get_comments(user_1, profile_email,
+                listed_section)
+            contents = map(lambda x: x.contents,
+                listing.new_comments + listing.old_comments)
+            self.assertEqual(contents, ["2", "1"])
+
+        self.assertEqual(self.run_comment_tasks(), 1)
+        listing = account_facade.get_comments(user_1, profile_email,
+            section_name)
+        self.assertEqual(len(listing.new_comments + listing.old_comments), 2)
+
+    def test_older_comments(self):
+        """Test paging through comments seen before the last visit."""
+        user_1 = FakeUser("test1@test.com")
+        user_2 = FakeUser("test2@test.com")
+        profile_email = "safe_email"
+        section_name = constants.DEFAULT_PORTFOLIO_SECTIONS[0]
+
+        for contents in ["1", "2", "3"]:
+            account_facade.add_comment(user_2, profile_email, section_name,
+                contents)
+        account_facade.set_viewed(user_1, profile_email, section_name)
+
+        listing = account_facade.get_comments(user_1, profile_email,
+            section_name, page_size=2)
+        self.assertEqual(listing.new_comments, [])
+        self.assertEqual(map(lambda x: x.contents, listing.old_comments),
+            ["3", "2"])
+        self.assertNotEqual(listing.older_cursor, None)
+
+        comments, cursor = account_facade.get_older_comments(profile_email,
+            listing.last_visited, section_name, listing.older_cursor,
+            page_size=2)
+        self.assertEqual(map(lambda x: x.contents, comments), ["1"])
+        self.assertEqual(cursor, None)
+
+        last_visited = util.token_to_timestamp(
+            util.timestamp_to_token(listing.last_visited))
+        self.assertEqual(last_visited, listing.last_visited)
+
     def test_get_updated_sections(self):
         """Test listing of unread comments / updated portfolio sections."""
         user_1 = FakeUser("test1@test.com")
@@ -306,7 +725,8 @@ class ServerTestCase(unittest2.TestCase):
         test_timestamp_2 = datetime.datetime(2003, 4, 5)
         viewing_timestamp = datetime.datetime(2001, 4, 5)
 
-        test_comment_1 = models.Comment()
+        test_comment_1 = models.Comment(
+            parent=models.get_portfolio_key(profile_email))
         test_comment_1.author_email = user_1.email()
         test_comment_1.profile_email = profile_email
         test_comment_1.section_name = section_1_name
@@ -314,7 +734,8 @@ class ServerTestCase(unittest2.TestCase):
         test_comment_1.timestamp = test_timestamp_1
         test_comment_1.put()
 
-        test_comment_2 = models.Comment()
+        test_comment_2 = models.Comment(
+            parent=models.get_portfolio_key(profile_email))
         test_comment_2.author_email = user_2.email()
         test_comment_2.profile_email = profile_email
         test_comment_2.section_name = section_2_name
@@ -322,7 +743,9 @@ class ServerTestCase(unittest2.TestCase):
         test_comment_2.timestamp = test_timestamp_2
         test_comment_2.put()
 
-        viewing_profile = models.ViewingProfile()
+        viewing_profile = models.ViewingProfile(
+            key_name=models.ViewingProfile.get_key_name(
+                user_1.email(), profile_email, section_1_name))
         viewing_profile.viewer_email = user_1.email()
         viewing_profile.profile_email = profile_email
         viewing_profile.section_name = section_1_name
@@ -334,6 +757,32 @@ class ServerTestCase(unittest2.TestCase):
         self.assertIn(section_2_name, updated_listing)
         self.assertEqual(updated_listing[section_2_name], 1)
 
+    def test_get_unread_dashboard(self):
+        """Test counting unread comments across portfolios in one pass."""
+        user_1 = FakeUser("test1@test.com")
+        user_2 = FakeUser("test2@test.com")
+        section_1_name = constants.DEFAULT_PORTFOLIO_SECTIONS[0]
+        section_2_name = constants.DEFAULT_PORTFOLIO_SECTIONS[1]
+
+        account_facade.add_comment(user_2, user_1.email(), section_1_name,
+            "1")
+        account_facade.add_comment(user_1, user_2.email(), section_1_name,
+            "2")
+        account_facade.add_comment(user_1, user_2.email(), section_2_name,
+            "3")
+        account_facade.set_viewed(user_1, user_2.email(), section_2_name)
+
+        dashboard = account_facade.get_unread_dashboard(user_1,
+            [user_1.email(), user_2.email()])
+        self.assertEqual(dashboard[user_1.email()], {section_1_name: 1})
+        self.assertEqual(dashboard[user_2.email()], {section_1_name: 1})
+
+        # Users who never visited any section are counted without a scan
+        dashboard = account_facade.get_unread_dashboard(
+            FakeUser("test3@test.com"), [user_2.email()])
+        self.assertEqual(dashboard[user_2.email()],
+            {section_1_name: 1, section_2_name: 1})
+
     def test_set_viewed(self):
         """Test indicating that a user viewed a portfolio section."""
         user_1 = FakeUser("test1@test.com")
@@ -342,7 +791,9 @@ class ServerTestCase(unittest2.TestCase):
         viewing_timestamp = datetime.datetime(2001, 4, 5)
         profile_email = "safe_email"
 
-        viewing_profile = models.ViewingProfile()
+        viewing_profile = models.ViewingProfile(
+            key_name=models.ViewingProfile.get_key_name(
+                user_1.email(), profile_email, section_1_name))
         viewing_profile.viewer_email = user_1.email()
         viewing_profile.profile_email = profile_email
         viewing_profile.section_name = section_1_name
@@ -350,18 +801,424 @@ class ServerTestCase(unittest2.TestCase):
         viewing_profile.put()
 
         account_facade.set_viewed(user_1, profile_email, section_1_name)
+        account_facade.flush_views()
 
         updated_viewing_profile = models.ViewingProfile.get_for(
             user_1, profile_email, section_1_name)
         self.assertTrue(
             viewing_timestamp != updated_viewing_profile.last_visited)
 
+    def test_buffered_views(self):
+        """Test buffering and coalescing views before saving them."""
+        user_1 = FakeUser("test1@test.com")
+        profile_email = "safe_email"
+        section_name = constants.DEFAULT_PORTFOLIO_SECTIONS[0]
+        pairs = [(profile_email, section_name), (profile_email, None)]
+
+        account_facade.set_viewed(user_1, profile_email, section_name)
+        account_facade.set_viewed(user_1, profile_email, None)
+        account_facade.set_viewed(user_1, profile_email, section_name)
+
+        self.assertEqual(models.ViewingProfile.get_many(user_1.email(),
+            pairs), [None, None])
+        last_visits = account_facade.get_last_visits(user_1.email(), pairs)
+        self.assertNotIn(None, last_visits)
+
+        tasks = self.taskqueue_stub.get_filtered_tasks(
+            queue_names=constants.VIEWS_QUEUE_NAME)
+        self.assertEqual(len(tasks), 1)
+
+        self.assertEqual(account_facade.flush_views(), 2)
+        self.assertEqual(account_facade.flush_views(), 0)
+        viewing_profiles = models.ViewingProfile.get_many(user_1.email(),
+            pairs)
+        self.assertEqual(map(lambda x: x.last_visited, viewing_profiles),
+            last_visits)
+
+        # Saved views are read back once the buffer is gone
+        memcache.flush_all()
+        self.assertEqual(account_facade.get_last_visits(user_1.email(),
+            pairs), last_visits)
+        self.assertEqual(models.ViewingProfile.get_for(user_1, profile_email,
+            section_name).last_visited, last_visits[0])
+
+        account_facade.set_viewed(user_1, profile_email, None)
+        tasks = self.taskqueue_stub.get_filtered_tasks(
+            queue_names=constants.VIEWS_QUEUE_NAME)
+        self.assertEqual(len(tasks), 1)
+
+    def test_unread_counters(self):
+        """Test maintenance of unread comment counters."""
+        user_1 = FakeUser("test1@test.com")
+        user_2 = FakeUser("test2@test.com")
+        profile_email = "safe_email"
+        section_name = constants.DEFAULT_PORTFOLIO_SECTIONS[0]
+
+        account_facade.add_comment(user_2, profile_email, section_name, "1")
+
+        updated_listing = account_facade.get_updated_sections(user_1,
+            profile_email)
+        self.assertEqual(updated_listing, {section_name: 1})
+        counter_key = models.UnreadCounter.get_key(user_1.email(),
+            profile_email, section_name)
+        self.assertEqual(models.UnreadCounter.get(counter_key), None)
+
+        account_facade.get_updated_sections(user_1, profile_email)
+        self.assertEqual(self.run_counter_tasks(), 1)
+        self.assertEqual(models.UnreadCounter.get(counter_key).count, 1)
+
+        account_facade.add_comment(user_2, profile_email, section_name, "2")
+        self.run_comment_tasks()
+        counter = models.UnreadCounter.get(
+            models.UnreadCounter.get_key(
+                user_1.email(), profile_email, section_name))
+        self.assertEqual(counter.count, 2)
+
+        account_facade.set_viewed(user_1, profile_email, section_name)
+        updated_listing = account_facade.get_updated_sections(user_1,
+            profile_email)
+        self.assertEqual(updated_listing, {})
+
+    def test_process_comment(self):
+        """Test saving new comments and processing them in a task."""
+        user_1 = FakeUser("test1@test.com")
+        user_2 = FakeUser("test2@test.com")
+        profile_email = "safe_email"
+        section_name = constants.DEFAULT_PORTFOLIO_SECTIONS[0]
+
+        account_facade.set_viewed(user_1, profile_email, section_name)
+        comment = account_facade.add_comment(user_2, profile_email,
+            section_name, "1")
+        self.assertEqual(comment.parent_key(),
+            models.get_portfolio_key(profile_email))
+
+        counter = models.UnreadCounter.get(models.UnreadCounter.get_key(
+            user_1.email(), profile_email, section_name))
+        self.assertEqual(counter.count, 1)
+        self.assertFalse(counter.add_comment(comment.key()))
+
+        tasks = self.taskqueue_stub.get_filtered_tasks(
+            url=constants.PROCESS_COMMENT_URL)
+        self.assertEqual(len(tasks), 1)
+        self.assertEqual(tasks[0].extract_params()["comment_key"],
+            str(comment.key()))
+
+        self.assertTrue(account_facade.process_new_comment(comment.key()))
+        self.assertTrue(account_facade.process_new_comment(comment.key()))
+        cached_comments = memcache.get(account_facade.get_comment_cache_key(
+            profile_email, section_name))
+        self.assertEqual(map(lambda x: x.key(), cached_comments),
+            [comment.key()])
+
+        comment.delete()
+        self.assertFalse(account_facade.process_new_comment(comment.key()))
+
+    def test_migrate_entity_groups(self):
+        """Test moving comments saved without a parent to their portfolio."""
+        user_1 = FakeUser("test1@test.com")
+        profile_email = "safe_email"
+        section_name = constants.DEFAULT_PORTFOLIO_SECTIONS[0]
+
+        legacy_comment = models.Comment()
+        legacy_comment.author_email = user_1.email()
+        legacy_comment.profile_email = profile_email
+        legacy_comment.section_name = section_name
+        legacy_comment.contents = "1"
+        legacy_comment.timestamp = datetime.datetime(2000, 1, 2)
+        legacy_comment.put()
+        models.UnreadCounter(
+            key_name=models.UnreadCounter.get_key_name(
+                user_1.email(), profile_email, section_name),
+            viewer_email=user_1.email(),
+            profile_email=profile_email,
+            section_name=section_name,
+            count=1
+        ).put()
+
+        self.assertEqual(models.Comment.get_for(profile_email).count(), 0)
+        self.assertEqual(account_facade.migrate_entity_groups(), 1)
+        self.assertEqual(account_facade.migrate_entity_groups(), 0)
+
+        comments = models.Comment.get_for(profile_email, section_name).fetch(2)
+        self.assertEqual(map(lambda x: x.contents, comments), ["1"])
+        self.assertEqual(models.Comment.all().count(), 1)
+        self.assertEqual(models.UnreadCounter.all().count(), 0)
+
+    def test_migrate_key_names(self):
+        """Test moving records saved without key names to their keys."""
+        user_1 = FakeUser("test1@test.com")
+        profile_email = "safe_email"
+        section_1_name = "section1"
+        test_timestamp_1 = datetime.datetime(2000, 1, 2)
+        test_timestamp_2 = datetime.datetime(2003, 4, 5)
+
+        user_info_1 = models.UserInfo()
+        user_info_1.email = user_1.email()
+        user_info_1.is_reviewer = True
+        user_info_1.put()
+
+        for timestamp in [test_timestamp_1, test_timestamp_2]:
+            viewing_profile = models.ViewingProfile()
+            viewing_profile.viewer_email = user_1.email()
+            viewing_profile.profile_email = profile_email
+            viewing_profile.section_name = section_1_name
+            viewing_profile.last_visited = timestamp
+            viewing_profile.put()
+
+        self.assertFalse(models.MigrationStatus.is_complete(
+            constants.KEY_NAMES_MIGRATION))
+        self.assertEqual(account_facade.migrate_key_names(), 3)
+        self.assertEqual(models.UserInfo.all().count(), 1)
+        self.assertEqual(models.ViewingProfile.all().count(), 1)
+        self.assertTrue(models.MigrationStatus.is_complete(
+            constants.KEY_NAMES_MIGRATION))
+
+        ret_info_1 = models.UserInfo.get_by_key_name(user_1.email())
+        self.assertTrue(ret_info_1.is_reviewer)
+
+        ret_profile = models.ViewingProfile.get_for(user_1, profile_email,
+            section_1_name)
+        self.assertEqual(ret_profile.last_visited, test_timestamp_2)
+
+    def test_migrate_key_names_batches(self):
+        """Test migrating records to key names in chained batches."""
+        user_1 = FakeUser("test1@test.com")
+        user_2 = FakeUser("test2@test.com")
+
+        for user in [user_1, user_2]:
+            user_info = models.UserInfo()
+            user_info.email = user.email()
+            user_info.put()
+
+        # Records saved without a key name are moved when found until the
+        # migration ends
+        self.assertEqual(models.UserInfo.get_for_email(user_1.email()).email,
+            user_1.email())
+        self.assertTrue(models.UserInfo.get_by_key_name(user_1.email()))
+
+        old_batch_size = constants.MIGRATION_BATCH_SIZE
+        constants.MIGRATION_BATCH_SIZE = 1
+        try:
+            num_migrated, step, cursor = \
+                account_facade.migrate_key_names_batch()
+            self.assertEqual(num_migrated, 1)
+            self.assertEqual(step, "user_infos")
+            self.assertTrue(cursor)
+            self.assertFalse(models.MigrationStatus.is_complete(
+                constants.KEY_NAMES_MIGRATION))
+
+            total_migrated = 1
+            while step:
+                num_migrated, step, cursor = \
+                    account_facade.migrate_key_names_batch(step, cursor)
+                total_migrated += num_migrated
+        finally:
+            constants.MIGRATION_BATCH_SIZE = old_batch_size
+
+        self.assertEqual(total_migrated, 1)
+        self.assertTrue(models.MigrationStatus.is_complete(
+            constants.KEY_NAMES_MIGRATION))
+        self.assertTrue(models.UserInfo.get_by_key_name(user_2.email()))
+
+        # Lookups stop checking for legacy records once migrated
+        legacy_info = models.UserInfo()
+        legacy_info.email = "legacy@test.com"
+        legacy_info.put()
+        self.assertEqual(models.UserInfo.get_for_email("legacy@test.com"),
+            None)
+
+    def test_portfolio_sections(self):
+        """Test loading, caching and editing the portfolio sections."""
+        default_names = constants.DEFAULT_PORTFOLIO_SECTIONS
+        self.assertEqual(account_facade.get_portfolio_section_names(),
+            default_names)
+        self.assertEqual(models.PortfolioSection.all().count(), 0)
+        self.assertTrue(account_facade.seed_portfolio_sections())
+        self.assertFalse(account_facade.seed_portfolio_sections())
+        self.assertEqual(models.PortfolioSection.all().count(),
+            len(default_names))
+        self.assertTrue(account_facade.is_portfolio_section(default_names[0]))
+        self.assertFalse(account_facade.is_portfolio_section("typo"))
+
+        account_facade.save_portfolio_section("capstone", "Capstone", -1)
+        self.assertTrue(account_facade.is_portfolio_section("capstone"))
+        sections = account_facade.get_portfolio_sections()
+        self.assertEqual(sections[0],
+            account_facade.SectionInfo("capstone", "Capstone"))
+        self.assertEqual(len(sections), len(default_names) + 1)
+
+        # Sections changed by another instance are seen once the cache expires
+        models.PortfolioSection.create("other", "Other", 100).put()
+        memcache.incr("sections_version")
+        self.assertFalse(account_facade.is_portfolio_section("other"))
+        account_facade.section_cache = \
+            account_facade.section_cache._replace(checked=0)
+        self.assertTrue(account_facade.is_portfolio_section("other"))
+
+        account_facade.delete_portfolio_section("capstone")
+        self.assertFalse(account_facade.is_portfolio_section("capstone"))
+
+        self.assertTrue(util.check_section_name("new_section-2"))
+        self.assertFalse(util.check_section_name("new section"))
+        self.assertFalse(util.check_section_name(""))
+
+    def test_profiling(self):
+        """Test attributing request time and API calls to functions."""
+        user_1 = FakeUser("test1@test.com")
+        profiling.instrument_module(account_facade)
+        profiling.instrument_module(account_facade)
+
+        self.assertEqual(profiling.get_current_profile(), None)
+        profile = profiling.start_profile("GET", "/test")
+        account_facade.get_roster()
+        account_facade.is_admin(user_1)
+        summary = profiling.finish_profile(profile)
+        self.assertEqual(profiling.get_current_profile(), None)
+
+        self.assertEqual(summary["path"], "/test")
+        rpc_names = map(lambda x: x["name"], summary["rpcs"])
+        self.assertIn("memcache.Get", rpc_names)
+        self.assertIn("datastore_v3.RunQuery", rpc_names)
+        functions = dict(map(lambda x: (x["name"], x), summary["functions"]))
+        self.assertEqual(functions["get_roster"]["calls"], 1)
+        self.assertGreater(functions["get_roster"]["rpcs"], 0)
+        self.assertEqual(functions["is_admin > get_viewer_context"]["calls"],
+            1)
+
+        self.assertEqual(profiling.get_recent_profiles(), [summary])
+        account_facade.get_roster()
+        self.assertEqual(profiling.get_recent_profiles(), [summary])
+
+    def test_profiling_middleware(self):
+        """Test that only administrators can profile requests."""
+        def app(environ, start_response):
+            start_response("200 OK", [])
+            return ["body"]
+        middleware = profiling.ProfilingMiddleware(app)
+
+        user_1 = FakeUser("first.admin@colorado.edu")
+        account_facade.ensure_user_info(user_1)
+
+        # Administrators of the App Engine project are not enough
+        headers = {constants.PROFILE_HEADER: "1"}
+        self.testbed.setup_env(USER_EMAIL=user_1.email(), USER_ID="1",
+            USER_IS_ADMIN="1", overwrite=True)
+        response = webapp2.Request.blank("/", headers=headers).get_response(
+            middleware)
+        self.assertEqual(response.body, "body")
+        self.assertEqual(profiling.get_recent_profiles(), [])
+
+        # Profiles are finished once the body is read
+        account_facade.make_admin(user_1.email())
+        self.testbed.setup_env(USER_IS_ADMIN="0", overwrite=True)
+        response = webapp2.Request.blank("/", headers=headers).get_response(
+            middleware)
+        self.assertEqual(response.body, "body")
+        self.assertEqual(len(profiling.get_recent_profiles()), 1)
+
+        self.testbed.setup_env(USER_EMAIL="", USER_ID="", overwrite=True)
+        response = webapp2.Request.blank("/", headers=headers,
+            environ={"SERVER_SOFTWARE": "Development/1.0"}).get_response(
+            middleware)
+        self.assertEqual(response.body, "body")
+        self.assertEqual(len(profiling.get_recent_profiles()), 2)
+
     def test_get_full_name(self):
         """Test getting full name of a user based on his / her email address."""
         name = util.get_full_name_from_email("first.last@colorado.edu")
         self.assertEqual(name[0], "First")
         self.assertEqual(name[1], "Last")
 
+    def test_get_older_comments_url(self):
+        """Test escaping the parts of the URL of older comments."""
+        url = util.get_older_comments_url("first.last@colorado.edu",
+            "a section/2", datetime.datetime(1970, 1, 1), "cursor&1", "json")
+        self.assertEqual(url, "/portfolio/first.last%40colorado.edu/section/"
+            "a%20section%2F2/older?visited=0&cursor=cursor%261&format=json")
+
+    def test_warm_up(self):
+        """Test loading all templates ahead of use."""
+        template_names = templating.warm_up()
+        self.assertIn("base.html", template_names)
+        self.assertIn("portfolio_section.html", template_names)
+
+    def test_generate_chunks(self):
+        """Test rendering a template in chunks as its values are ready."""
+        calls = []
+
+        def get_items():
+            calls.append(True)
+            return [u"\xe9", "x" * constants.STREAM_CHUNK_SIZE, "y"]
+
+        template = templating.jinja_environment.from_string(
+            "header{{ stream_flush }}{% for item in items %}{{ item }}"
+            "{% endfor %}")
+        chunks = templating.generate_chunks(template,
+            {"items": util.LazyResult(get_items)})
+
+        self.assertEqual(chunks.next(),
+            "header" + templating.STREAM_FLUSH_MARKER)
+        self.assertEqual(calls, [])
+        self.assertEqual(list(chunks), [
+            "\xc3\xa9" + "x" * constants.STREAM_CHUNK_SIZE,
+            "y"
+        ])
+        self.assertEqual(len(calls), 1)
+
+    def test_stream_response(self):
+        """Test completing a response body only if it is fully rendered."""
+        completed = []
+
+        def generate_failing_chunks():
+            yield "header"
+            raise ValueError("render failed")
+
+        handler = ehp_portfolios_comments.BaseHandler(
+            webapp2.Request.blank("/"), webapp2.Response())
+        handler.stream_response(["header", "body"],
+            lambda: completed.append(True))
+        self.assertEqual(handler.response.body, "headerbody")
+        self.assertEqual(len(completed), 1)
+
+        with self.assertRaises(ValueError):
+            handler.stream_response(generate_failing_chunks(),
+                lambda: completed.append(True))
+        self.assertEqual(len(completed), 1)
+
+        # Streamed bodies only complete once the client reads all of them
+        old_stream_responses = constants.STREAM_RESPONSES
+        constants.STREAM_RESPONSES = True
+        try:
+            handler.stream_response(["header", "body"],
+                lambda: completed.append(True))
+            self.assertEqual(handler.response.app_iter.next(), "header")
+            handler.response.app_iter.close()
+            self.assertEqual(len(completed), 1)
+
+            handler.stream_response(["header", "body"],
+                lambda: completed.append(True))
+            self.assertEqual(list(handler.response.app_iter),
+                ["header", "body"])
+        finally:
+            constants.STREAM_RESPONSES = old_stream_responses
+        self.assertEqual(len(completed), 2)
+
+    def test_lazy_result(self):
+        """Test deferring a computation until its result is used."""
+        calls = []
+
+        def get_value():
+            calls.append(True)
+            return {"section": 1}
+
+        lazy_result = util.LazyResult(get_value)
+        self.assertEqual(calls, [])
+        self.assertIn("section", lazy_result)
+        self.assertEqual(lazy_result["section"], 1)
+        self.assertEqual(lazy_result.values(), [1])
+        self.assertTrue(lazy_result)
+        self.assertEqual(len(calls), 1)
+
 
 if __name__ == "__main__":
     unittest2.main()
@@ -5,11 +5,17 @@ Convienence routines for the EHP Portfolio Private Comments application.
 @license: GNU GPL v3
 """
 
+import calendar
+import cgi
 import collections
+import datetime
 import re
 import urllib
 
+import constants
+
 EMAIL_REGEX = re.compile("([\w\d\-]+)\.([\w\d\-]+)\@colorado\.edu")
+SECTION_NAME_REGEX = re.compile("^[A-Za-z0-9_\-]+$")
 
 
 # Simple struct to hold information about a portfolio section
@@ -19,6 +25,63 @@ SectionStatus = collections.namedtuple(
 )
 
 
+class LazyResult(object):
+    """
+    Proxy for a value that is only computed (or waited for) when first used.
+
+    Proxy for the result of a function that is called the first time the
+    result is needed, allowing asynchronous operations to be started early and
+    only waited on when (and if) a template uses their results.
+    """
+
+    def __init__(self, get_value):
+        """
+        Create a new LazyResult.
+
+        @param get_value: Function without arguments returning the value.
+        @type get_value: function
+        """
+        self.__get_value = get_value
+        self.__is_resolved = False
+        self.__value = None
+
+    def get_result(self):
+        """
+        Get the value of this LazyResult, computing it if not yet computed.
+
+        @return: The value returned by the function given to this LazyResult.
+        @rtype: any
+        """
+        if not self.__is_resolved:
+            self.__value = self.__get_value()
+            self.__is_resolved = True
+        return self.__value
+
+    def __getattr__(self, name):
+        return getattr(self.get_result(), name)
+
+    def __iter__(self):
+        return iter(self.get_result())
+
+    def __len__(self):
+        return len(self.get_result())
+
+    def __contains__(self, item):
+        return item in self.get_result()
+
+    def __getitem__(self, key):
+        return self.get_result()[key]
+
+    def __nonzero__(self):
+        return bool(self.get_result())
+
+    def __str__(self):
+        return str(self.get_result())
+
+    def __unicode__(self):
+        return unicode(self.get_result())
+
+
 def check_email(target_email):
     """
     Check that an email address is an individual email from colorado.edu.
@@ -31,6 +94,19 @@ def check_email(target_email):
     return EMAIL_REGEX.match(target_email) != None
 
 
+def check_section_name(section_name):
+    """
+    Check that a portfolio section name can be used in URLs.
+
+    @param section_name: The section name to check.
+    @type section_name: str
+    @return: True if the name contains only letters, numbers, - and _ and
+             False otherwise.
+    @rtype: bool
+    """
+    return SECTION_NAME_REGEX.match(section_name) != None
+
+
 def get_user_home(target_user):
     """
     Get the URL that a user should be redirected to after authenticating.
@@ -56,6 +132,39 @@ def get_safe_email(target_user):
     return sanitize_email(target_user.email())
 
 
+def get_older_comments_url(profile_email, section_name, last_visited, cursor,
+    response_format=None):
+    """
+    Get the URL for the next page of older comments on a portfolio section.
+
+    @param profile_email: The email address of the user whose portfolio the
+                          comments are on.
+    @type profile_email: str
+    @param section_name: The name of the section the comments are on.
+    @type section_name: str
+    @param last_visited: The time of the visit splitting new and old comments.
+    @type last_visited: datetime.datetime
+    @param cursor: The cursor for the next page of comments.
+    @type cursor: str
+    @keyword response_format: The format the page should be returned in ("json"
+                              or None for an HTML fragment).
+    @type response_format: str
+    @return: URL for the next page of older comments.
+    @rtype: str
+    """
+    params = [
+        ("visited", timestamp_to_token(last_visited)),
+        ("cursor", cursor)
+    ]
+    if response_format:
+        params.append(("format", response_format))
+    return "/portfolio/%s/section/%s/older?%s" % (
+        sanitize_email(profile_email),
+        urllib.quote(section_name, ""),
+        urllib.urlencode(params)
+    )
+
+
 def sanitize_email(target_email):
     """
     Get a URL-safe version of an email address.
@@ -83,3 +192,74 @@ def get_full_name_from_email(target_email):
     if not match:
         return target_email
     return [match.group(1).capitalize(), match.group(2).capitalize()]
+
+
+def timestamp_to_token(timestamp):
+    """
+    Encode a timestamp as a URL-safe string.
+
+    @param timestamp: The (UTC) timestamp to encode.
+    @type timestamp: datetime.datetime
+    @return: The number of microseconds since the epoch as a string.
+    @rtype: str
+    """
+    seconds = calendar.timegm(timestamp.utctimetuple())
+    return str(seconds * 1000000 + timestamp.microsecond)
+
+
+def token_to_timestamp(token):
+    """
+    Decode a timestamp encoded by timestamp_to_token.
+
+    @param token: The string to decode.
+    @type token: str
+    @return: The decoded timestamp or None if the token is not valid.
+    @rtype: datetime.datetime
+    """
+    try:
+        microseconds = int(token)
+    except (TypeError, ValueError):
+        return None
+    return datetime.datetime(1970, 1, 1) + \
+        datetime.timedelta(microseconds=microseconds)
+
+
+def format_unread_count(count):
+    """
+    Format a number of unread comments for display in a badge.
+
+    @param count: The number of unread comments.
+    @type count: int
+    @return: The number as a string or constants.UNREAD_COUNT_CAP followed by
+             a plus sign if the number exceeds the cap (ex: "99+").
+    @rtype: str
+    """
+    if count > constants.UNREAD_COUNT_CAP:
+        return "%d+" % constants.UNREAD_COUNT_CAP
+    return str(count)
+
+
+def render_comment_html(author_email, timestamp, contents):
+    """
+    Render the HTML block displaying a private comment.
+
+    @param author_email: The email address of the user that wrote the comment.
+    @type author_email: str
+    @param timestamp: When the comment was posted.
+    @type timestamp: datetime.datetime
+    @param contents: The already escaped HTML contents of the comment.
+    @type contents: str
+    @return: HTML with the comment header (author and date) and contents.
+    @rtype: str
+    """
+    return COMMENT_HTML_TEMPLATE % (
+        cgi.escape(author_email),
+        timestamp.strftime("%Y-%m-%d"),
+        contents
+    )
+
+
+COMMENT_HTML_TEMPLATE = """<div class="comment-header">
+    %s at %s
+</div>
+%s"""